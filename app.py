@@ -1,14 +1,22 @@
 from asyncio import Task
-from threading import Event
-from quart import Quart, request, render_template, websocket as ws
+import asyncio
+from quart import Quart, Response, g, request, render_template, \
+  websocket as ws
 from quart.datastructures import FileStorage
 from json import dumps, loads
 from pathlib import Path
-from common import TEMP_FOLDER, BackendError, ensure_directories
+from common import DISK_QUOTA_BYTES, PROFILE_REQUESTS, TEMP_FOLDER, \
+  TRACKING_WINDOW, BackendError, ReturnResult, ensure_directories
 from collections import namedtuple
-from time import sleep
+from time import perf_counter
+from typing import Union
 import os.path
 import tempfile
+from metrics import metrics, request_profiler, request_seconds
+from frame_similarity import DEFAULT_THRESHOLD
+from interpolation import DEFAULT_MIN_SIMILARITY
+import dataset
+import upload
 import video_tool
 
 app = Quart(__name__)
@@ -21,13 +29,49 @@ VideoInfo = namedtuple('VideoInfo', [
     'labeled_frames', 'excluded_frames'
 ])
 
+label_flush_task: Union[Task, None] = None
+disk_quota_task: Union[Task, None] = None
+
 @app.before_serving
 async def before_serving():
+  global label_flush_task, disk_quota_task
   await video_tool.load_videos()
+  label_flush_task = asyncio.ensure_future(video_tool.label_flush_loop())
+  if DISK_QUOTA_BYTES:
+    disk_quota_task = asyncio.ensure_future(video_tool.disk_quota_loop())
 
 @app.after_serving
 async def after_serving():
+  for task in (label_flush_task, disk_quota_task):
+    if task is not None:
+      task.cancel()
+      await asyncio.gather(task, return_exceptions=True)
   await video_tool.save_videos()
+  video_tool.shutdown_workers()
+  dataset.shutdown_export_executor()
+
+@app.before_request
+async def start_request_timer():
+  g.request_started = perf_counter()
+  g.profile = None
+  if PROFILE_REQUESTS and request.args.get('profile') == '1':
+    g.profile = request_profiler.start()
+
+@app.after_request
+async def record_request_time(response):
+  started = g.get('request_started')
+  if started is None:
+    return response
+  seconds = perf_counter() - started
+  # the rule rather than the path, so every video shares one series
+  route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+  request_seconds.observe(seconds,
+                          route=route,
+                          method=request.method,
+                          status=response.status_code)
+  if g.get('profile') is not None:
+    request_profiler.stop(g.profile, route, seconds)
+  return response
 
 # web page routes
 
@@ -49,7 +93,7 @@ async def index_page():
     else:
       videos.append(
           VideoInfo(video_id, video_info[1], "-",
-                    video_info[2].name.split(".")[1], video_info[3],
+                    video_info[2].name, video_info[3],
                     video_info[4], "-", "-"))
   return await render_template('index.html.j2', videos=videos)
 
@@ -80,7 +124,7 @@ async def api_root():
 
 @app.route("/api/videos")
 async def api_all_videos():
-  videos = video_tool.get_all_videos()
+  videos = await video_tool.get_all_videos()
   if not videos.is_success:
     return dumps({"status": videos.status, "error": videos.message})
   return dumps({"status": 0, "videos": videos.data})
@@ -90,7 +134,8 @@ async def api_video_info(video_id):
   result = await video_tool.get_video_info(video_id)
   if not result.is_success:
     return dumps({"status": result.status, "error": result.message})
-  processed, data = result.data[0], result.data[1:]
+  # data[1] is the video name
+  processed, data = result.data[0], result.data[2:]
   if processed:
     return dumps({
         "status": 0,
@@ -136,6 +181,66 @@ async def api_video_upload():
                                                         tmp_file_path)).data
   return dumps({"status": 0, "video_id": video_id, "video_name": video_name})
 
+@app.route('/api/upload', methods=['POST'])
+async def api_create_upload():
+  params = await request.get_json(silent=True)
+  if not isinstance(params, dict) or 'name' not in params \
+    or 'size' not in params:
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await upload.create_upload(params['name'], params['size'],
+                                      params.get('sha256'))
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/upload/<string:upload_id>', methods=['GET'])
+async def api_upload_status(upload_id):
+  result = await upload.get_upload(upload_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/upload/<string:upload_id>', methods=['PUT'])
+async def api_upload_chunk(upload_id):
+  offset = request.args.get('offset', type=int)
+  if offset is None:
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await upload.write_chunk(upload_id, offset, request.content_length,
+                                    request.body)
+  if not result.is_success:
+    return dumps({
+        "status": result.status,
+        "error": result.message,
+        **(result.data or {})
+    })
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/upload/<string:upload_id>/finish', methods=['POST'])
+async def api_finish_upload(upload_id):
+  result = await upload.finish_upload(upload_id)
+  if not result.is_success:
+    return dumps({
+        "status": result.status,
+        "error": result.message,
+        **(result.data or {})
+    })
+  video_name, video_id, duplicate = result.data
+  return dumps({
+      "status": 0,
+      "video_id": video_id,
+      "video_name": video_name,
+      "duplicate": duplicate
+  })
+
+@app.route('/api/upload/<string:upload_id>/cancel', methods=['GET'])
+async def api_cancel_upload(upload_id):
+  result = await upload.cancel_upload(upload_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0})
+
 @app.route('/api/video/<string:video_id>/cancel', methods=['GET'])
 async def api_frame_extract_cancel(video_id):
   result = await video_tool.cancel_process(video_id)
@@ -143,6 +248,18 @@ async def api_frame_extract_cancel(video_id):
     return dumps({"status": result.status, "error": result.message})
   return dumps({"status": 0})
 
+@app.route('/api/video/<string:video_id>/delete', methods=['GET'])
+async def api_delete_video(video_id):
+  result = await video_tool.delete_video(video_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0})
+
+@app.route('/api/storage', methods=['GET'])
+async def api_storage():
+  result = video_tool.get_storage_stats()
+  return dumps({"status": 0, **result.data})
+
 @app.route('/api/video/<string:video_id>/frames/<int:index>', methods=['GET'])
 async def api_read_frame(video_id, index):
   result = await video_tool.read_frame(video_id, index)
@@ -154,30 +271,140 @@ async def api_read_frame(video_id, index):
       "frame_labels": result.data[1]
   })
 
+FRAME_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+async def send_frame_image(frame_id: str, result):
+  if not result.is_success:
+    return await app.send_static_file('img/file_not_found.png')
+  frame_bytes, mimetype = result.data
+  # a frame never changes for the lifetime of its video, so its id is a
+  # strong validator
+  return Response(frame_bytes,
+                  mimetype=mimetype,
+                  headers={
+                      "ETag": f'"{frame_id}"',
+                      "Cache-Control": FRAME_CACHE_CONTROL
+                  })
+
+def frame_not_modified(frame_id: str):
+  if not request.if_none_match.contains(frame_id):
+    return None
+  return Response(status=304,
+                  headers={
+                      "ETag": f'"{frame_id}"',
+                      "Cache-Control": FRAME_CACHE_CONTROL
+                  })
+
 @app.route('/api/frame/<string:frame_id>', methods=['GET'])
 async def api_get_frame_png(frame_id):
-  result = video_tool.get_frame_png(frame_id)
+  if (not_modified := frame_not_modified(frame_id)) is not None:
+    return not_modified
+  return await send_frame_image(frame_id, await
+                                video_tool.get_frame_png(frame_id))
+
+@app.route('/api/video/<string:video_id>/frames/<int:index>/image',
+           methods=['GET'])
+async def api_get_frame_image(video_id, index):
+  frame_id = video_tool.frame_id_of(video_id, index)
+  if (not_modified := frame_not_modified(frame_id)) is not None:
+    return not_modified
+  return await send_frame_image(
+      frame_id, await video_tool.get_frame_image(video_id, index))
+
+@app.route('/api/video/<string:video_id>/frames/<int:index>/preview',
+           methods=['GET'])
+async def api_get_frame_preview(video_id, index):
+  frame_id = f"{video_tool.frame_id_of(video_id, index)}_preview"
+  if (not_modified := frame_not_modified(frame_id)) is not None:
+    return not_modified
+  result = await video_tool.get_frame_preview(video_id, index)
   if not result.is_success:
-    return await app.send_static_file('img/placeholder.png')
-  return await app.send_static_file(result.data)
+    return await app.send_static_file('img/file_not_found.png')
+  return Response(result.data,
+                  mimetype="image/jpeg",
+                  headers={
+                      "ETag": f'"{frame_id}"',
+                      "Cache-Control": FRAME_CACHE_CONTROL
+                  })
+
+@app.route('/api/video/<string:video_id>/thumbnails', methods=['GET'])
+async def api_thumbnails(video_id):
+  start = request.args.get('start', 1, type=int)
+  count = request.args.get('count', 100, type=int)
+  result = await video_tool.get_thumbnails(video_id, start, count)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({
+      "status": 0,
+      **result.data, "sprite":
+          f"/api/video/{video_id}/thumbnails/sprite?start={start}" +
+          f"&count={result.data['count']}"
+  })
+
+@app.route('/api/video/<string:video_id>/thumbnails/sprite', methods=['GET'])
+async def api_thumbnail_sprite(video_id):
+  start = request.args.get('start', 1, type=int)
+  count = request.args.get('count', 100, type=int)
+  columns = request.args.get('columns', 10, type=int)
+  sprite_id = f"{video_id}_{start}_{count}_{columns}_sprite"
+  if (not_modified := frame_not_modified(sprite_id)) is not None:
+    return not_modified
+  result = await video_tool.get_thumbnail_sprite(video_id, start, count,
+                                                 columns)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  sprite, complete = result.data
+  # a sheet with frames still missing is only good until the build is done
+  headers = {
+      "ETag": f'"{sprite_id}"',
+      "Cache-Control": FRAME_CACHE_CONTROL
+  } if complete else {"Cache-Control": "no-store"}
+  return Response(sprite, mimetype="image/jpeg", headers=headers)
+
+@app.route('/api/frame_cache', methods=['GET'])
+async def api_frame_cache_stats():
+  result = video_tool.get_frame_cache_stats()
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/metrics', methods=['GET'])
+async def api_metrics():
+  # Prometheus text format by default, ?format=json adds p50/p95/p99
+  if request.args.get('format') == 'json':
+    return dumps({"status": 0, "metrics": metrics.to_dict()})
+  return Response(metrics.render(),
+                  mimetype="text/plain",
+                  content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/api/metrics/profiles', methods=['GET'])
+async def api_metrics_profiles():
+  return dumps({
+      "status": 0,
+      "enabled": bool(PROFILE_REQUESTS),
+      "profiles": list(request_profiler.profiles)
+  })
 
 @app.route('/api/video/<string:video_id>/frames/<int:index>/label',
            methods=['POST'])
 async def api_label_frame(video_id, index):
-  if 'label' not in await request.json or 'box' not in await request.json:
+  params = await request.get_json(silent=True)
+  if not isinstance(params, dict) or 'label' not in params \
+    or 'box' not in params:
     ir = BackendError.INVALID_REQUEST
     return dumps({"status": ir, "error": ir.error_message})
-  label = (await request.json)['label']
-  box = (await request.json)['box']
-  result = await video_tool.label_frame(video_id, index, label, box)
+  result = await video_tool.label_frame(video_id, index, params['label'],
+                                        params['box'])
   if not result.is_success:
     return dumps({"status": result.status, "error": result.message})
   return dumps({"status": 0, "label_id": result.data})
 
 @app.route('/api/video/<string:video_id>/frames/<int:index>/unlabel',
            methods=['GET'])
-async def api_unlabel_frame(video_id, label_id):
-  result = await video_tool.unlabel_frame(video_id, label_id)
+async def api_unlabel_frame(video_id, index):
+  label_id = request.args.get('label_id')
+  if not label_id:
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await video_tool.unlabel_frame(video_id, index, label_id)
   if not result.is_success:
     return dumps({"status": result.status, "error": result.message})
   return dumps({"status": 0})
@@ -190,6 +417,149 @@ async def api_exclude_frame(video_id, index):
     return dumps({"status": result.status, "error": result.message})
   return dumps({"status": 0})
 
+async def ndjson_lines(body):
+  pending = b""
+  async for data in body:
+    pending += data
+    *lines, pending = pending.split(b"\n")
+    for line in lines:
+      if line.strip():
+        yield line
+  if pending.strip():
+    yield pending
+
+@app.route('/api/video/<string:video_id>/labels/batch', methods=['POST'])
+async def api_label_batch(video_id):
+  # a json list of operations (or {"operations": [...]}), or ndjson with one
+  # operation per line; a line that doesn't parse only fails itself
+  if request.mimetype == 'application/x-ndjson':
+    operations = []
+    async for line in ndjson_lines(request.body):
+      try:
+        operations.append(loads(line))
+      except ValueError:
+        operations.append(None)
+  else:
+    params = await request.get_json(silent=True)
+    operations = params.get('operations') if isinstance(params,
+                                                        dict) else params
+  if not isinstance(operations, list):
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await video_tool.apply_label_operations(video_id, operations)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  failed = sum(1 for r in result.data if r["status"] != BackendError.SUCCESS)
+  return dumps({
+      "status": 0,
+      "applied": len(result.data) - failed,
+      "failed": failed,
+      "results": result.data
+  })
+
+@app.route('/api/video/<string:video_id>/near_duplicates', methods=['GET'])
+async def api_near_duplicates(video_id):
+  threshold = request.args.get('threshold', DEFAULT_THRESHOLD, type=float)
+  with_changes = request.args.get('changes', 0, type=int) == 1
+  result = await video_tool.get_near_duplicates(video_id, threshold,
+                                                with_changes)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/video/<string:video_id>/near_duplicates/exclude',
+           methods=['GET'])
+async def api_exclude_near_duplicates(video_id):
+  threshold = request.args.get('threshold', DEFAULT_THRESHOLD, type=float)
+  result = await video_tool.exclude_near_duplicates(video_id, threshold)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, "excluded_frames": result.data})
+
+@app.route('/api/video/<string:video_id>/object_tracking/stats',
+           methods=['GET'])
+async def api_object_tracking_stats(video_id):
+  result = await video_tool.get_tracking_stats(video_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, "trackers": result.data})
+
+@app.route('/api/video/<string:video_id>/tracking_jobs', methods=['POST'])
+async def api_start_tracking_job(video_id):
+  params = await request.get_json(silent=True)
+  if not isinstance(params, dict) or 'start' not in params \
+    or 'algorithm' not in params:
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await video_tool.start_tracking_job(
+      video_id, params['start'], params['algorithm'],
+      params.get('max_frames'), bool(params.get('stop_on_failure', False)),
+      params.get('min_iou'), params.get('scale', 1.0),
+      params.get('priority', 0), params.get('method', "linear"),
+      params.get('max_gap'), params.get('refine'),
+      params.get('min_similarity', DEFAULT_MIN_SIMILARITY))
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, "job_id": result.data})
+
+@app.route('/api/tracking_jobs', methods=['GET'])
+async def api_all_tracking_jobs():
+  result = video_tool.get_all_tracking_jobs()
+  return dumps({"status": 0, "jobs": result.data[0], **result.data[1]})
+
+@app.route('/api/tracking_jobs/<string:job_id>', methods=['GET'])
+async def api_tracking_job(job_id):
+  result = video_tool.get_tracking_job(job_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/tracking_jobs/<string:job_id>/cancel', methods=['GET'])
+async def api_cancel_tracking_job(job_id):
+  result = video_tool.cancel_tracking_job(job_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0})
+
+@app.route('/api/datasets', methods=['POST'])
+async def api_create_dataset():
+  params = await request.get_json(silent=True)
+  if not isinstance(params, dict) or 'video_ids' not in params \
+    or 'format' not in params:
+    ir = BackendError.INVALID_REQUEST
+    return dumps({"status": ir, "error": ir.error_message})
+  result = await dataset.create_export(params['video_ids'], params['format'],
+                                       params.get('val_fraction', 0.2),
+                                       params.get('quality', 90),
+                                       params.get('seed', 0))
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/datasets', methods=['GET'])
+async def api_all_datasets():
+  result = dataset.get_all_exports()
+  return dumps({"status": 0, "exports": result.data})
+
+@app.route('/api/datasets/<string:export_id>', methods=['GET'])
+async def api_dataset(export_id):
+  result = dataset.get_export(export_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  return dumps({"status": 0, **result.data})
+
+@app.route('/api/datasets/<string:export_id>/download', methods=['GET'])
+async def api_download_dataset(export_id):
+  result = dataset.stream_export(export_id)
+  if not result.is_success:
+    return dumps({"status": result.status, "error": result.message})
+  response = Response(result.data, mimetype="application/x-tar")
+  response.headers["Content-Disposition"] = \
+    f"attachment; filename=dataset_{export_id}.tar"
+  # a large export streams for longer than quart's default response timeout
+  response.timeout = None
+  return response
+
 @app.websocket('/api/video/<string:video_id>/object_tracking')
 async def api_object_tracking(video_id: str):
   params = await ws.receive()
@@ -202,8 +572,10 @@ async def api_object_tracking(video_id: str):
     return
   frame_index = params['start']
   algorithm = params['algorithm']
+  window = params.get('window', TRACKING_WINDOW)
+  scale = params.get('scale', 1.0)
   result = await video_tool.start_object_tracking(video_id, frame_index,
-                                                  algorithm)
+                                                  algorithm, window, scale)
   if not result.is_success:
     if result.status in [
         BackendError.VIDEO_NOT_FOUND, BackendError.VIDEO_PROCESSING,
@@ -213,22 +585,46 @@ async def api_object_tracking(video_id: str):
       code = 1011
     elif result.status == BackendError.UNACCEPTABLE_ALGORITHM:
       code = 1008
+    elif result.status == BackendError.INVALID_ARGUMENT:
+      code = 1007
     else:
       code = 1006
 
     await ws.close(code, result.message)
-  task: Task = result.data[0]
-  continue_event: Event = result.data[1]
-  while not task.done():
-    while continue_event.is_set():
-      sleep(0.1)
-    frame_index += 1
-    frame_result = await video_tool.read_frame(video_id, frame_index)
-    if not frame_result.is_success:
-      await ws.close(1011, frame_result.message)
-      task.cancel()
-      return
-    frame_id, frame_labels = frame_result.data
-    await ws.send(dumps({"frame_id": frame_id, "frame_labels": frame_labels}))
-    continue_event.set()
-  await ws.close(1000)
+    return
+  stream: video_tool.TrackingStream = result.data
+
+  async def receive_commands():
+    while True:
+      message = await ws.receive()
+      try:
+        command = loads(message).get('command')
+      except (ValueError, AttributeError):
+        continue
+      if command == 'pause':
+        stream.pause()
+      elif command == 'resume':
+        stream.resume()
+
+  receiver = asyncio.ensure_future(receive_commands())
+  try:
+    while True:
+      item = await stream.frames.get()
+      if isinstance(item, ReturnResult):
+        if not item.is_success:
+          await ws.close(1011, item.message)
+        else:
+          await ws.close(1000)
+        return
+      frame_result = await video_tool.read_frame(video_id, item)
+      if not frame_result.is_success:
+        await ws.close(1011, frame_result.message)
+        return
+      frame_id, frame_labels = frame_result.data
+      await ws.send(dumps({
+          "frame_id": frame_id,
+          "frame_labels": frame_labels
+      }))
+  finally:
+    receiver.cancel()
+    stream.cancel()
@@ -0,0 +1,68 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from threading import Event
+from time import perf_counter
+import shutil
+import tempfile
+from frame_store import create_frame_store, extract_frames, \
+  measure_random_read, probe_video
+
+class _Progress:
+
+  def __init__(self):
+    self.value = 0
+
+def bench_store(kind: str, video_path: str, quality: int, frame_limit: int):
+  folder = Path(tempfile.mkdtemp(prefix=f"bench_{kind}_"))
+  try:
+    store = create_frame_store(kind, folder, quality)
+    frame_count = probe_video(video_path)[0]
+    if frame_limit:
+      frame_count = min(frame_count, frame_limit)
+    started = perf_counter()
+    if store.extracts_frames:
+      frames, stored_bytes = extract_frames(video_path, store, frame_count,
+                                            _Progress(), Event())
+    else:
+      source_copy = Path(folder, "upload.mp4")
+      shutil.copyfile(video_path, source_copy)
+      stored_bytes = source_copy.stat().st_size
+      store.import_source(str(source_copy))
+      frames = frame_count
+    elapsed = perf_counter() - started
+    random_read = measure_random_read(store, frames, samples=20)
+    store.close()
+    return {
+        "frame_store": kind,
+        "frames": frames,
+        "frames_per_second": frames / elapsed if elapsed > 0 else 0.0,
+        "bytes_per_frame": stored_bytes / frames if frames else 0.0,
+        "random_read_ms": random_read * 1000
+    }
+  finally:
+    shutil.rmtree(folder, ignore_errors=True)
+
+def main():
+  parser = ArgumentParser(
+      description="Compare frame store backends on a video")
+  parser.add_argument("video")
+  parser.add_argument("--stores",
+                      nargs="+",
+                      default=["png", "jpeg", "webp", "lazy"])
+  parser.add_argument("--quality", type=int, default=90)
+  parser.add_argument("--frames",
+                      type=int,
+                      default=0,
+                      help="only extract the first N frames")
+  args = parser.parse_args()
+  print(f"{'store':<8}{'frames':>8}{'frames/s':>12}{'KiB/frame':>12}" +
+        f"{'random ms':>12}")
+  for kind in args.stores:
+    result = bench_store(kind, args.video, args.quality, args.frames)
+    print(f"{result['frame_store']:<8}{result['frames']:>8}" +
+          f"{result['frames_per_second']:>12.1f}" +
+          f"{result['bytes_per_frame'] / 1024:>12.1f}" +
+          f"{result['random_read_ms']:>12.2f}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,173 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import List
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from label_journal import LabelJournal
+from label_store import LabelStore
+import video_tool
+
+def make_video(frame_count: int):
+  # labels only, no frames are ever read
+  video = video_tool.Video("bench_labels")
+  folder = Path("data", "videos", video.identifier).absolute()
+  folder.mkdir(parents=True, exist_ok=True)
+  video_tool.videos.put(video.identifier, video)
+  video.total_frame_count = frame_count
+  video.resolution = (1920, 1080)
+  video.extract_stats = None
+  video.frame_store = None
+  video.labels = LabelStore()
+  video.journal = LabelJournal(folder)
+  video.excluded_frames = []
+  video.process_status = video_tool.Video.ProcessStatus.COMPLETED
+  return video
+
+def random_operations(count: int, frame_count: int, seed: int):
+  rng = random.Random(seed)
+  operations = []
+  for _ in range(count):
+    left = rng.uniform(0, 1800)
+    top = rng.uniform(0, 1000)
+    operations.append({
+        "op": "label",
+        "frame": rng.randrange(1, frame_count + 1),
+        "label": rng.choice(["red", "blue", "robot"]),
+        "box": [left, top, left + rng.uniform(10, 120),
+                top + rng.uniform(10, 80)]
+    })
+  return operations
+
+async def single_requests(client, video, operations: List[dict]):
+  started = perf_counter()
+  for operation in operations:
+    response = await client.post(
+        f"/api/video/{video.identifier}/frames/{operation['frame']}/label",
+        json={
+            "label": operation["label"],
+            "box": operation["box"]
+        })
+    assert json.loads(await response.get_data())["status"] == 0
+  return perf_counter() - started
+
+async def batch_request(client, video, operations: List[dict], ndjson: bool):
+  started = perf_counter()
+  if ndjson:
+    response = await client.post(
+        f"/api/video/{video.identifier}/labels/batch",
+        data="\n".join(json.dumps(operation) for operation in operations),
+        headers={"Content-Type": "application/x-ndjson"})
+  else:
+    response = await client.post(f"/api/video/{video.identifier}/labels/batch",
+                                 json=operations)
+  result = json.loads(await response.get_data())
+  elapsed = perf_counter() - started
+  assert result["status"] == 0 and result["failed"] == 0, result.get("error")
+  return elapsed, result["results"]
+
+async def bench(args):
+  from app import app
+  results = []
+  async with app.test_app() as test_app:
+    client = test_app.test_client()
+    try:
+      results = await run(client, args)
+    finally:
+      # these have no frame store, so they must not reach the saved index
+      for video in video_tool.videos.values():
+        if video.name == "bench_labels":
+          video_tool.videos.remove(video.identifier)
+  video_tool.shutdown_workers()
+  return results
+
+async def run(client, args):
+  results = []
+  video = make_video(args.frames)
+  operations = random_operations(args.single, args.frames, 0)
+  elapsed = await single_requests(client, video, operations)
+  results.append({
+      "mode": "one request per box",
+      "boxes": len(operations),
+      "seconds": elapsed,
+      "boxes_per_second": len(operations) / elapsed
+  })
+  for boxes in args.boxes:
+    for ndjson in (False, True):
+      video = make_video(args.frames)
+      operations = random_operations(boxes, args.frames, boxes)
+      elapsed, inserted = await batch_request(client, video, operations,
+                                              ndjson)
+      assert len(video.labels) == boxes
+      started = perf_counter()
+      await video.flush_labels()
+      flushed = perf_counter() - started
+      # the same request shape also takes the boxes out again
+      removals = [{
+          "op": "unlabel",
+          "label_id": result["label_id"]
+      } for result in inserted]
+      removals += [{
+          "op": "exclude",
+          "frame": frame_index
+      } for frame_index in range(1, args.frames + 1, 10)]
+      removed, _ = await batch_request(client, video, removals, ndjson)
+      assert len(video.labels) == 0
+      results.append({
+          "mode": "batch " + ("ndjson" if ndjson else "json"),
+          "boxes": boxes,
+          "seconds": elapsed,
+          "boxes_per_second": boxes / elapsed,
+          "journal_flush_seconds": flushed,
+          "removal_seconds": removed
+      })
+  return results
+
+def main():
+  parser = ArgumentParser(
+      description="Measure label insert throughput, single and batched")
+  parser.add_argument("--boxes",
+                      nargs="+",
+                      type=int,
+                      default=[10000, 50000],
+                      help="boxes per batch request")
+  parser.add_argument("--single",
+                      type=int,
+                      default=1000,
+                      help="boxes sent one request at a time")
+  parser.add_argument("--frames", type=int, default=5000)
+  parser.add_argument("--json",
+                      help="write the results as JSON to this file, " +
+                      "- for stdout")
+  args = parser.parse_args()
+  json_path = args.json and args.json != "-" and os.path.abspath(args.json)
+  # the app and Video keep their data under the relative data folder
+  work_folder = tempfile.mkdtemp(prefix="bench_labels_")
+  os.chdir(work_folder)
+  try:
+    results = asyncio.run(bench(args))
+  finally:
+    shutil.rmtree(work_folder, ignore_errors=True)
+  if args.json == "-":
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return
+  print(f"{'mode':<22}{'boxes':>8}{'seconds':>10}{'boxes/s':>12}" +
+        f"{'flush s':>10}{'remove s':>10}")
+  for result in results:
+    print(f"{result['mode']:<22}{result['boxes']:>8}" +
+          f"{result['seconds']:>10.3f}{result['boxes_per_second']:>12.0f}" +
+          (f"{result['journal_flush_seconds']:>10.3f}" +
+           f"{result['removal_seconds']:>10.3f}"
+           if "journal_flush_seconds" in result else ""))
+  if json_path:
+    with open(json_path, "w") as f:
+      json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+  main()
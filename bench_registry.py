@@ -0,0 +1,215 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Generic, TypeVar
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from common import Registry, ensure_directories
+from label_store import LabelStore
+from label_journal import LabelJournal
+import video_tool
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class LockedDict(Generic[K, V]):
+  # what the registry replaced: every access awaits one global asyncio.Lock
+
+  def __init__(self):
+    self.items: Dict[K, V] = {}
+    self.lock = asyncio.Lock()
+
+  async def get(self, key: K):
+    async with self.lock:
+      return self.items.get(key)
+
+  async def put(self, key: K, value: V):
+    async with self.lock:
+      self.items[key] = value
+
+def make_video(name: str, frame_count: int):
+  video = video_tool.Video(name)
+  folder = Path("data", "videos", video.identifier).absolute()
+  folder.mkdir(parents=True, exist_ok=True)
+  video.total_frame_count = frame_count
+  video.resolution = (640, 480)
+  video.extract_stats = None
+  video.frame_store = None
+  video.labels = LabelStore()
+  video.journal = LabelJournal(folder)
+  video.excluded_frames = []
+  video.process_status = video_tool.Video.ProcessStatus.COMPLETED
+  return video
+
+async def lookups(get, keys, tasks: int, per_task: int):
+  # every task yields between lookups like a request handler would, so
+  # a contended lock shows up as queueing rather than being hidden
+  async def worker(seed: int):
+    rng = random.Random(seed)
+    for _ in range(per_task):
+      await get(keys[rng.randrange(len(keys))])
+      await asyncio.sleep(0)
+
+  started = perf_counter()
+  await asyncio.gather(*[worker(i) for i in range(tasks)])
+  return tasks * per_task / (perf_counter() - started)
+
+async def bench_reads(args):
+  keys = [f"video_{i}" for i in range(args.videos)]
+  locked: LockedDict[str, int] = LockedDict()
+  registry: Registry[str, int] = Registry()
+  for i, key in enumerate(keys):
+    await locked.put(key, i)
+    registry.put(key, i)
+
+  async def registry_get(key: str):
+    return registry.get(key)
+
+  return {
+      "global_lock_lookups_per_second":
+          await lookups(locked.get, keys, args.tasks, args.operations),
+      "registry_lookups_per_second":
+          await lookups(registry_get, keys, args.tasks, args.operations)
+  }
+
+async def bench_mutations(args):
+  videos = [make_video(f"stress_{i}", args.frames) for i in range(args.videos)]
+  video_tool.videos.update({video.identifier: video for video in videos})
+  expected = {video.identifier: {} for video in videos}
+  excluded = {video.identifier: set() for video in videos}
+  stop = threading.Event()
+  churn = {"writes": 0, "reads": 0, "snapshots": 0}
+
+  def registry_churn():
+    # registers and drops videos from another thread while the loop reads
+    rng = random.Random(1)
+    while not stop.is_set():
+      key = f"churn_{rng.randrange(64)}"
+      if rng.random() < 0.5:
+        video_tool.videos.put(key, videos[0])
+      else:
+        video_tool.videos.remove(key)
+      churn["writes"] += 1
+      stop.wait(0.0001)
+
+  async def staggered_save(video: video_tool.Video):
+    # lets clients change the labels between two overlapping snapshots
+    await asyncio.sleep(0)
+    await video.save_labels()
+
+  async def persist_loop():
+    # snapshots and journal flushes race the mutations and each other
+    while not stop.is_set():
+      await asyncio.gather(*[video.flush_labels() for video in videos],
+                           *[video.save_labels() for video in videos],
+                           *[staggered_save(video) for video in videos])
+      churn["snapshots"] += 1
+      await asyncio.sleep(0.001)
+
+  async def client(seed: int):
+    rng = random.Random(seed)
+    for _ in range(args.operations):
+      video = videos[rng.randrange(len(videos))]
+      frame_index = rng.randrange(1, args.frames + 1)
+      labels = expected[video.identifier]
+      action = rng.random()
+      if action < 0.6:
+        result = await video_tool.label_frame(video.identifier, frame_index,
+                                              "robot", (10, 10, 50, 50))
+        labels[result.data] = frame_index
+      elif action < 0.8 and labels:
+        label_id = rng.choice(list(labels))
+        result = await video_tool.unlabel_frame(video.identifier,
+                                                labels.pop(label_id),
+                                                label_id)
+        assert result.is_success, result.message
+      elif action < 0.9:
+        await video_tool.exclude_frame(video.identifier, frame_index)
+        excluded[video.identifier].add(frame_index)
+      else:
+        result = await video_tool.get_all_videos()
+        assert video.identifier in result.data
+        churn["reads"] += 1
+      await asyncio.sleep(0)
+
+  churn_thread = threading.Thread(target=registry_churn, daemon=True)
+  churn_thread.start()
+  persist_task = asyncio.ensure_future(persist_loop())
+  started = perf_counter()
+  await asyncio.gather(*[client(i) for i in range(args.tasks)])
+  elapsed = perf_counter() - started
+  stop.set()
+  churn_thread.join()
+  await persist_task
+  for video in videos:
+    await video.flush_labels()
+
+  # what is in memory and what comes back from disk must both match what
+  # the clients did
+  mismatches = 0
+  for video in videos:
+    reloaded = video_tool.Video(video.name, video.identifier)
+    reloaded.load_labels()
+    for store, excluded_frames in ((video.labels, video.excluded_frames),
+                                   (reloaded.labels,
+                                    reloaded.excluded_frames)):
+      frame = store.to_dataframe()
+      if dict(zip(frame["label_id"], frame["frame_index"])) \
+        != expected[video.identifier] \
+        or set(excluded_frames) != excluded[video.identifier]:
+        mismatches += 1
+  return {
+      "mutations_per_second": args.tasks * args.operations / elapsed,
+      "labels": sum(len(labels) for labels in expected.values()),
+      "registry_writes_from_thread": churn["writes"],
+      "snapshot_iterations": churn["reads"],
+      "persist_rounds": churn["snapshots"],
+      "mismatched_stores": mismatches
+  }
+
+async def bench(args):
+  return {**await bench_reads(args), **await bench_mutations(args)}
+
+def main():
+  parser = ArgumentParser(
+      description="Stress the video registry and label persistence")
+  parser.add_argument("--videos", type=int, default=16)
+  parser.add_argument("--frames", type=int, default=500)
+  parser.add_argument("--tasks", type=int, default=64)
+  parser.add_argument("--operations",
+                      type=int,
+                      default=500,
+                      help="operations per task")
+  parser.add_argument("--json",
+                      help="write the results as JSON to this file, " +
+                      "- for stdout")
+  args = parser.parse_args()
+  json_path = args.json and args.json != "-" and os.path.abspath(args.json)
+  # Video keeps its labels under the relative data folder
+  work_folder = tempfile.mkdtemp(prefix="bench_registry_")
+  os.chdir(work_folder)
+  try:
+    ensure_directories()
+    results = asyncio.run(bench(args))
+  finally:
+    shutil.rmtree(work_folder, ignore_errors=True)
+  if args.json == "-":
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    for key, value in results.items():
+      print(f"{key:<34}{value:>14,.0f}")
+    if json_path:
+      with open(json_path, "w") as f:
+        json.dump(results, f, indent=2)
+  if results["mismatched_stores"]:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,332 @@
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Tuple, Union
+import asyncio
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import cv2
+import numpy as np
+import pandas as pd
+from common import DATA_FOLDER
+from frame_cache import frame_cache
+from interpolation import BOX_COLUMNS, DEFAULT_MIN_SIMILARITY, interpolate, \
+  match_keyframes, refine
+from tracking import ACCEPTABLE_ALGORITHMS, box_iou
+import video_tool
+
+Box = Tuple[float, float, float, float]
+# label -> frame index -> (left, top, right, bottom) in pixels
+Track = Dict[str, Dict[int, Box]]
+
+def write_synthetic_video(path: str, frame_count: int, size: Tuple[int, int],
+                          box_size: Tuple[int, int]):
+  # a textured box drifting over a noisy background, so every tracker has
+  # something to hold on to and the ground truth is known exactly
+  width, height = size
+  rng = np.random.default_rng(0)
+  background = cv2.GaussianBlur(
+      rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+  texture = rng.integers(0, 256, (box_size[1], box_size[0], 3),
+                         dtype=np.uint8)
+  writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 30,
+                           (width, height))
+  track: Dict[int, Box] = {}
+  for i in range(frame_count):
+    phase = i / max(1, frame_count - 1)
+    left = int((width - box_size[0]) * (0.1 + 0.8 * phase))
+    top = int((height - box_size[1]) * (0.5 + 0.3 * np.sin(phase * 6)))
+    frame = background.copy()
+    frame[top:top + box_size[1], left:left + box_size[0]] = texture
+    writer.write(frame)
+    track[i + 1] = (left, top, left + box_size[0], top + box_size[1])
+  writer.release()
+  return {"object": track}
+
+async def prepare_synthetic_video(frame_count: int, size: Tuple[int, int]):
+  source = Path(tempfile.gettempdir(), f"bench_synthetic_{os.getpid()}.mp4")
+  ground_truth = write_synthetic_video(str(source), frame_count, size,
+                                       (size[0] // 10, size[1] // 8))
+  video = video_tool.Video("synthetic")
+  # frame_extract removes the upload once the frames are stored
+  await video.frame_extract(str(source))
+  if video.pyramid_task is not None:
+    # the thumbnail build would compete with the trackers for the cpu
+    video.pyramid_cancel.set()
+    await video.pyramid_task
+  video.label_frame(1, "object", ground_truth["object"][1])
+  return video, 1, ground_truth
+
+def load_stored_video(video_identifier: str, start: Union[int, None]):
+  with open(Path(DATA_FOLDER, "videos.json"), "r") as f:
+    entries = [d for d in json.load(f) if d["identifier"] == video_identifier]
+  if not entries:
+    raise LookupError(f"Video {video_identifier} is not in {DATA_FOLDER}")
+  video = video_tool.Video.from_dict(entries[0]).data
+  labels = video.labels.to_dataframe()
+  if labels.empty:
+    raise LookupError(f"Video {video_identifier} has no labels")
+  if start is None:
+    start = int(labels["frame_index"].min())
+  ground_truth: Track = {}
+  # the first box of a label on each frame is that label's ground truth
+  for record in labels.drop_duplicates(["label", "frame_index"]).itertuples():
+    ground_truth.setdefault(record.label, {})[record.frame_index] = \
+      (record.absolute_left, record.absolute_top, record.absolute_right,
+       record.absolute_bottom)
+  return video, start, ground_truth
+
+def current_rss():
+  try:
+    with open("/proc/self/statm", "r") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError):
+    # only a peak is available without procfs
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def track(video: video_tool.Video, start: int, algorithm: str,
+                frames: int, scale: float):
+  boxes: Track = {}
+  latencies: List[float] = []
+  baseline = current_rss()
+  peak = baseline
+  last = perf_counter()
+
+  async def on_frame(frame_index: int, records: List[dict]):
+    nonlocal last, peak
+    now = perf_counter()
+    latencies.append(now - last)
+    last = now
+    peak = max(peak, current_rss())
+    for record in records:
+      boxes.setdefault(record["label"], {})[frame_index] = \
+        (record["absolute_left"], record["absolute_top"],
+         record["absolute_right"], record["absolute_bottom"])
+    return True
+
+  # every run decodes its own frames, otherwise later runs get a warm cache
+  frame_cache.invalidate(video.identifier)
+  started = perf_counter()
+  result = await video.track_frames(start, algorithm, on_frame, frames,
+                                    scale=scale)
+  elapsed = perf_counter() - started
+  return {
+      "boxes": boxes,
+      "elapsed": elapsed,
+      "latencies": latencies,
+      "peak_memory_bytes": peak - baseline,
+      "stop_reason": result.data.name.lower() if result.is_success else
+                     result.message
+  }
+
+def keyframe_labels(ground_truth: Track, start: int, last: int, every: int):
+  # what an annotator would have labeled by hand: every few frames, and the
+  # last one so the end of the range is covered too
+  keyframes = set(range(start, last + 1, every)) | {last}
+  rows = [(frame_index, label, *box)
+          for label, frames in ground_truth.items()
+          for frame_index, box in frames.items() if frame_index in keyframes]
+  return pd.DataFrame(rows, columns=["frame_index", "label"] + BOX_COLUMNS)
+
+async def interpolate_keyframes(video: video_tool.Video, ground_truth: Track,
+                                start: int, last: int, every: int,
+                                method: str, refine_algorithm: Union[str,
+                                                                     None]):
+  labels = keyframe_labels(ground_truth, start, last, every)
+  frame_cache.invalidate(video.identifier)
+  baseline = current_rss()
+  started = perf_counter()
+  segments = match_keyframes(labels, start, last, None)
+  frames, segment_of, boxes = interpolate(segments, method,
+                                          tuple(video.resolution))
+  if refine_algorithm is not None:
+    await asyncio.to_thread(refine, video.frame_store, segments, frames,
+                            segment_of, boxes, refine_algorithm,
+                            DEFAULT_MIN_SIMILARITY, threading.Event())
+  elapsed = perf_counter() - started
+  result: Track = {}
+  for record in labels.itertuples(index=False):
+    result.setdefault(record.label, {})[record.frame_index] = tuple(
+        getattr(record, column) for column in BOX_COLUMNS)
+  names = segments.labels[segments.start][segment_of]
+  for frame_index, label, box in zip(frames.tolist(), names.tolist(),
+                                     boxes.tolist()):
+    result.setdefault(label, {})[frame_index] = tuple(box)
+  return {
+      "boxes": result,
+      "elapsed": elapsed,
+      # no per-frame steps to time, every frame costs the same share
+      "latencies": [elapsed / max(1, len(frames))] * len(frames),
+      "peak_memory_bytes": current_rss() - baseline,
+      "stop_reason": f"keyframe every {every}"
+  }
+
+def compare(boxes: Track, reference: Track, start: int, last: int):
+  # reference frames this run lost count as no overlap
+  ious = []
+  for label, frames in reference.items():
+    for frame_index, (left, top, right, bottom) in frames.items():
+      if not start < frame_index <= last:
+        continue
+      other = boxes.get(label, {}).get(frame_index)
+      ious.append(0.0 if other is None else box_iou(
+          (left, top, right - left, bottom - top),
+          (other[0], other[1], other[2] - other[0], other[3] - other[1])))
+  if not ious:
+    return None, None
+  return float(np.mean(ious)), float(np.mean(np.asarray(ious) >= 0.5))
+
+async def bench(args):
+  if args.video_id is None:
+    video, start, ground_truth = await prepare_synthetic_video(
+        args.frames + 1, tuple(args.size))
+  else:
+    video, start, ground_truth = load_stored_video(args.video_id, args.start)
+  last = min(video.total_frame_count, start + args.frames)
+  results = []
+  for algorithm in args.algorithms:
+    full_resolution = None
+    for scale in sorted(set(args.scales) | {1.0}, reverse=True):
+      run = await track(video, start, algorithm, args.frames, scale)
+      if full_resolution is None:
+        full_resolution = run["boxes"]
+      frame_count = len(run["latencies"])
+      latencies = np.asarray(run["latencies"] or [0.0]) * 1000
+      iou, success_rate = compare(run["boxes"], ground_truth, start, last)
+      results.append({
+          "algorithm": algorithm,
+          "scale": scale,
+          "video": video.name,
+          "resolution": list(video.resolution),
+          "frames": frame_count,
+          "stop_reason": run["stop_reason"],
+          "frames_per_second": frame_count / run["elapsed"]
+                               if run["elapsed"] > 0 else 0.0,
+          "latency_ms": {
+              "p50": float(np.percentile(latencies, 50)),
+              "p95": float(np.percentile(latencies, 95)),
+              "p99": float(np.percentile(latencies, 99)),
+              "max": float(latencies.max())
+          },
+          "peak_memory_mib": run["peak_memory_bytes"] / 1024 / 1024,
+          "iou": iou,
+          "success_rate": success_rate,
+          "iou_vs_full": compare(run["boxes"], full_resolution, start,
+                                 last)[0]
+      })
+  for method in args.interpolate:
+    for refine_algorithm in [None] + args.refine:
+      run = await interpolate_keyframes(video, ground_truth, start, last,
+                                        args.keyframe_every, method,
+                                        refine_algorithm)
+      frame_count = len(run["latencies"])
+      latencies = np.asarray(run["latencies"] or [0.0]) * 1000
+      iou, success_rate = compare(run["boxes"], ground_truth, start, last)
+      results.append({
+          "algorithm": method + (f"+{refine_algorithm}"
+                                 if refine_algorithm else ""),
+          "scale": 1.0,
+          "video": video.name,
+          "resolution": list(video.resolution),
+          "frames": frame_count,
+          "stop_reason": run["stop_reason"],
+          "frames_per_second": frame_count / run["elapsed"]
+                               if run["elapsed"] > 0 else 0.0,
+          "latency_ms": {
+              "p50": float(np.percentile(latencies, 50)),
+              "p95": float(np.percentile(latencies, 95)),
+              "p99": float(np.percentile(latencies, 99)),
+              "max": float(latencies.max())
+          },
+          "peak_memory_mib": run["peak_memory_bytes"] / 1024 / 1024,
+          "iou": iou,
+          "success_rate": success_rate,
+          "iou_vs_full": None
+      })
+  video_tool.shutdown_workers()
+  return results
+
+def format_number(value: Union[float, None], width: int, digits: int):
+  return f"{'-':>{width}}" if value is None else f"{value:>{width}.{digits}f}"
+
+def print_table(results: List[dict]):
+  print(f"{'algorithm':<12}{'scale':>7}{'frames':>8}{'frames/s':>10}" +
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mem MiB':>9}" +
+        f"{'IoU':>7}{'IoU>.5':>8}{'vs full':>9}  stop")
+  for result in results:
+    latency = result["latency_ms"]
+    print(f"{result['algorithm']:<12}{result['scale']:>7.2f}" +
+          f"{result['frames']:>8}{result['frames_per_second']:>10.1f}" +
+          f"{latency['p50']:>9.1f}{latency['p95']:>9.1f}" +
+          f"{latency['p99']:>9.1f}{result['peak_memory_mib']:>9.1f}" +
+          format_number(result["iou"], 7, 3) +
+          format_number(result["success_rate"], 8, 2) +
+          format_number(result["iou_vs_full"], 9, 3) +
+          f"  {result['stop_reason']}")
+
+def main():
+  parser = ArgumentParser(
+      description="Benchmark the tracking algorithms on a labeled video")
+  parser.add_argument("--video-id",
+                      help="labeled video under the data folder, " +
+                      "a synthetic one if left out")
+  parser.add_argument("--data-root",
+                      default=".",
+                      help="directory holding the data folder")
+  parser.add_argument("--start",
+                      type=int,
+                      help="frame to start from, the first labeled frame " +
+                      "by default")
+  parser.add_argument("--algorithms", nargs="+", default=ACCEPTABLE_ALGORITHMS)
+  parser.add_argument("--scales", nargs="+", type=float, default=[1.0])
+  parser.add_argument("--interpolate",
+                      nargs="*",
+                      default=["linear", "spline"],
+                      help="interpolation methods to compare, " +
+                      "from keyframes taken out of the ground truth")
+  parser.add_argument("--keyframe-every", type=int, default=30)
+  parser.add_argument("--refine",
+                      nargs="*",
+                      default=["CSRT"],
+                      help="trackers to also run each interpolation with, " +
+                      "where it disagrees with the frames")
+  parser.add_argument("--frames", type=int, default=150)
+  parser.add_argument("--size",
+                      nargs=2,
+                      type=int,
+                      default=[1920, 1080],
+                      metavar=("WIDTH", "HEIGHT"),
+                      help="size of the synthetic video")
+  parser.add_argument("--json",
+                      help="write the results as JSON to this file, " +
+                      "- for stdout")
+  args = parser.parse_args()
+  json_path = args.json and args.json != "-" and os.path.abspath(args.json)
+  work_folder = None
+  if args.video_id is None:
+    # Video keeps its frames under the relative data folder
+    work_folder = tempfile.mkdtemp(prefix="bench_tracking_")
+    os.chdir(work_folder)
+  else:
+    os.chdir(args.data_root)
+  try:
+    results = asyncio.run(bench(args))
+  finally:
+    if work_folder is not None:
+      shutil.rmtree(work_folder, ignore_errors=True)
+  if args.json == "-":
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    print_table(results)
+    if json_path:
+      with open(json_path, "w") as f:
+        json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -1,13 +1,63 @@
 from enum import IntEnum
 from pathlib import Path
-from asyncio import Lock
+import os
 import tempfile
-from typing import Generic, TypeVar, Dict
+from threading import Lock
+from typing import Generic, TypeVar, Dict, List, Optional
 from typing_extensions import override
 
 DATA_FOLDER = "data"
 TEMP_FOLDER = Path(tempfile.gettempdir(), "FTCMachineLearning").absolute()
 
+def env_int(name: str, default: int):
+  value = os.environ.get(name)
+  return int(value) if value else default
+
+def env_str(name: str, default: str):
+  return os.environ.get(name) or default
+
+# "thread" or "process"
+EXTRACT_POOL = env_str("FTCML_EXTRACT_POOL", "thread")
+EXTRACT_WORKERS = env_int("FTCML_EXTRACT_WORKERS", os.cpu_count() or 1)
+MAX_CONCURRENT_EXTRACTS = env_int("FTCML_MAX_CONCURRENT_EXTRACTS",
+                                  EXTRACT_WORKERS)
+# "png", "jpeg", "webp" or "lazy"
+FRAME_STORE = env_str("FTCML_FRAME_STORE", "lazy")
+FRAME_STORE_QUALITY = env_int("FTCML_FRAME_STORE_QUALITY", 90)
+FRAME_CACHE_BYTES = env_int("FTCML_FRAME_CACHE_MB", 512) * 1024 * 1024
+LABEL_FLUSH_SECONDS = env_int("FTCML_LABEL_FLUSH_SECONDS", 2)
+# 0 leaves labels to be loaded on first access only
+PRELOAD_LABELS = env_int("FTCML_PRELOAD_LABELS", 1)
+LABEL_LOAD_WORKERS = env_int("FTCML_LABEL_LOAD_WORKERS", 4)
+TRACKER_WORKERS = env_int("FTCML_TRACKER_WORKERS", os.cpu_count() or 1)
+# worker processes for scheduled tracking jobs, one job per process
+TRACKING_PROCESSES = env_int("FTCML_TRACKING_PROCESSES", os.cpu_count() or 1)
+# largest chunk accepted by the chunked upload, below quart's request limit
+UPLOAD_CHUNK_BYTES = env_int("FTCML_UPLOAD_CHUNK_MB", 8) * 1024 * 1024
+# unfinished chunked uploads idle for this long are thrown away
+UPLOAD_EXPIRE_SECONDS = env_int("FTCML_UPLOAD_EXPIRE_HOURS", 24) * 3600
+# processes encoding images for dataset exports
+EXPORT_WORKERS = env_int("FTCML_EXPORT_WORKERS", os.cpu_count() or 1)
+# how many tracked frames may wait for the websocket client by default
+TRACKING_WINDOW = env_int("FTCML_TRACKING_WINDOW", 8)
+# 1 lets any request be profiled with ?profile=1, see /api/metrics/profiles
+PROFILE_REQUESTS = env_int("FTCML_PROFILE_REQUESTS", 0)
+# 0 leaves thumbnails and previews to be built on first request
+BUILD_PYRAMID = env_int("FTCML_BUILD_PYRAMID", 1)
+# 1 scores near-duplicate frames right after extraction instead of on request
+ANALYZE_SIMILARITY = env_int("FTCML_ANALYZE_SIMILARITY", 0)
+# 0 leaves disk use unbounded; above the quota, the thumbnails, previews and
+# extracted frames of idle videos are removed, the original and labels stay
+DISK_QUOTA_BYTES = env_int("FTCML_DISK_QUOTA_MB", 0) * 1024 * 1024
+# videos used more recently than this keep everything they have on disk
+EVICT_IDLE_SECONDS = env_int("FTCML_EVICT_IDLE_MINUTES", 30) * 60
+QUOTA_CHECK_SECONDS = env_int("FTCML_QUOTA_CHECK_SECONDS", 60)
+# how fast deleted videos and evicted files are unlinked, 0 for no limit
+RECLAIM_FILES_PER_SECOND = env_int("FTCML_RECLAIM_FILES_PER_SECOND", 2000)
+PREFETCH_WORKERS = env_int("FTCML_PREFETCH_WORKERS", 2)
+# 0 disables read-ahead
+PREFETCH_MAX_DEPTH = env_int("FTCML_PREFETCH_MAX_DEPTH", 16)
+
 __necessary_directories = (Path(DATA_FOLDER), Path(DATA_FOLDER,
                                                    "videos"), TEMP_FOLDER)
 
@@ -32,6 +82,15 @@ class BackendError(IntEnum):
   FRAME_NOT_LABELED = 10
   TASK_WAS_CANCELLED = 11
   INVALID_ARGUMENT = 12
+  JOB_NOT_FOUND = 13
+  UPLOAD_NOT_FOUND = 14
+  UPLOAD_OFFSET_MISMATCH = 15
+  UPLOAD_INCOMPLETE = 16
+  CHECKSUM_MISMATCH = 17
+  EXPORT_NOT_FOUND = 18
+  EXPORT_RUNNING = 19
+  ANALYSIS_RUNNING = 20
+  LABEL_NOT_FOUND = 21
 
   @property
   def error_message(self):
@@ -61,6 +120,24 @@ class BackendError(IntEnum):
       return "Task was cancelled"
     elif self == BackendError.INVALID_ARGUMENT:
       return "Invalid argument"
+    elif self == BackendError.JOB_NOT_FOUND:
+      return "Job not found"
+    elif self == BackendError.UPLOAD_NOT_FOUND:
+      return "Upload not found"
+    elif self == BackendError.UPLOAD_OFFSET_MISMATCH:
+      return "Chunk doesn't continue where the upload left off"
+    elif self == BackendError.UPLOAD_INCOMPLETE:
+      return "Upload is missing data"
+    elif self == BackendError.CHECKSUM_MISMATCH:
+      return "Uploaded data doesn't match its checksum"
+    elif self == BackendError.EXPORT_NOT_FOUND:
+      return "Dataset export not found"
+    elif self == BackendError.EXPORT_RUNNING:
+      return "Dataset export is already being downloaded"
+    elif self == BackendError.ANALYSIS_RUNNING:
+      return "Near-duplicate analysis for this video is still running"
+    elif self == BackendError.LABEL_NOT_FOUND:
+      return "Label not found"
     else:
       return "Unknown error"
 
@@ -89,23 +166,42 @@ class ReturnResult:
 K = TypeVar('K')
 V = TypeVar('V')
 
-class DictProxy(Generic[K, V], Dict[K, V]):
-
-  def __init__(self, *args, **kwargs):
-    super().__init__(*args, **kwargs)
-    self.lock = Lock()
-
-  async def __getitem__(self, key: K):
-    async with self.lock:
-      return super().__getitem__(key)
-
-  async def __setitem__(self, key: K, value: V):
-    async with self.lock:
-      return super().__setitem__(key, value)
-
-  async def put(self, key: K, value: V):
-    return await self.__setitem__(key, value)
-  
-  async def values(self):
-    async with self.lock:
-      return super().values()
+class Registry(Generic[K, V]):
+  # copy-on-write: a published dict is never changed again, so lookups and
+  # iteration need no lock and always see one consistent snapshot, while
+  # writers (rare) copy it under a lock and swap the new one in
+
+  def __init__(self):
+    self._items: Dict[K, V] = {}
+    self._write_lock = Lock()
+
+  def __contains__(self, key: K):
+    return key in self._items
+
+  def __len__(self):
+    return len(self._items)
+
+  def get(self, key: K) -> Optional[V]:
+    return self._items.get(key)
+
+  def put(self, key: K, value: V):
+    with self._write_lock:
+      items = dict(self._items)
+      items[key] = value
+      self._items = items
+
+  def update(self, entries: Dict[K, V]):
+    with self._write_lock:
+      self._items = {**self._items, **entries}
+
+  def remove(self, key: K) -> Optional[V]:
+    with self._write_lock:
+      if key not in self._items:
+        return None
+      items = dict(self._items)
+      value = items.pop(key)
+      self._items = items
+      return value
+
+  def values(self) -> List[V]:
+    return list(self._items.values())
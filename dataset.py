@@ -0,0 +1,609 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import IntEnum
+from typing import Dict, Iterator, List, Tuple, Union
+from time import time
+from uuid import uuid4
+import asyncio
+import io
+import json
+import queue
+import struct
+import tarfile
+import threading
+import zlib
+import cv2
+import numpy as np
+from common import BackendError, ReturnResult, EXPORT_WORKERS
+from metrics import metrics
+import video_tool
+
+EXPORT_FORMATS = ["tfrecord", "yolo", "coco"]
+# consecutive frames handed to one encode task, so the lazy frame store steps
+# forward through them instead of seeking for every frame
+ENCODE_CHUNK_FRAMES = 16
+# encode tasks allowed in flight per worker, bounds the frames held in memory
+ENCODE_TASKS_PER_WORKER = 2
+# a tar member's size has to be known before it is written, so tfrecord
+# shards are collected in memory up to this size
+TFRECORD_SHARD_BYTES = 64 * 1024 * 1024
+STREAM_CHUNK_BYTES = 1024 * 1024
+STREAM_QUEUE_CHUNKS = 8
+
+# (label, left, top, right, bottom), normalized
+Box = Tuple[str, float, float, float, float]
+
+def _crc32c_table():
+  table = []
+  for i in range(256):
+    crc = i
+    for _ in range(8):
+      crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+    table.append(crc)
+  return table
+
+_CRC32C_TABLE = _crc32c_table()
+_CRC32C_ARRAY = np.array(_CRC32C_TABLE, dtype=np.uint32)
+# data is cut into lanes of this many bytes, all of them run through the
+# table at once, then their crcs are folded together pairwise
+CRC32C_LANE_BYTES = 64
+# below this the plain table loop is quicker than setting up the lanes
+CRC32C_MIN_LANES_BYTES = 4096
+# _CRC32C_SHIFTS[k] moves a crc past a lane times 2**k of zero bytes, as four tables of
+# what each byte of the crc contributes, since that is linear
+_CRC32C_SHIFTS: List[np.ndarray] = []
+
+def _crc32c_loop(data: bytes, crc: int = 0xFFFFFFFF):
+  table = _CRC32C_TABLE
+  for byte in data:
+    crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+  return crc
+
+def _apply_shift(tables: np.ndarray, crcs: np.ndarray):
+  return tables[0][crcs & 0xFF] ^ tables[1][(crcs >> 8) & 0xFF] \
+    ^ tables[2][(crcs >> 16) & 0xFF] ^ tables[3][crcs >> 24]
+
+def _shift_tables(images: np.ndarray):
+  # from where each of the 32 bits ends up to a table per crc byte
+  values = np.arange(256, dtype=np.uint32)
+  tables = np.zeros((4, 256), dtype=np.uint32)
+  for bit in range(32):
+    tables[bit // 8] ^= np.where((values >> (bit % 8)) & 1, images[bit],
+                                 np.uint32(0))
+  return tables
+
+def _crc32c_shift(level: int):
+  while len(_CRC32C_SHIFTS) <= level:
+    if not _CRC32C_SHIFTS:
+      images = np.left_shift(np.uint32(1), np.arange(32, dtype=np.uint32))
+      for _ in range(CRC32C_LANE_BYTES):
+        images = _CRC32C_ARRAY[images & 0xFF] ^ (images >> 8)
+    else:
+      # twice the distance is the previous shift applied twice
+      previous = _CRC32C_SHIFTS[-1]
+      images = _apply_shift(
+          previous,
+          _apply_shift(previous,
+                       np.left_shift(np.uint32(1),
+                                     np.arange(32, dtype=np.uint32))))
+    _CRC32C_SHIFTS.append(_shift_tables(images))
+  return _CRC32C_SHIFTS[level]
+
+def _crc32c_lanes(data: bytes):
+  # a crc starting from 0xFFFFFFFF is one starting from 0 with the first
+  # four bytes inverted, and zeros in front of a crc starting from 0 change
+  # nothing, so the data is padded at the front to a power of two of lanes
+  lanes = 1 << max(0, -(-len(data) // CRC32C_LANE_BYTES) - 1).bit_length()
+  padded = np.zeros(lanes * CRC32C_LANE_BYTES, dtype=np.uint8)
+  start = len(padded) - len(data)
+  padded[start:] = np.frombuffer(data, dtype=np.uint8)
+  padded[start:start + 4] ^= 0xFF
+  columns = padded.reshape(lanes, CRC32C_LANE_BYTES).T
+  crcs = np.zeros(lanes, dtype=np.uint32)
+  for column in columns:
+    crcs = _CRC32C_ARRAY[(crcs ^ column) & 0xFF] ^ (crcs >> 8)
+  level = 0
+  while len(crcs) > 1:
+    pairs = crcs.reshape(-1, 2)
+    crcs = _apply_shift(_crc32c_shift(level), pairs[:, 0]) ^ pairs[:, 1]
+    level += 1
+  return int(crcs[0])
+
+def _crc32c_fallback(data: bytes):
+  if len(data) < CRC32C_MIN_LANES_BYTES:
+    return _crc32c_loop(data) ^ 0xFFFFFFFF
+  return _crc32c_lanes(data) ^ 0xFFFFFFFF
+
+# a native crc32c is a lot faster still, when either package is installed
+try:
+  import google_crc32c
+  crc32c = google_crc32c.value
+except ImportError:
+  try:
+    from crc32c import crc32c
+  except ImportError:
+    crc32c = _crc32c_fallback
+
+def masked_crc32c(data: bytes):
+  crc = crc32c(data)
+  return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+def _varint(value: int):
+  out = bytearray()
+  while True:
+    bits = value & 0x7F
+    value >>= 7
+    if value:
+      out.append(bits | 0x80)
+    else:
+      out.append(bits)
+      return bytes(out)
+
+def _field(number: int, payload: bytes):
+  # every field written here is length delimited (wire type 2)
+  return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+def _bytes_feature(values: List[bytes]):
+  return _field(1, b"".join(_field(1, value) for value in values))
+
+def _float_feature(values: List[float]):
+  return _field(2, _field(1, struct.pack(f"<{len(values)}f", *values)))
+
+def _int64_feature(values: List[int]):
+  return _field(
+      3,
+      _field(1,
+             b"".join(_varint(value & 0xFFFFFFFFFFFFFFFF) for value in values)))
+
+def tf_example(features: Dict[str, bytes]):
+  # tf.train.Example { Features features = 1 }, Features being a
+  # map<string, Feature> whose entries are { key = 1, value = 2 }
+  return _field(
+      1, b"".join(
+          _field(1,
+                 _field(1, key.encode()) + _field(2, feature))
+          for key, feature in features.items()))
+
+def tfrecord(data: bytes):
+  length = struct.pack("<Q", len(data))
+  return length + struct.pack("<I", masked_crc32c(length)) + data + \
+    struct.pack("<I", masked_crc32c(data))
+
+def detection_example(file_name: str, image: bytes, width: int, height: int,
+                      boxes: List[Box], class_ids: Dict[str, int]):
+  # the feature keys the TensorFlow object detection API reads
+  return tf_example({
+      "image/height": _int64_feature([height]),
+      "image/width": _int64_feature([width]),
+      "image/filename": _bytes_feature([file_name.encode()]),
+      "image/source_id": _bytes_feature([file_name.encode()]),
+      "image/encoded": _bytes_feature([image]),
+      "image/format": _bytes_feature([b"jpeg"]),
+      "image/object/bbox/xmin": _float_feature([box[1] for box in boxes]),
+      "image/object/bbox/xmax": _float_feature([box[3] for box in boxes]),
+      "image/object/bbox/ymin": _float_feature([box[2] for box in boxes]),
+      "image/object/bbox/ymax": _float_feature([box[4] for box in boxes]),
+      "image/object/class/text": _bytes_feature(
+          [box[0].encode() for box in boxes]),
+      "image/object/class/label": _int64_feature(
+          [class_ids[box[0]] for box in boxes])
+  })
+
+def encode_chunk(frame_store, frames: List[Tuple[int, str, List[Box]]],
+                 resolution: Tuple[int, int], export_format: str,
+                 quality: int, class_ids: Dict[str, int]):
+  # runs in an export worker process
+  width, height = resolution
+  results: List[Union[bytes, None]] = []
+  for frame_index, file_name, boxes in frames:
+    if frame_store.kind == "jpeg":
+      # already a jpeg on disk, no need to decode and encode it again
+      encoded = frame_store.read_encoded(frame_index)
+      image = encoded[0] if encoded is not None else None
+    else:
+      frame = frame_store.read(frame_index)
+      image = None
+      if frame is not None:
+        success, buffer = cv2.imencode(".jpg", frame,
+                                       [cv2.IMWRITE_JPEG_QUALITY, quality])
+        image = buffer.tobytes() if success else None
+    if image is not None and export_format == "tfrecord":
+      image = tfrecord(
+          detection_example(file_name, image, width, height, boxes,
+                            class_ids))
+    results.append(image)
+  return results
+
+_export_executor: Union[ProcessPoolExecutor, None] = None
+
+def get_export_executor():
+  global _export_executor
+  if _export_executor is None:
+    _export_executor = ProcessPoolExecutor(EXPORT_WORKERS)
+  return _export_executor
+
+def shutdown_export_executor():
+  global _export_executor
+  if _export_executor is not None:
+    _export_executor.shutdown(wait=False, cancel_futures=True)
+    _export_executor = None
+
+class ExportCancelled(Exception):
+  pass
+
+class _ArchiveStream:
+  # the file object tarfile writes to, handing fixed size chunks over to the
+  # response as they fill up
+
+  def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+    self.chunks = chunks
+    self.cancelled = cancelled
+    self.buffer = bytearray()
+
+  def put(self, item):
+    while True:
+      if self.cancelled.is_set():
+        raise ExportCancelled()
+      try:
+        self.chunks.put(item, timeout=0.5)
+        return
+      except queue.Full:
+        pass
+
+  def write(self, data: bytes):
+    self.buffer += data
+    if len(self.buffer) >= STREAM_CHUNK_BYTES:
+      self.put(bytes(self.buffer))
+      self.buffer.clear()
+    return len(data)
+
+  def close(self):
+    if self.buffer:
+      self.put(bytes(self.buffer))
+      self.buffer.clear()
+
+class _Frame:
+
+  def __init__(self, video: "video_tool.Video", frame_index: int, split: str,
+               boxes: List[Box]):
+    self.video = video
+    self.frame_index = frame_index
+    self.split = split
+    self.boxes = boxes
+
+  @property
+  def file_name(self):
+    return f"{self.video.identifier}_{self.frame_index}.jpg"
+
+class DatasetExport:
+
+  class Status(IntEnum):
+    PENDING = 0
+    RUNNING = 1
+    COMPLETED = 2
+    FAILED = 3
+    CANCELLED = -1
+
+  def __init__(self, frames: List[_Frame], export_format: str, quality: int,
+               class_names: List[str]):
+    self.identifier = uuid4().hex
+    self.frames = frames
+    self.export_format = export_format
+    self.quality = quality
+    self.class_names = class_names
+    self.status = DatasetExport.Status.PENDING
+    self.frames_done = 0
+    self.frames_missing = 0
+    self.bytes_sent = 0
+
+  @property
+  def class_ids(self):
+    # tfrecord label maps and coco categories count from 1, yolo from 0
+    offset = 0 if self.export_format == "yolo" else 1
+    return {name: i + offset for i, name in enumerate(self.class_names)}
+
+  def chunks(self) -> Iterator[List[_Frame]]:
+    chunk: List[_Frame] = []
+    for frame in self.frames:
+      if chunk and (frame.video is not chunk[-1].video
+                    or len(chunk) == ENCODE_CHUNK_FRAMES):
+        yield chunk
+        chunk = []
+      chunk.append(frame)
+    if chunk:
+      yield chunk
+
+  def encoded_frames(self) -> Iterator[Tuple[_Frame, Union[bytes, None]]]:
+    executor = get_export_executor()
+    class_ids = self.class_ids
+    in_flight = deque()
+    try:
+      for chunk in self.chunks():
+        video = chunk[0].video
+        in_flight.append((chunk,
+                          executor.submit(encode_chunk, video.frame_store,
+                                          [(frame.frame_index, frame.file_name,
+                                            frame.boxes) for frame in chunk],
+                                          tuple(video.resolution),
+                                          self.export_format, self.quality,
+                                          class_ids)))
+        # results are taken in order, so the archive is deterministic
+        if len(in_flight) >= EXPORT_WORKERS * ENCODE_TASKS_PER_WORKER:
+          done_chunk, future = in_flight.popleft()
+          yield from zip(done_chunk, future.result())
+      while in_flight:
+        done_chunk, future = in_flight.popleft()
+        yield from zip(done_chunk, future.result())
+    finally:
+      for _, future in in_flight:
+        future.cancel()
+
+  def write_archive(self, chunks: queue.Queue, cancelled: threading.Event):
+    stream = _ArchiveStream(chunks, cancelled)
+    try:
+      with tarfile.open(fileobj=stream, mode="w|") as tar:
+        if self.export_format == "tfrecord":
+          self.write_tfrecord(tar)
+        elif self.export_format == "yolo":
+          self.write_yolo(tar)
+        else:
+          self.write_coco(tar)
+      stream.close()
+      self.status = DatasetExport.Status.COMPLETED
+    except ExportCancelled:
+      self.status = DatasetExport.Status.CANCELLED
+    except Exception as e:
+      print(f"Dataset export {self.identifier} failed: {e!r}")
+      self.status = DatasetExport.Status.FAILED
+    finally:
+      try:
+        stream.put(None)
+      except ExportCancelled:
+        pass
+
+  def frames_with_images(self):
+    for frame, image in self.encoded_frames():
+      if image is None:
+        self.frames_missing += 1
+        continue
+      yield frame, image
+      self.frames_done += 1
+
+  def write_tfrecord(self, tar: tarfile.TarFile):
+    label_map = "".join(f"item {{\n  id: {class_id}\n  name: '{name}'\n}}\n"
+                        for name, class_id in self.class_ids.items())
+    add_member(tar, "label_map.pbtxt", label_map.encode())
+    shards = {"train": bytearray(), "val": bytearray()}
+    shard_counts = {"train": 0, "val": 0}
+
+    def flush(split: str):
+      add_member(tar, f"{split}-{shard_counts[split]:05d}.tfrecord",
+                 bytes(shards[split]))
+      shard_counts[split] += 1
+      shards[split].clear()
+
+    for frame, record in self.frames_with_images():
+      shards[frame.split] += record
+      if len(shards[frame.split]) >= TFRECORD_SHARD_BYTES:
+        flush(frame.split)
+    for split, shard in shards.items():
+      if shard:
+        flush(split)
+
+  def write_yolo(self, tar: tarfile.TarFile):
+    names = "".join(f"  {class_id}: {json.dumps(name)}\n"
+                    for name, class_id in self.class_ids.items())
+    add_member(
+        tar, "data.yaml",
+        f"path: .\ntrain: images/train\nval: images/val\nnames:\n{names}".
+        encode())
+    class_ids = self.class_ids
+    for frame, image in self.frames_with_images():
+      stem = frame.file_name.rsplit(".", 1)[0]
+      add_member(tar, f"images/{frame.split}/{frame.file_name}", image)
+      lines = "".join(
+          f"{class_ids[label]} {(left + right) / 2:.6f} " +
+          f"{(top + bottom) / 2:.6f} {right - left:.6f} {bottom - top:.6f}\n"
+          for label, left, top, right, bottom in frame.boxes)
+      add_member(tar, f"labels/{frame.split}/{stem}.txt", lines.encode())
+
+  def write_coco(self, tar: tarfile.TarFile):
+    categories = [{
+        "id": class_id,
+        "name": name
+    } for name, class_id in self.class_ids.items()]
+    class_ids = self.class_ids
+    documents = {
+        split: {
+            "images": [],
+            "annotations": [],
+            "categories": categories
+        } for split in ("train", "val")
+    }
+    annotation_id = 0
+    for frame, image in self.frames_with_images():
+      add_member(tar, f"images/{frame.split}/{frame.file_name}", image)
+      document = documents[frame.split]
+      image_id = len(document["images"]) + 1
+      width, height = frame.video.resolution
+      document["images"].append({
+          "id": image_id,
+          "file_name": frame.file_name,
+          "width": width,
+          "height": height
+      })
+      for label, left, top, right, bottom in frame.boxes:
+        annotation_id += 1
+        box_width = (right - left) * width
+        box_height = (bottom - top) * height
+        document["annotations"].append({
+            "id": annotation_id,
+            "image_id": image_id,
+            "category_id": class_ids[label],
+            "bbox": [left * width, top * height, box_width, box_height],
+            "area": box_width * box_height,
+            "iscrowd": 0
+        })
+    for split, document in documents.items():
+      add_member(tar, f"annotations/instances_{split}.json",
+                 json.dumps(document).encode())
+
+  def to_dict(self):
+    return {
+        "export_id": self.identifier,
+        "format": self.export_format,
+        "export_status": self.status.name.lower(),
+        "classes": self.class_names,
+        "frames": len(self.frames),
+        "train_frames": sum(1 for frame in self.frames
+                            if frame.split == "train"),
+        "val_frames": sum(1 for frame in self.frames if frame.split == "val"),
+        "frames_done": self.frames_done,
+        "frames_missing": self.frames_missing,
+        "bytes_sent": self.bytes_sent
+    }
+
+def add_member(tar: tarfile.TarFile, name: str, data: bytes):
+  info = tarfile.TarInfo(name)
+  info.size = len(data)
+  info.mtime = int(time())
+  tar.addfile(info, io.BytesIO(data))
+
+def split_of(seed: int, video_identifier: str, frame_index: int,
+             val_fraction: float):
+  # hashing keeps a frame on the same side of the split across exports, even
+  # when more frames get labeled in between
+  key = f"{seed}:{video_identifier}:{frame_index}".encode()
+  return "val" if zlib.crc32(key) / 2**32 < val_fraction else "train"
+
+dataset_exports: Dict[str, DatasetExport] = {}
+metrics.gauge(
+    "ftcml_dataset_exports_running", "Dataset exports being streamed",
+    lambda: {(): sum(1 for export in list(dataset_exports.values())
+                     if export.status == DatasetExport.Status.RUNNING)})
+
+async def create_export(video_identifiers: List[str],
+                        export_format: str,
+                        val_fraction: float = 0.2,
+                        quality: int = 90,
+                        seed: int = 0):
+  if not isinstance(video_identifiers, list) or not video_identifiers \
+    or not all(isinstance(video_identifier, str)
+               for video_identifier in video_identifiers) \
+    or export_format not in EXPORT_FORMATS \
+    or not video_tool.is_number(val_fraction) or not 0 <= val_fraction < 1 \
+    or not video_tool.is_integer(quality) or not 1 <= quality <= 100 \
+    or not video_tool.is_integer(seed):
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  frames: List[_Frame] = []
+  class_names = set()
+  for video_identifier in dict.fromkeys(video_identifiers):
+    video = video_tool.videos.get(video_identifier)
+    if video is None:
+      return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+    if not video.frame_extract_finished():
+      return ReturnResult(BackendError.VIDEO_PROCESSING)
+    video.touch()
+    # the labels are copied here, so labeling can go on during the export
+    labels = video.labels.to_dataframe()
+    labels = labels[~labels["frame_index"].isin(video.excluded_frames)]
+    labels = labels.sort_values("frame_index", kind="stable")
+    class_names.update(labels["label"].unique())
+    for frame_index, group in labels.groupby("frame_index", sort=True):
+      boxes = [(label, min(max(left, 0.0), 1.0), min(max(top, 0.0), 1.0),
+                min(max(right, 0.0), 1.0), min(max(bottom, 0.0), 1.0))
+               for label, left, top, right, bottom in zip(
+                   group["label"], group["left"], group["top"],
+                   group["right"], group["bottom"])]
+      frame_index = int(frame_index)
+      frames.append(
+          _Frame(video, frame_index,
+                 split_of(seed, video_identifier, frame_index, val_fraction),
+                 boxes))
+  export = DatasetExport(frames, export_format, quality, sorted(class_names))
+  dataset_exports[export.identifier] = export
+  return ReturnResult.success(export.to_dict())
+
+def get_export(export_identifier: str):
+  if export_identifier not in dataset_exports:
+    return ReturnResult(BackendError.EXPORT_NOT_FOUND)
+  return ReturnResult.success(dataset_exports[export_identifier].to_dict())
+
+def get_all_exports():
+  return ReturnResult.success(
+      [export.to_dict() for export in dataset_exports.values()])
+
+class _ExportBody:
+  # a generator's cleanup only runs once it has started, so a body closed or
+  # dropped before its first chunk was asked for (a client gone early, a
+  # response never sent) gives the export back here instead
+
+  def __init__(self, export: DatasetExport,
+               previous_status: DatasetExport.Status, chunks):
+    self.export = export
+    self.previous_status = previous_status
+    self.chunks = chunks
+    self.started = False
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    self.started = True
+    return await self.chunks.__anext__()
+
+  def release(self):
+    if not self.started:
+      self.started = True
+      if self.export.status == DatasetExport.Status.RUNNING:
+        self.export.status = self.previous_status
+
+  async def aclose(self):
+    self.release()
+    await self.chunks.aclose()
+
+  def __del__(self):
+    self.release()
+
+def stream_export(export_identifier: str):
+  if export_identifier not in dataset_exports:
+    return ReturnResult(BackendError.EXPORT_NOT_FOUND)
+  export = dataset_exports[export_identifier]
+  if export.status == DatasetExport.Status.RUNNING:
+    return ReturnResult(BackendError.EXPORT_RUNNING)
+  # taken right away, a second download asking before this one's first chunk
+  # is read would otherwise start another archive
+  previous_status = export.status
+  export.status = DatasetExport.Status.RUNNING
+
+  async def stream():
+    chunks: queue.Queue = queue.Queue(STREAM_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    export.frames_done = 0
+    export.frames_missing = 0
+    export.bytes_sent = 0
+    thread = threading.Thread(target=export.write_archive,
+                              args=(chunks, cancelled),
+                              name=f"dataset_export_{export.identifier}",
+                              daemon=True)
+    thread.start()
+
+    def next_chunk():
+      # also gives up once the archive thread is gone, so a waiting reader
+      # doesn't outlive a cancelled export
+      while True:
+        try:
+          return chunks.get(timeout=0.5)
+        except queue.Empty:
+          if not thread.is_alive() and chunks.empty():
+            return None
+
+    try:
+      while (chunk := await asyncio.to_thread(next_chunk)) is not None:
+        export.bytes_sent += len(chunk)
+        yield chunk
+    finally:
+      # a client that goes away stops the archive at its next write
+      cancelled.set()
+
+  return ReturnResult.success(_ExportBody(export, previous_status, stream()))
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+from common import FRAME_CACHE_BYTES
+import threading
+import numpy as np
+
+BGR = "bgr"
+ENCODED = "encoded"
+
+CacheKey = Tuple[str, int, str]
+
+def _size_of(value) -> int:
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, tuple):
+    return sum(_size_of(item) for item in value)
+  if isinstance(value, (bytes, bytearray)):
+    return len(value)
+  return 64
+
+class FrameCache:
+
+  def __init__(self, max_bytes: int):
+    self.max_bytes = max_bytes
+    self.entries: "OrderedDict[CacheKey, Tuple[object, int]]" = OrderedDict()
+    self.keys_by_video: Dict[str, Set[CacheKey]] = {}
+    self.current_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # frames are read from worker threads as well as from the event loop
+    self.lock = threading.Lock()
+
+  def get(self, video_identifier: str, frame_index: int, representation: str):
+    key = (video_identifier, frame_index, representation)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, video_identifier: str, frame_index: int, representation: str,
+          value):
+    size = _size_of(value)
+    if size > self.max_bytes:
+      return
+    key = (video_identifier, frame_index, representation)
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      self.entries[key] = (value, size)
+      self.keys_by_video.setdefault(video_identifier, set()).add(key)
+      self.current_bytes += size
+      while self.current_bytes > self.max_bytes:
+        self._remove(next(iter(self.entries)))
+        self.evictions += 1
+
+  def _remove(self, key: CacheKey):
+    _, size = self.entries.pop(key)
+    self.current_bytes -= size
+    video_keys = self.keys_by_video[key[0]]
+    video_keys.discard(key)
+    if not video_keys:
+      del self.keys_by_video[key[0]]
+
+  def invalidate(self, video_identifier: str):
+    with self.lock:
+      for key in list(self.keys_by_video.get(video_identifier, ())):
+        self._remove(key)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.keys_by_video.clear()
+      self.current_bytes = 0
+
+  @property
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+          "hits": self.hits,
+          "misses": self.misses,
+          "evictions": self.evictions,
+          "hit_rate": self.hits / lookups if lookups else 0.0,
+          "entries": len(self.entries),
+          "bytes": self.current_bytes,
+          "max_bytes": self.max_bytes
+      }
+
+frame_cache = FrameCache(FRAME_CACHE_BYTES)
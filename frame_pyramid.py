@@ -0,0 +1,174 @@
+from pathlib import Path
+from typing import Tuple, Union
+import copy
+import json
+import os
+import threading
+import cv2
+import numpy as np
+
+THUMBNAILS_NAME = "thumbnails.npy"
+PREVIEWS_NAME = "previews.bin"
+PREVIEW_OFFSETS_NAME = "previews.idx.npy"
+PYRAMID_META_NAME = "pyramid.json"
+# everything a build leaves in the video folder
+PYRAMID_FILES = (THUMBNAILS_NAME, PREVIEWS_NAME, PREVIEW_OFFSETS_NAME,
+                 PYRAMID_META_NAME)
+THUMBNAIL_WIDTH = 96
+PREVIEW_WIDTH = 640
+PREVIEW_QUALITY = 80
+SPRITE_QUALITY = 85
+# the largest range one sprite may cover, 20 x 20 thumbnails
+MAX_SPRITE_FRAMES = 400
+# progress is written out this often, so an interrupted build resumes close
+# to where it stopped
+SAVE_EVERY_FRAMES = 250
+
+def level_size(resolution: Tuple[int, int], width: int):
+  source_width, source_height = resolution
+  width = min(width, source_width)
+  height = max(2, int(round(width * source_height / source_width / 2)) * 2)
+  return width, height
+
+class FramePyramid:
+  # thumbnails are kept raw in one memory-mapped array so a range of them is
+  # a single slice, previews are jpeg encoded and packed back to back in one
+  # file with an offset index next to it
+
+  def __init__(self, folder: Path, frame_count: int,
+               resolution: Tuple[int, int]):
+    self.folder = Path(folder)
+    self.frame_count = frame_count
+    self.thumbnail_size = level_size(resolution, THUMBNAIL_WIDTH)
+    self.preview_size = level_size(resolution, PREVIEW_WIDTH)
+    self.built = 0
+    self.thumbnails: Union[np.memmap, None] = None
+    self.offsets: Union[np.memmap, None] = None
+    self.lock = threading.Lock()
+
+  @property
+  def thumbnails_path(self):
+    return Path(self.folder, THUMBNAILS_NAME)
+
+  @property
+  def previews_path(self):
+    return Path(self.folder, PREVIEWS_NAME)
+
+  @property
+  def offsets_path(self):
+    return Path(self.folder, PREVIEW_OFFSETS_NAME)
+
+  @property
+  def meta_path(self):
+    return Path(self.folder, PYRAMID_META_NAME)
+
+  @property
+  def complete(self):
+    return self.built >= self.frame_count
+
+  def open(self):
+    width, height = self.thumbnail_size
+    shape = (self.frame_count, height, width, 3)
+    meta = None
+    if self.meta_path.exists():
+      with open(self.meta_path, "r") as f:
+        meta = json.load(f)
+    if meta is not None and meta["thumbnail_size"] == list(self.thumbnail_size) \
+      and meta["preview_size"] == list(self.preview_size) \
+      and self.thumbnails_path.exists() and self.offsets_path.exists():
+      self.thumbnails = np.load(self.thumbnails_path, mmap_mode="r+")
+      self.offsets = np.load(self.offsets_path, mmap_mode="r+")
+      self.built = min(meta["built"], self.frame_count)
+      # drops previews written after the last saved progress
+      with open(self.previews_path, "ab") as f:
+        f.truncate(int(self.offsets[self.built]))
+      return
+    self.thumbnails = np.lib.format.open_memmap(self.thumbnails_path,
+                                                mode="w+",
+                                                dtype=np.uint8,
+                                                shape=shape)
+    self.offsets = np.lib.format.open_memmap(self.offsets_path,
+                                             mode="w+",
+                                             dtype=np.int64,
+                                             shape=(self.frame_count + 1,))
+    open(self.previews_path, "wb").close()
+    self.built = 0
+    self.save()
+
+  def save(self):
+    self.thumbnails.flush()
+    self.offsets.flush()
+    tmp_path = Path(self.folder, PYRAMID_META_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+      json.dump({
+          "built": self.built,
+          "thumbnail_size": list(self.thumbnail_size),
+          "preview_size": list(self.preview_size)
+      }, f)
+    os.replace(tmp_path, self.meta_path)
+
+  def build(self, frame_store, cancel_event: threading.Event):
+    # a copy of the store gets its own reader, like the similarity pass
+    frame_store = copy.copy(frame_store)
+    try:
+      with open(self.previews_path, "ab") as previews:
+        for frame_index in range(self.built + 1, self.frame_count + 1):
+          if cancel_event.is_set():
+            break
+          frame = frame_store.read(frame_index)
+          if frame is None:
+            break
+          thumbnail = cv2.resize(frame,
+                                 self.thumbnail_size,
+                                 interpolation=cv2.INTER_AREA)
+          preview = cv2.resize(frame,
+                               self.preview_size,
+                               interpolation=cv2.INTER_AREA)
+          success, buffer = cv2.imencode(
+              ".jpg", preview, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+          if not success:
+            break
+          previews.write(buffer.tobytes())
+          self.thumbnails[frame_index - 1] = thumbnail
+          self.offsets[frame_index] = self.offsets[frame_index - 1] + \
+            len(buffer)
+          with self.lock:
+            self.built = frame_index
+          if frame_index % SAVE_EVERY_FRAMES == 0:
+            previews.flush()
+            self.save()
+    finally:
+      frame_store.close()
+      self.save()
+
+  def sprite(self, start: int, count: int, columns: int):
+    # frames that aren't built yet stay gray
+    width, height = self.thumbnail_size
+    rows = (count + columns - 1) // columns
+    with self.lock:
+      built = self.built
+    tiles = np.full((rows * columns, height, width, 3), 128, dtype=np.uint8)
+    available = max(0, min(start + count - 1, built) - start + 1)
+    if available:
+      tiles[:available] = self.thumbnails[start - 1:start - 1 + available]
+    sheet = tiles.reshape(rows, columns, height, width,
+                          3).swapaxes(1, 2).reshape(rows * height,
+                                                    columns * width, 3)
+    success, buffer = cv2.imencode(".jpg", sheet,
+                                   [cv2.IMWRITE_JPEG_QUALITY, SPRITE_QUALITY])
+    return buffer.tobytes() if success else None
+
+  def preview(self, frame_index: int):
+    with self.lock:
+      if frame_index > self.built:
+        return None
+    begin = int(self.offsets[frame_index - 1])
+    end = int(self.offsets[frame_index])
+    with open(self.previews_path, "rb") as f:
+      f.seek(begin)
+      return f.read(end - begin)
+
+  def close(self):
+    # memmaps go away with their last reference
+    self.thumbnails = None
+    self.offsets = None
@@ -0,0 +1,106 @@
+from pathlib import Path
+from typing import Iterable, List
+import copy
+import os
+import threading
+import cv2
+import numpy as np
+
+SIMILARITY_NAME = "similarity.npz"
+THUMBNAIL_SIZE = 16
+# mean absolute difference of the thumbnails, on a 0 to 1 scale, below which
+# a frame counts as a repeat of the last one kept
+DEFAULT_THRESHOLD = 0.005
+# progress is written out this often, so an interrupted pass resumes close to
+# where it stopped
+SAVE_EVERY_FRAMES = 500
+
+def thumbnail(frame: cv2.typing.MatLike):
+  gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+  return cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                    interpolation=cv2.INTER_AREA)
+
+class FrameSimilarity:
+
+  def __init__(self, folder: Path, frame_count: int):
+    self.path = Path(folder, SIMILARITY_NAME)
+    self.frame_count = frame_count
+    self.thumbnails = np.zeros((frame_count, THUMBNAIL_SIZE, THUMBNAIL_SIZE),
+                               dtype=np.uint8)
+    self.analyzed = 0
+    self.lock = threading.Lock()
+
+  @property
+  def complete(self):
+    return self.analyzed >= self.frame_count
+
+  def load(self):
+    if not self.path.exists():
+      return
+    with np.load(self.path, allow_pickle=False) as data:
+      analyzed = min(int(data["analyzed"]), self.frame_count)
+      self.thumbnails[:analyzed] = data["thumbnails"][:analyzed]
+    self.analyzed = analyzed
+
+  def save(self):
+    with self.lock:
+      analyzed = self.analyzed
+      thumbnails = self.thumbnails[:analyzed].copy()
+    tmp_path = Path(self.path.parent, SIMILARITY_NAME + ".tmp")
+    with open(tmp_path, "wb") as f:
+      np.savez(f, analyzed=np.int64(analyzed), thumbnails=thumbnails)
+    os.replace(tmp_path, self.path)
+
+  def analyze(self, frame_store, cancel_event: threading.Event):
+    # a copy of the store gets its own reader, so the lazy frame store steps
+    # forward without fighting the labeling UI over one capture, and a full
+    # pass doesn't flush the shared frame cache
+    frame_store = copy.copy(frame_store)
+    try:
+      for frame_index in range(self.analyzed + 1, self.frame_count + 1):
+        if cancel_event.is_set():
+          break
+        frame = frame_store.read(frame_index)
+        if frame is None:
+          break
+        with self.lock:
+          self.thumbnails[frame_index - 1] = thumbnail(frame)
+          self.analyzed = frame_index
+        if frame_index % SAVE_EVERY_FRAMES == 0:
+          self.save()
+    finally:
+      frame_store.close()
+      self.save()
+
+  def changes(self):
+    # mean absolute difference to the previous frame, 0 (identical) to 1
+    with self.lock:
+      thumbnails = self.thumbnails[:self.analyzed].astype(np.int16)
+    if len(thumbnails) < 2:
+      return np.zeros(len(thumbnails), dtype=np.float32)
+    differences = np.abs(np.diff(thumbnails, axis=0)).mean(axis=(1, 2)) / 255
+    return np.concatenate(([1.0], differences)).astype(np.float32)
+
+  def near_duplicates(self, threshold: float, keep: Iterable[int]) -> List[int]:
+    # compared against the last frame that was kept rather than the previous
+    # one, so a slow pan still keeps a frame every so often
+    keep = set(keep)
+    with self.lock:
+      thumbnails = self.thumbnails[:self.analyzed].reshape(
+          self.analyzed, -1).astype(np.float32)
+    if len(thumbnails) == 0:
+      return []
+    limit = threshold * 255
+    # frames that moved enough since the previous one are kept anyway,
+    # only the rest need the sequential comparison
+    moved = np.ones(len(thumbnails), dtype=bool)
+    moved[1:] = np.abs(np.diff(thumbnails, axis=0)).mean(axis=1) >= limit
+    duplicates = []
+    kept = thumbnails[0]
+    for i in range(1, len(thumbnails)):
+      if moved[i] or i + 1 in keep \
+        or np.abs(thumbnails[i] - kept).mean() >= limit:
+        kept = thumbnails[i]
+      else:
+        duplicates.append(i + 1)
+    return duplicates
@@ -0,0 +1,368 @@
+from pathlib import Path
+from typing import List, Tuple, Union
+from time import perf_counter
+import bisect
+import json
+import random
+import struct
+import shutil
+import threading
+import cv2
+from metrics import stage_items, time_stage
+
+MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".webp": "image/webp"}
+
+class FrameStore:
+  kind = ""
+  # whether frame_extract has to decode the whole video into the store
+  extracts_frames = True
+
+  def __init__(self, folder: Path):
+    self.folder = Path(folder)
+
+  def import_source(self, source_path: str):
+    pass
+
+  def write(self, frame_index: int, frame: cv2.typing.MatLike) -> int:
+    raise NotImplementedError
+
+  def read(self, frame_index: int) -> Union[cv2.typing.MatLike, None]:
+    raise NotImplementedError
+
+  def read_encoded(self, frame_index: int) -> Union[Tuple[bytes, str], None]:
+    raise NotImplementedError
+
+  def encode(self,
+             frame: cv2.typing.MatLike) -> Union[Tuple[bytes, str], None]:
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+  def to_dict(self) -> dict:
+    return {"kind": self.kind}
+
+class ImageFrameStore(FrameStore):
+  extension = ""
+
+  def __init__(self, folder: Path, params: Union[List[int], None] = None):
+    super().__init__(folder)
+    self.params = params if params else []
+
+  def frame_path(self, frame_index: int):
+    return Path(self.folder, f"frame_{frame_index}{self.extension}")
+
+  def write(self, frame_index: int, frame: cv2.typing.MatLike):
+    with time_stage("imwrite"):
+      ret, buffer = cv2.imencode(self.extension, frame, self.params)
+      if not ret:
+        raise ValueError(f"Failed to encode frame {frame_index}")
+      buffer.tofile(str(self.frame_path(frame_index)))
+    stage_items.inc(stage="imwrite")
+    return len(buffer)
+
+  def encode(self, frame: cv2.typing.MatLike):
+    ret, buffer = cv2.imencode(self.extension, frame, self.params)
+    return (buffer.tobytes(), self.extension) if ret else None
+
+  def read(self, frame_index: int):
+    frame_path = self.frame_path(frame_index)
+    if not frame_path.exists():
+      return None
+    with time_stage("imread"):
+      frame = cv2.imread(str(frame_path))
+    stage_items.inc(stage="imread")
+    return frame
+
+  def read_encoded(self, frame_index: int):
+    frame_path = self.frame_path(frame_index)
+    if not frame_path.exists():
+      return None
+    return frame_path.read_bytes(), self.extension
+
+class PngFrameStore(ImageFrameStore):
+  kind = "png"
+  extension = ".png"
+
+  def __init__(self, folder: Path, compression: Union[int, None] = None):
+    # None keeps OpenCV's default level, which is what frames extracted before
+    # the frame store existed were written with
+    super().__init__(
+        folder,
+        [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        if compression is not None else None)
+    self.compression = compression
+
+  def to_dict(self):
+    return {"kind": self.kind, "compression": self.compression}
+
+class JpegFrameStore(ImageFrameStore):
+  kind = "jpeg"
+  extension = ".jpg"
+
+  def __init__(self, folder: Path, quality: int = 90):
+    super().__init__(folder, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    self.quality = quality
+
+  def to_dict(self):
+    return {"kind": self.kind, "quality": self.quality}
+
+class WebpFrameStore(ImageFrameStore):
+  kind = "webp"
+  extension = ".webp"
+
+  def __init__(self, folder: Path, quality: int = 90):
+    super().__init__(folder, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    self.quality = quality
+
+  def to_dict(self):
+    return {"kind": self.kind, "quality": self.quality}
+
+class LazyFrameStore(FrameStore):
+  kind = "lazy"
+  extracts_frames = False
+  source_name = "source.mp4"
+  index_name = "keyframes.json"
+  encode_extension = ".png"
+  encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+  def __init__(self, folder: Path):
+    super().__init__(folder)
+    self.keyframes: Union[List[int], None] = None
+    self.index_loaded = False
+    self._reset_reader()
+
+  def _reset_reader(self):
+    self.capture = None
+    # index of the frame the next capture.read() returns, 0 when unknown
+    self.position = 0
+    self.capture_lock = threading.Lock()
+
+  @property
+  def source_path(self):
+    return Path(self.folder, self.source_name)
+
+  @property
+  def index_path(self):
+    return Path(self.folder, self.index_name)
+
+  def import_source(self, source_path: str,
+                    keyframes: Union[List[int], None] = None):
+    shutil.move(source_path, self.source_path)
+    self.build_index(keyframes)
+
+  def build_index(self, keyframes: Union[List[int], None] = None):
+    # keyframes already read while the file was still being uploaded
+    self.keyframes = keyframes if keyframes is not None \
+      else read_mp4_keyframes(self.source_path)
+    self.index_loaded = True
+    with open(self.index_path, "w") as f:
+      json.dump({"keyframes": self.keyframes}, f)
+
+  def load_index(self):
+    if self.index_path.exists():
+      with open(self.index_path, "r") as f:
+        self.keyframes = json.load(f)["keyframes"]
+      self.index_loaded = True
+    else:
+      self.build_index()
+
+  def nearest_keyframe(self, frame_index: int):
+    if not self.keyframes:
+      return frame_index
+    position = bisect.bisect_right(self.keyframes, frame_index)
+    return self.keyframes[position - 1] if position else 1
+
+  def read(self, frame_index: int):
+    with self.capture_lock, time_stage("decode"):
+      if not self.index_loaded:
+        self.load_index()
+      if self.capture is None:
+        self.capture = cv2.VideoCapture(str(self.source_path))
+        self.position = 1
+      # stepping forward is only cheaper than seeking while no keyframe lies
+      # between the current position and the wanted frame
+      keyframe = self.nearest_keyframe(frame_index)
+      if not keyframe <= self.position <= frame_index:
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe - 1)
+        self.position = keyframe
+      while self.position < frame_index:
+        if not self.capture.grab():
+          self.position = 0
+          return None
+        self.position += 1
+      ret, frame = self.capture.read()
+      if not ret:
+        self.position = 0
+        return None
+      self.position += 1
+      stage_items.inc(stage="decode")
+      return frame
+
+  def read_encoded(self, frame_index: int):
+    frame = self.read(frame_index)
+    if frame is None:
+      return None
+    return self.encode(frame)
+
+  def encode(self, frame: cv2.typing.MatLike):
+    ret, buffer = cv2.imencode(self.encode_extension, frame,
+                               self.encode_params)
+    return (buffer.tobytes(), self.encode_extension) if ret else None
+
+  def close(self):
+    with self.capture_lock:
+      if self.capture is not None:
+        self.capture.release()
+        self.capture = None
+      self.position = 0
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    for key in ("capture", "position", "capture_lock"):
+      del state[key]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._reset_reader()
+
+def _iter_mp4_boxes(f, start: int, end: int):
+  offset = start
+  while offset + 8 <= end:
+    f.seek(offset)
+    size, box_type = struct.unpack(">I4s", f.read(8))
+    header = 8
+    if size == 1:
+      size = struct.unpack(">Q", f.read(8))[0]
+      header = 16
+    elif size == 0:
+      size = end - offset
+    if size < header:
+      return
+    yield box_type, offset + header, offset + size
+    offset += size
+
+def _find_mp4_box(f, start: int, end: int, box_type: bytes):
+  for found_type, body_start, body_end in _iter_mp4_boxes(f, start, end):
+    if found_type == box_type:
+      return body_start, body_end
+  return None
+
+def mp4_moov_complete(path: Path, size: int):
+  # whether the moov box lies within the first size bytes of the file, which
+  # is early on for files written with it up front or fragmented ones
+  try:
+    with open(path, "rb") as f:
+      for box_type, _, body_end in _iter_mp4_boxes(f, 0, size):
+        if box_type == b"moov":
+          return body_end <= size
+  except (OSError, struct.error):
+    pass
+  return False
+
+def read_mp4_keyframes(path: Path,
+                       size: Union[int, None] = None) -> Union[List[int], None]:
+  # reads the sync sample table (stss) of the first video track, which lists
+  # the keyframes without decoding anything; None when it can't be found
+  try:
+    with open(path, "rb") as f:
+      if size is None:
+        f.seek(0, 2)
+        size = f.tell()
+      moov = _find_mp4_box(f, 0, size, b"moov")
+      if moov is None:
+        return None
+      for box_type, trak_start, trak_end in _iter_mp4_boxes(f, *moov):
+        if box_type != b"trak":
+          continue
+        mdia = _find_mp4_box(f, trak_start, trak_end, b"mdia")
+        if mdia is None:
+          continue
+        hdlr = _find_mp4_box(f, *mdia, b"hdlr")
+        if hdlr is None:
+          continue
+        f.seek(hdlr[0] + 8)
+        if f.read(4) != b"vide":
+          continue
+        minf = _find_mp4_box(f, *mdia, b"minf")
+        stbl = _find_mp4_box(f, *minf, b"stbl") if minf else None
+        if stbl is None:
+          return None
+        stss = _find_mp4_box(f, *stbl, b"stss")
+        if stss is None:
+          # every sample is a sync sample
+          return []
+        f.seek(stss[0] + 4)
+        entry_count = struct.unpack(">I", f.read(4))[0]
+        return list(
+            struct.unpack(f">{entry_count}I", f.read(4 * entry_count)))
+  except (OSError, struct.error):
+    return None
+  return None
+
+def create_frame_store(kind: str, folder: Path, quality: int = 90):
+  if kind == "png":
+    return PngFrameStore(folder, compression=1)
+  elif kind == "jpeg":
+    return JpegFrameStore(folder, quality)
+  elif kind == "webp":
+    return WebpFrameStore(folder, quality)
+  elif kind == "lazy":
+    return LazyFrameStore(folder)
+  else:
+    raise ValueError(f"Unknown frame store: {kind}")
+
+def frame_store_from_dict(d: Union[dict, None], folder: Path):
+  if not d:
+    return PngFrameStore(folder)
+  kind = d.get("kind")
+  if kind == "png":
+    return PngFrameStore(folder, d.get("compression"))
+  elif kind == "jpeg":
+    return JpegFrameStore(folder, d.get("quality", 90))
+  elif kind == "webp":
+    return WebpFrameStore(folder, d.get("quality", 90))
+  elif kind == "lazy":
+    return LazyFrameStore(folder)
+  else:
+    raise ValueError(f"Unknown frame store: {kind}")
+
+def measure_random_read(store: FrameStore, frame_count: int, samples: int = 10):
+  if frame_count <= 0:
+    return 0.0
+  indices = random.sample(range(1, frame_count + 1),
+                          min(samples, frame_count))
+  start = perf_counter()
+  for frame_index in indices:
+    store.read(frame_index)
+  return (perf_counter() - start) / len(indices)
+
+def probe_video(file_path: str):
+  video = cv2.VideoCapture(file_path)
+  try:
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    resolution = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    return frame_count, resolution
+  finally:
+    video.release()
+
+def extract_frames(file_path: str, store: FrameStore, frame_count: int,
+                   progress, cancel_event):
+  video = cv2.VideoCapture(file_path)
+  try:
+    extracted = 0
+    stored_bytes = 0
+    while extracted < frame_count and not cancel_event.is_set():
+      with time_stage("decode"):
+        ret, frame = video.read()
+      if not ret:
+        break
+      stored_bytes += store.write(extracted + 1, frame)
+      extracted += 1
+      stage_items.inc(stage="decode")
+      progress.value = extracted
+    return extracted, stored_bytes
+  finally:
+    video.release()
@@ -0,0 +1,251 @@
+from typing import List, Tuple, Union
+import copy
+import threading
+import cv2
+import numpy as np
+import pandas as pd
+from tracking import init_tracker, update_tracker
+
+INTERPOLATION_METHODS = ("linear", "spline")
+BOX_COLUMNS = [
+    "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"
+]
+# appearance is compared on small grayscale patches, normalized so lighting
+# changes alone don't count as a disagreement
+PATCH_SIZE = 16
+# of the box size on every side, a plain colored object only stands out
+# against what is around it
+PATCH_CONTEXT = 0.25
+DEFAULT_MIN_SIMILARITY = 0.5
+
+class Segments:
+  # one segment per box carried from a keyframe to the same object on the
+  # next keyframe; start and end index into the keyframe boxes
+
+  def __init__(self, frames: np.ndarray, labels: np.ndarray, boxes: np.ndarray,
+               start: np.ndarray, end: np.ndarray):
+    self.frames = frames
+    self.labels = labels
+    self.boxes = boxes
+    self.start = start
+    self.end = end
+
+  def __len__(self):
+    return len(self.start)
+
+def match_keyframes(labels: pd.DataFrame, first: int, last: int,
+                    max_gap: Union[int, None]):
+  # every labeled frame is a keyframe; a box is carried over to the next
+  # keyframe only if a box with the same label is there too, so an object the
+  # annotator left out of a keyframe isn't made up on the frames around it
+  labels = labels[(labels["frame_index"] >= first)
+                  & (labels["frame_index"] <= last)]
+  frames = labels["frame_index"].to_numpy(dtype=np.int64)
+  names = labels["label"].to_numpy(dtype=object)
+  boxes = labels[BOX_COLUMNS].to_numpy(dtype=np.float64)
+  keyframes = np.unique(frames)
+  position = np.searchsorted(keyframes, frames, side="right")
+  has_next = position < len(keyframes)
+  next_frames = np.where(has_next,
+                         keyframes[np.minimum(position,
+                                              len(keyframes) - 1)], 0)
+  gaps = next_frames - frames
+  usable = has_next & (gaps > 1)
+  if max_gap is not None:
+    usable &= gaps <= max_gap
+  rows = np.arange(len(frames))
+  pairs = pd.DataFrame({
+      "start": rows[usable],
+      "frame_index": next_frames[usable],
+      "label": names[usable]
+  }).merge(pd.DataFrame({
+      "end": rows,
+      "frame_index": frames,
+      "label": names
+  }),
+           on=["frame_index", "label"])
+  start = pairs["start"].to_numpy(dtype=np.int64)
+  end = pairs["end"].to_numpy(dtype=np.int64)
+  # one box of a label on both keyframes is the common case and needs no
+  # choosing; several are paired up nearest centers first
+  unique = (np.bincount(start, minlength=len(frames))[start] == 1) \
+    & (np.bincount(end, minlength=len(frames))[end] == 1)
+  if not unique.all():
+    ambiguous = np.flatnonzero(~unique)
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+    distances = np.linalg.norm(centers[start[ambiguous]] -
+                               centers[end[ambiguous]],
+                               axis=1)
+    used_starts = set()
+    used_ends = set()
+    for i in ambiguous[np.argsort(distances, kind="stable")].tolist():
+      if start[i] in used_starts or end[i] in used_ends:
+        continue
+      used_starts.add(start[i])
+      used_ends.add(end[i])
+      unique[i] = True
+    start = start[unique]
+    end = end[unique]
+  return Segments(frames, names, boxes, start, end)
+
+def tangents(segments: Segments):
+  # finite differences over the neighbouring keyframes of the same object,
+  # one-sided where the object starts or stops being matched
+  count = len(segments.frames)
+  previous = np.full(count, -1, dtype=np.int64)
+  following = np.full(count, -1, dtype=np.int64)
+  previous[segments.end] = segments.start
+  following[segments.start] = segments.end
+  rows = np.arange(count)
+  before = np.where(previous >= 0, previous, rows)
+  after = np.where(following >= 0, following, rows)
+  span = segments.frames[after] - segments.frames[before]
+  slopes = (segments.boxes[after] - segments.boxes[before]) / \
+    np.where(span > 0, span, 1)[:, None]
+  return np.where((span > 0)[:, None], slopes, 0.0)
+
+def interpolate(segments: Segments, method: str, resolution: Tuple[int, int]):
+  # every in-between frame of every segment at once: one row per generated
+  # box, with the segment it came from and its position t in the segment
+  start_frames = segments.frames[segments.start]
+  lengths = segments.frames[segments.end] - start_frames
+  counts = lengths - 1
+  segment_of = np.repeat(np.arange(len(segments)), counts)
+  offsets = np.arange(len(segment_of)) - \
+    np.repeat(np.cumsum(counts) - counts, counts) + 1
+  frames = start_frames[segment_of] + offsets
+  t = (offsets / lengths[segment_of])[:, None]
+  first = segments.boxes[segments.start][segment_of]
+  last = segments.boxes[segments.end][segment_of]
+  boxes = first + (last - first) * t
+  if method == "spline":
+    # cubic hermite through the keyframes, catmull-rom like tangents
+    slopes = tangents(segments)
+    h = lengths[segment_of][:, None]
+    t2 = t * t
+    t3 = t2 * t
+    curved = (2 * t3 - 3 * t2 + 1) * first + \
+      (t3 - 2 * t2 + t) * h * slopes[segments.start][segment_of] + \
+      (-2 * t3 + 3 * t2) * last + \
+      (t3 - t2) * h * slopes[segments.end][segment_of]
+    # an overshooting curve can turn a box inside out, those stay linear
+    inverted = (curved[:, 2] <= curved[:, 0]) | (curved[:, 3] <= curved[:, 1])
+    boxes = np.where(inverted[:, None], boxes, curved)
+  width, height = resolution
+  boxes = np.clip(boxes, 0, [width, height, width, height])
+  return frames, segment_of, boxes
+
+def group_by(values: np.ndarray):
+  order = np.argsort(values, kind="stable")
+  keys, firsts = np.unique(values[order], return_index=True)
+  return {
+      key: indices.tolist()
+      for key, indices in zip(keys.tolist(), np.split(order, firsts[1:]))
+  }
+
+def patch(gray: np.ndarray, box: np.ndarray):
+  height, width = gray.shape
+  margin_x = (box[2] - box[0]) * PATCH_CONTEXT
+  margin_y = (box[3] - box[1]) * PATCH_CONTEXT
+  left = max(0, int(box[0] - margin_x))
+  top = max(0, int(box[1] - margin_y))
+  right = min(width, int(np.ceil(box[2] + margin_x)))
+  bottom = min(height, int(np.ceil(box[3] + margin_y)))
+  if right - left < 2 or bottom - top < 2:
+    return None
+  pixels = cv2.resize(gray[top:bottom, left:right], (PATCH_SIZE, PATCH_SIZE),
+                      interpolation=cv2.INTER_AREA).astype(np.float32)
+  pixels -= pixels.mean()
+  norm = np.linalg.norm(pixels)
+  return pixels / norm if norm > 0 else pixels
+
+def similarity(a: Union[np.ndarray, None], b: Union[np.ndarray, None]):
+  if a is None or b is None:
+    return 0.0
+  return float(np.vdot(a, b))
+
+def refine(frame_store, segments: Segments, frames: np.ndarray,
+           segment_of: np.ndarray, boxes: np.ndarray, algorithm: str,
+           min_similarity: float, cancel_event: threading.Event):
+  # walks the frames once, in order; wherever an interpolated box doesn't
+  # look like the object on either keyframe around it, a tracker started
+  # from the last box that did runs until the two agree again, and its box
+  # is taken wherever it looks the more like the object of the two
+  frame_store = copy.copy(frame_store)
+  refined = 0
+  try:
+    start_frames = segments.frames[segments.start]
+    end_frames = segments.frames[segments.end]
+    templates_start: List[Union[np.ndarray, None]] = [None] * len(segments)
+    templates_end: List[Union[np.ndarray, None]] = [None] * len(segments)
+    starting = group_by(start_frames)
+    ending = group_by(end_frames)
+    keyframes = np.unique(np.concatenate([start_frames, end_frames]))
+    for frame_index in keyframes.tolist():
+      if cancel_event.is_set():
+        return refined
+      frame = frame_store.read(frame_index)
+      if frame is None:
+        return refined
+      gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+      for i in starting.get(frame_index, ()):
+        templates_start[i] = patch(gray, segments.boxes[segments.start[i]])
+      for i in ending.get(frame_index, ()):
+        templates_end[i] = patch(gray, segments.boxes[segments.end[i]])
+    rows_at = group_by(frames)
+    by_end = np.argsort(end_frames, kind="stable")
+    finished = 0
+    # the last box per segment that matched, with the frame it is on
+    last_good: dict = {}
+    trackers: dict = {}
+    # lost by the tracker too, left alone until interpolation matches again
+    given_up = set()
+    for frame_index in np.union1d(frames, start_frames).tolist():
+      if cancel_event.is_set():
+        break
+      frame = frame_store.read(frame_index)
+      if frame is None:
+        break
+      # segments that are past their last frame let go of theirs
+      while finished < len(by_end) and end_frames[by_end[finished]] <= \
+        frame_index:
+        last_good.pop(int(by_end[finished]), None)
+        trackers.pop(int(by_end[finished]), None)
+        finished += 1
+      for i in starting.get(frame_index, ()):
+        last_good[i] = (frame, segments.boxes[segments.start[i]])
+      if frame_index not in rows_at:
+        continue
+      gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+      for row in rows_at[frame_index]:
+        i = int(segment_of[row])
+        current = patch(gray, boxes[row])
+        agreement = max(similarity(current, templates_start[i]),
+                        similarity(current, templates_end[i]))
+        if agreement >= min_similarity:
+          last_good[i] = (frame, boxes[row])
+          trackers.pop(i, None)
+          given_up.discard(i)
+          continue
+        if i not in trackers and i in last_good and i not in given_up:
+          good_frame, good_box = last_good[i]
+          trackers[i] = init_tracker(algorithm, good_frame, good_box)
+        if i not in trackers:
+          continue
+        success, bbox, _ = update_tracker(trackers[i], frame)
+        if success:
+          left, top, width, height = bbox
+          tracked = np.array([left, top, left + width, top + height])
+          # the tracker only wins where it looks more like the object
+          tracked_patch = patch(gray, tracked)
+          if max(similarity(tracked_patch, templates_start[i]),
+                 similarity(tracked_patch, templates_end[i])) > agreement:
+            boxes[row] = tracked
+            refined += 1
+        else:
+          # lost as well, the interpolated box is the better guess
+          del trackers[i]
+          given_up.add(i)
+  finally:
+    frame_store.close()
+  return refined
@@ -0,0 +1,163 @@
+from pathlib import Path
+from typing import Iterable, List, Union
+from label_store import COLUMNS, DTYPES, LabelStore
+import json
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+JOURNAL_NAME = "labels.journal"
+SNAPSHOT_NAME = "labels.npz"
+# once the journal holds this many bytes the next flush writes a snapshot
+COMPACT_JOURNAL_BYTES = 16 * 1024 * 1024
+
+class LabelJournal:
+
+  def __init__(self, folder: Path):
+    self.folder = Path(folder)
+    self.pending: List[dict] = []
+    self.journal_bytes = 0
+    self.lock = threading.Lock()
+    self.file_lock = threading.Lock()
+
+  @property
+  def journal_path(self):
+    return Path(self.folder, JOURNAL_NAME)
+
+  @property
+  def snapshot_path(self):
+    return Path(self.folder, SNAPSHOT_NAME)
+
+  def _record(self, entry: dict):
+    # entries are encoded when flushed, on the flush thread rather than in
+    # the request that made them; nothing changes an entry once recorded
+    with self.lock:
+      self.pending.append(entry)
+
+  def record_insert(self, records: Union[Iterable[dict], pd.DataFrame]):
+    if isinstance(records, pd.DataFrame):
+      # column by column, bulk inserts never turn into one dict per row
+      rows = [
+          list(row)
+          for row in zip(*(records[column].tolist() for column in COLUMNS))
+      ]
+    else:
+      rows = [[record[column] for column in COLUMNS] for record in records]
+    self._record({"op": "insert", "labels": rows})
+
+  def record_delete(self, label_ids: Iterable[str]):
+    self._record({"op": "delete", "label_ids": list(label_ids)})
+
+  def record_exclude(self, frame_indices: Iterable[int]):
+    self._record({"op": "exclude", "frame_indices": list(frame_indices)})
+
+  @property
+  def has_pending(self):
+    with self.lock:
+      return bool(self.pending)
+
+  def flush(self):
+    with self.lock:
+      pending, self.pending = self.pending, []
+    if not pending:
+      return 0
+    data = "".join(
+        json.dumps(entry, separators=(",", ":")) + "\n" for entry in pending)
+    with self.file_lock:
+      with open(self.journal_path, "a") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+      self.journal_bytes += len(data)
+    return len(pending)
+
+  @property
+  def needs_compaction(self):
+    return self.journal_bytes >= COMPACT_JOURNAL_BYTES
+
+  def prepare_snapshot(self, store: LabelStore, excluded_frames: List[int]):
+    # runs on the thread that mutates the store, so the snapshot covers every
+    # operation recorded so far; the journal only has to keep what gets
+    # flushed after this point
+    with self.lock:
+      self.pending = []
+    with self.file_lock:
+      offset = self.journal_path.stat().st_size \
+        if self.journal_path.exists() else 0
+    frame = store.to_dataframe()
+    columns = {
+        column: frame[column].to_numpy(dtype=str)
+                if DTYPES[column] is object else frame[column].to_numpy()
+        for column in COLUMNS
+    }
+    columns["excluded_frames"] = np.asarray(excluded_frames, dtype=np.int64)
+    return columns, offset
+
+  def write_snapshot(self, columns: dict, offset: int):
+    tmp_path = Path(self.folder, SNAPSHOT_NAME + ".tmp")
+    with self.file_lock:
+      with open(tmp_path, "wb") as f:
+        np.savez(f, **columns)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self.snapshot_path)
+      tail = b""
+      if self.journal_path.exists():
+        with open(self.journal_path, "rb") as f:
+          f.seek(offset)
+          tail = f.read()
+      tmp_path = Path(self.folder, JOURNAL_NAME + ".tmp")
+      with open(tmp_path, "wb") as f:
+        f.write(tail)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self.journal_path)
+      self.journal_bytes = len(tail)
+
+  def load_snapshot(self):
+    with np.load(self.snapshot_path, allow_pickle=False) as data:
+      frame = pd.DataFrame({column: data[column] for column in COLUMNS},
+                           columns=COLUMNS)
+      excluded_frames = data["excluded_frames"].tolist()
+    return LabelStore.from_dataframe(frame), excluded_frames
+
+  def replay(self, store: LabelStore, excluded_frames: List[int]):
+    if not self.journal_path.exists():
+      return 0
+    excluded = set(excluded_frames)
+    inserts = []
+    replayed = 0
+
+    def apply_inserts():
+      if inserts:
+        store.extend(
+            pd.DataFrame(inserts, columns=COLUMNS).drop_duplicates(
+                subset=["label_id"], keep="last"))
+        inserts.clear()
+
+    with open(self.journal_path, "r") as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          # a crash can leave the last line half written
+          break
+        replayed += 1
+        # replaying is idempotent, a journal that wasn't truncated after its
+        # snapshot only repeats what the snapshot already holds
+        if entry["op"] == "insert":
+          inserts.extend(
+              row for row in entry["labels"] if row[0] not in store)
+        elif entry["op"] == "delete":
+          apply_inserts()
+          for label_id in entry["label_ids"]:
+            store.delete(label_id)
+        elif entry["op"] == "exclude":
+          for frame_index in entry["frame_indices"]:
+            if frame_index not in excluded:
+              excluded.add(frame_index)
+              excluded_frames.append(frame_index)
+      apply_inserts()
+    self.journal_bytes = self.journal_path.stat().st_size
+    return replayed
@@ -0,0 +1,203 @@
+from typing import Dict, Iterable, List, Union
+import numpy as np
+import pandas as pd
+
+COLUMNS = [
+    "label_id", "frame_index", "label", "left", "top", "right", "bottom",
+    "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"
+]
+DTYPES = {
+    "label_id": object,
+    "frame_index": np.int64,
+    "label": object,
+    "left": np.float64,
+    "top": np.float64,
+    "right": np.float64,
+    "bottom": np.float64,
+    "absolute_left": np.float64,
+    "absolute_top": np.float64,
+    "absolute_right": np.float64,
+    "absolute_bottom": np.float64
+}
+
+CHUNK_SIZE = 4096
+# tombstones are only compacted away once there are at least this many and
+# they make up half of the stored rows
+COMPACT_MIN_TOMBSTONES = 1024
+
+class LabelStore:
+
+  def __init__(self):
+    self.chunks: List[Dict[str, np.ndarray]] = []
+    self.alive: List[np.ndarray] = []
+    self.row_count = 0
+    self.tombstone_count = 0
+    self.rows_by_label_id: Dict[str, int] = {}
+    self.rows_by_frame: Dict[int, Dict[int, None]] = {}
+    self.version = 0
+    self._dataframe: Union[pd.DataFrame, None] = None
+    self._dataframe_version = -1
+
+  def __len__(self):
+    return self.row_count - self.tombstone_count
+
+  def __contains__(self, label_id: str):
+    return label_id in self.rows_by_label_id
+
+  def has_frame(self, frame_index: int):
+    return frame_index in self.rows_by_frame
+
+  @property
+  def labeled_frame_count(self):
+    # rows_by_frame drops a frame as soon as its last label goes away
+    return len(self.rows_by_frame)
+
+  def _new_chunk(self):
+    self.chunks.append({
+        column: np.empty(CHUNK_SIZE, dtype=dtype)
+        for column, dtype in DTYPES.items()
+    })
+    self.alive.append(np.zeros(CHUNK_SIZE, dtype=bool))
+
+  def _index_row(self, row: int, label_id: str, frame_index: int):
+    self.rows_by_label_id[label_id] = row
+    # dicts keep insertion order, so rows come back in the order they were
+    # labeled and removing one is O(1)
+    self.rows_by_frame.setdefault(frame_index, {})[row] = None
+
+  def append(self, record: dict):
+    if self.row_count == len(self.chunks) * CHUNK_SIZE:
+      self._new_chunk()
+    row = self.row_count
+    chunk, offset = divmod(row, CHUNK_SIZE)
+    columns = self.chunks[chunk]
+    for column in COLUMNS:
+      columns[column][offset] = record[column]
+    self.alive[chunk][offset] = True
+    self.row_count += 1
+    self._index_row(row, record["label_id"], int(record["frame_index"]))
+    self.version += 1
+    return row
+
+  def extend(self, records: Union[Iterable[dict], pd.DataFrame]):
+    frame = records if isinstance(records, pd.DataFrame) \
+      else pd.DataFrame(list(records), columns=COLUMNS)
+    count = len(frame)
+    if count == 0:
+      return
+    values = {
+        column: frame[column].to_numpy(dtype=DTYPES[column])
+        for column in COLUMNS
+    }
+    start = self.row_count
+    written = 0
+    while written < count:
+      row = start + written
+      chunk, offset = divmod(row, CHUNK_SIZE)
+      if chunk == len(self.chunks):
+        self._new_chunk()
+      size = min(CHUNK_SIZE - offset, count - written)
+      columns = self.chunks[chunk]
+      for column in COLUMNS:
+        columns[column][offset:offset + size] = \
+          values[column][written:written + size]
+      self.alive[chunk][offset:offset + size] = True
+      written += size
+    self.row_count += count
+    for i, (label_id, frame_index) in enumerate(
+        zip(values["label_id"], values["frame_index"].tolist())):
+      self._index_row(start + i, label_id, frame_index)
+    self.version += 1
+
+  def _tombstone(self, row: int):
+    chunk, offset = divmod(row, CHUNK_SIZE)
+    columns = self.chunks[chunk]
+    frame_index = int(columns["frame_index"][offset])
+    del self.rows_by_label_id[columns["label_id"][offset]]
+    frame_rows = self.rows_by_frame[frame_index]
+    del frame_rows[row]
+    if not frame_rows:
+      del self.rows_by_frame[frame_index]
+    self.alive[chunk][offset] = False
+    self.tombstone_count += 1
+
+  def delete(self, label_id: str):
+    row = self.rows_by_label_id.get(label_id)
+    if row is None:
+      return False
+    self._tombstone(row)
+    self.version += 1
+    self._maybe_compact()
+    return True
+
+  def delete_frame(self, frame_index: int):
+    rows = list(self.rows_by_frame.get(frame_index, ()))
+    for row in rows:
+      self._tombstone(row)
+    if rows:
+      self.version += 1
+      self._maybe_compact()
+    return len(rows)
+
+  def _maybe_compact(self):
+    if self.tombstone_count >= COMPACT_MIN_TOMBSTONES \
+      and self.tombstone_count * 2 >= self.row_count:
+      self.compact()
+
+  def compact(self):
+    live = self.to_dataframe()
+    self.chunks = []
+    self.alive = []
+    self.row_count = 0
+    self.tombstone_count = 0
+    self.rows_by_label_id = {}
+    self.rows_by_frame = {}
+    self.extend(live)
+
+  def records(self, rows: Iterable[int], columns: List[str] = COLUMNS):
+    result = []
+    for row in rows:
+      chunk, offset = divmod(row, CHUNK_SIZE)
+      chunk_columns = self.chunks[chunk]
+      result.append({
+          column: chunk_columns[column][offset].item()
+                  if DTYPES[column] is not object
+                  else chunk_columns[column][offset]
+          for column in columns
+      })
+    return result
+
+  def frame_records(self, frame_index: int, columns: List[str] = COLUMNS):
+    return self.records(self.rows_by_frame.get(frame_index, ()), columns)
+
+  def to_dataframe(self):
+    if self._dataframe_version == self.version \
+      and self._dataframe is not None:
+      return self._dataframe
+    if self.row_count == 0:
+      data = {
+          column: np.empty(0, dtype=dtype)
+          for column, dtype in DTYPES.items()
+      }
+    else:
+      last_chunk, last_offset = divmod(self.row_count, CHUNK_SIZE)
+      masks = [
+          alive if i < last_chunk else alive[:last_offset]
+          for i, alive in enumerate(self.alive[:last_chunk + 1])
+      ]
+      data = {
+          column:
+          np.concatenate([
+              chunk[column][:len(mask)][mask]
+              for chunk, mask in zip(self.chunks, masks)
+          ]) for column in COLUMNS
+      }
+    self._dataframe = pd.DataFrame(data, columns=COLUMNS)
+    self._dataframe_version = self.version
+    return self._dataframe
+
+  @classmethod
+  def from_dataframe(cls, frame: pd.DataFrame):
+    store = cls()
+    store.extend(frame)
+    return store
@@ -0,0 +1,284 @@
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter, time
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+import cProfile
+import io
+import math
+import pstats
+import threading
+
+# seconds; spans a cached frame read up to a whole video's extraction
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+# profiles of the last few profiled requests are kept for /api/metrics/profiles
+KEPT_PROFILES = 16
+PROFILE_LINES = 40
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+def label_key(labels: Dict[str, object]) -> LabelKey:
+  return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()):
+  pairs = list(key) + list(extra)
+  if not pairs:
+    return ""
+  escaped = (value.replace("\\", "\\\\").replace("\"", "\\\"").replace(
+      "\n", "\\n") for _, value in pairs)
+  return "{" + ",".join(
+      f"{name}=\"{value}\"" for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value: float):
+  if math.isinf(value):
+    return "+Inf" if value > 0 else "-Inf"
+  return repr(float(value))
+
+class Metric:
+  kind = ""
+
+  def __init__(self, name: str, help_text: str):
+    self.name = name
+    self.help_text = help_text
+    self.lock = threading.Lock()
+
+  def render(self) -> List[str]:
+    return [
+        f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"
+    ] + self.samples()
+
+  def samples(self) -> List[str]:
+    raise NotImplementedError
+
+  def to_dict(self) -> dict:
+    raise NotImplementedError
+
+class Counter(Metric):
+  kind = "counter"
+
+  def __init__(self, name: str, help_text: str):
+    super().__init__(name, help_text)
+    self.values: Dict[LabelKey, float] = {}
+
+  def inc(self, amount: float = 1, **labels):
+    key = label_key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def samples(self):
+    with self.lock:
+      values = list(self.values.items())
+    return [
+        f"{self.name}{format_labels(key)} {format_value(value)}"
+        for key, value in values
+    ]
+
+  def to_dict(self):
+    with self.lock:
+      return [{**dict(key), "value": value} for key, value in self.values.items()]
+
+class Gauge(Metric):
+  kind = "gauge"
+
+  def __init__(self,
+               name: str,
+               help_text: str,
+               collect: Union[Callable[[], Dict[LabelKey, float]], None] = None):
+    # a collect callback reads the current value when scraped, for things
+    # like queue depths that already live elsewhere
+    super().__init__(name, help_text)
+    self.values: Dict[LabelKey, float] = {}
+    self.collect = collect
+
+  def set(self, value: float, **labels):
+    with self.lock:
+      self.values[label_key(labels)] = value
+
+  def current(self):
+    if self.collect is not None:
+      return dict(self.collect())
+    with self.lock:
+      return dict(self.values)
+
+  def samples(self):
+    return [
+        f"{self.name}{format_labels(key)} {format_value(value)}"
+        for key, value in self.current().items()
+    ]
+
+  def to_dict(self):
+    return [{**dict(key), "value": value} for key, value in self.current().items()]
+
+class _HistogramSeries:
+
+  def __init__(self, bucket_count: int):
+    self.counts = [0] * (bucket_count + 1)
+    self.sum = 0.0
+    self.count = 0
+
+class Histogram(Metric):
+  kind = "histogram"
+
+  def __init__(self,
+               name: str,
+               help_text: str,
+               buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+    super().__init__(name, help_text)
+    self.buckets = buckets
+    self.series: Dict[LabelKey, _HistogramSeries] = {}
+
+  def observe(self, value: float, **labels):
+    key = label_key(labels)
+    # the last slot is the +Inf bucket
+    position = bisect_left(self.buckets, value)
+    with self.lock:
+      series = self.series.get(key)
+      if series is None:
+        series = self.series[key] = _HistogramSeries(len(self.buckets))
+      series.counts[position] += 1
+      series.sum += value
+      series.count += 1
+
+  @contextmanager
+  def time(self, **labels):
+    started = perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(perf_counter() - started, **labels)
+
+  def snapshot(self):
+    with self.lock:
+      return [(key, list(series.counts), series.sum, series.count)
+              for key, series in self.series.items()]
+
+  def quantile(self, counts: List[int], count: int, q: float):
+    # interpolated inside the bucket the quantile falls in, the same
+    # estimate Prometheus' histogram_quantile makes
+    if count == 0:
+      return 0.0
+    rank = q * count
+    cumulative = 0
+    for i, bucket_count in enumerate(counts):
+      if cumulative + bucket_count >= rank and bucket_count:
+        lower = self.buckets[i - 1] if i > 0 else 0.0
+        if i == len(self.buckets):
+          return lower
+        return lower + (self.buckets[i] - lower) * \
+          (rank - cumulative) / bucket_count
+      cumulative += bucket_count
+    return self.buckets[-1]
+
+  def samples(self):
+    lines = []
+    for key, counts, total, count in self.snapshot():
+      cumulative = 0
+      for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+        cumulative += bucket_count
+        lines.append(f"{self.name}_bucket" +
+                     format_labels(key, [("le", format_value(bound))]) +
+                     f" {cumulative}")
+      lines.append(f"{self.name}_sum{format_labels(key)} {format_value(total)}")
+      lines.append(f"{self.name}_count{format_labels(key)} {count}")
+    return lines
+
+  def to_dict(self):
+    return [{
+        **dict(key), "count": count,
+        "sum": total,
+        **{
+            f"p{round(q * 100)}": self.quantile(counts, count, q)
+            for q in QUANTILES
+        }
+    } for key, counts, total, count in self.snapshot()]
+
+class MetricsRegistry:
+
+  def __init__(self):
+    self.metrics: Dict[str, Metric] = {}
+    self.lock = threading.Lock()
+
+  def register(self, metric: Metric):
+    with self.lock:
+      if metric.name in self.metrics:
+        raise ValueError(f"Metric {metric.name} is already registered")
+      self.metrics[metric.name] = metric
+    return metric
+
+  def counter(self, name: str, help_text: str) -> Counter:
+    return self.register(Counter(name, help_text))  # type: ignore
+
+  def gauge(self, name: str, help_text: str, collect=None) -> Gauge:
+    return self.register(Gauge(name, help_text, collect))  # type: ignore
+
+  def histogram(self, name: str, help_text: str, **kwargs) -> Histogram:
+    return self.register(Histogram(name, help_text, **kwargs))  # type: ignore
+
+  def render(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+    lines = []
+    for metric in metrics:
+      try:
+        lines += metric.render()
+      except Exception as e:
+        # one broken collect callback shouldn't take the endpoint down
+        lines.append(f"# {metric.name} failed: {e}")
+    return "\n".join(lines) + "\n"
+
+  def to_dict(self):
+    with self.lock:
+      metrics = list(self.metrics.values())
+    return {metric.name: metric.to_dict() for metric in metrics}
+
+metrics = MetricsRegistry()
+
+request_seconds = metrics.histogram(
+    "ftcml_http_request_seconds", "Time spent handling HTTP requests")
+stage_seconds = metrics.histogram(
+    "ftcml_stage_seconds", "Time spent in frame and label pipeline stages")
+stage_items = metrics.counter(
+    "ftcml_stage_items_total",
+    "Frames or labels that went through a pipeline stage")
+
+def time_stage(stage: str):
+  return stage_seconds.time(stage=stage)
+
+def gauge_values(values: Dict[str, float], label: str):
+  return {((label, name),): value for name, value in values.items()}
+
+class RequestProfiler:
+  # cProfile hooks the whole thread, so while a request awaits, whatever the
+  # event loop runs in between lands in its profile too; only one request is
+  # profiled at a time for the same reason
+
+  def __init__(self):
+    self.active: Union[cProfile.Profile, None] = None
+    self.profiles: deque = deque(maxlen=KEPT_PROFILES)
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.active is not None:
+        return None
+      self.active = cProfile.Profile()
+    self.active.enable()
+    return self.active
+
+  def stop(self, profile: cProfile.Profile, route: str, seconds: float):
+    profile.disable()
+    with self.lock:
+      self.active = None
+    output = io.StringIO()
+    stats = pstats.Stats(profile, stream=output)
+    stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
+    self.profiles.append({
+        "route": route,
+        "finished_at": time(),
+        "seconds": seconds,
+        "stats": output.getvalue()
+    })
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple, Union
+from time import monotonic
+from common import PREFETCH_WORKERS, PREFETCH_MAX_DEPTH
+import math
+import threading
+
+# how far ahead, in seconds of the current access rate, frames are decoded
+PREFETCH_LOOKAHEAD_SECONDS = 0.5
+# consecutive +1 steps needed before an access pattern counts as sequential
+SEQUENTIAL_THRESHOLD = 2
+
+class _Stream:
+
+  def __init__(self):
+    self.last_index = 0
+    self.last_access = 0.0
+    self.interval = 0.0
+    self.run_length = 0
+    self.next_index = 0
+    self.target_index = 0
+    self.running = False
+    self.load: Union[Callable[[int], object], None] = None
+
+class Prefetcher:
+
+  def __init__(self, workers: int, max_depth: int, min_depth: int = 2):
+    self.workers = workers
+    self.max_depth = max_depth
+    self.min_depth = min(min_depth, max_depth)
+    self.executor: Union[ThreadPoolExecutor, None] = None
+    # one stream per video and per representation loaded ahead, a tracker
+    # reading decoded frames and a client reading encoded ones don't mix
+    self.streams: Dict[Tuple[str, str], _Stream] = {}
+    self.prefetched = 0
+    self.lock = threading.Lock()
+
+  def depth_for(self, stream: _Stream):
+    if stream.interval <= 0:
+      return self.min_depth
+    depth = math.ceil(PREFETCH_LOOKAHEAD_SECONDS / stream.interval)
+    return max(self.min_depth, min(self.max_depth, depth))
+
+  def access(self, key: str, frame_index: int, load: Callable[[int], object],
+             last_index: int, kind: str = "decoded"):
+    if self.max_depth <= 0:
+      return
+    now = monotonic()
+    key = (key, kind)
+    with self.lock:
+      stream = self.streams.setdefault(key, _Stream())
+      if frame_index == stream.last_index:
+        return
+      if frame_index == stream.last_index + 1:
+        elapsed = now - stream.last_access
+        stream.interval = elapsed if stream.run_length == 0 \
+          else 0.7 * stream.interval + 0.3 * elapsed
+        stream.run_length += 1
+      else:
+        stream.run_length = 0
+        stream.interval = 0.0
+        stream.next_index = 0
+        stream.target_index = 0
+      stream.last_index = frame_index
+      stream.last_access = now
+      if stream.run_length < SEQUENTIAL_THRESHOLD:
+        return
+      stream.load = load
+      stream.next_index = max(stream.next_index, frame_index + 1)
+      stream.target_index = min(last_index,
+                                frame_index + self.depth_for(stream))
+      if stream.running or stream.next_index > stream.target_index:
+        return
+      stream.running = True
+      if self.executor is None:
+        self.executor = ThreadPoolExecutor(self.workers,
+                                           thread_name_prefix="prefetch")
+    # one job per stream decodes in order, so the lazy frame store keeps
+    # stepping forward instead of seeking back and forth between workers
+    self.executor.submit(self._run, key, stream)
+
+  def _run(self, key: Tuple[str, str], stream: _Stream):
+    while True:
+      with self.lock:
+        if self.streams.get(key) is not stream \
+          or stream.next_index > stream.target_index or stream.load is None:
+          stream.running = False
+          return
+        frame_index = stream.next_index
+        stream.next_index += 1
+        load = stream.load
+      try:
+        load(frame_index)
+      except Exception:
+        with self.lock:
+          stream.running = False
+        return
+      with self.lock:
+        self.prefetched += 1
+
+  def forget(self, key: str):
+    with self.lock:
+      for stream_key in [
+          stream_key for stream_key in self.streams if stream_key[0] == key
+      ]:
+        del self.streams[stream_key]
+
+  def shutdown(self):
+    with self.lock:
+      self.streams.clear()
+      executor, self.executor = self.executor, None
+    if executor is not None:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+  @property
+  def stats(self):
+    with self.lock:
+      return {
+          "prefetched": self.prefetched,
+          "sequential_streams": sum(
+              1 for stream in self.streams.values()
+              if stream.run_length >= SEQUENTIAL_THRESHOLD)
+      }
+
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_MAX_DEPTH)
@@ -42,4 +42,116 @@ $(function () {
     uploadForm.appendTo("#popup");
     $(".popups").show();
   });
+
+  $("button#delete-videos-button").on("click", function () {
+    const videoIds = $("input.video-selector:checked")
+      .map(function () {
+        return $(this).attr("vid");
+      })
+      .get();
+    if (videoIds.length === 0) {
+      alert("Select the videos to delete first.");
+      return;
+    }
+    if (
+      !confirm(
+        "Delete " +
+          videoIds.length +
+          " video(s) with all their labels? This can't be undone."
+      )
+    ) {
+      return;
+    }
+    $.when
+      .apply(
+        $,
+        videoIds.map(function (videoId) {
+          return $.getJSON("/api/video/" + videoId + "/delete");
+        })
+      )
+      .always(function () {
+        window.location.reload();
+      });
+  });
+
+  $("button#produce-dataset-button").on("click", function () {
+    const videoIds = $("input.video-selector:checked")
+      .map(function () {
+        return $(this).attr("vid");
+      })
+      .get();
+    if (videoIds.length === 0) {
+      alert("Select the videos to produce a dataset from first.");
+      return;
+    }
+    const datasetForm = $("<form/>");
+    $("<h2/>")
+      .text("Produce dataset")
+      .addClass("red-hat-bold")
+      .css("margin-top", "0.5em")
+      .appendTo(datasetForm);
+    const p1 = $("<p/>");
+    $("<label/>")
+      .text("Format: ")
+      .append(
+        $("<select/>")
+          .attr("name", "format")
+          .append($("<option/>").attr("value", "tfrecord").text("TFRecord"))
+          .append($("<option/>").attr("value", "yolo").text("YOLO"))
+          .append($("<option/>").attr("value", "coco").text("COCO"))
+      )
+      .appendTo(p1);
+    p1.appendTo(datasetForm);
+    const p2 = $("<p/>");
+    $("<label/>")
+      .text("Validation fraction: ")
+      .append(
+        $("<input/>")
+          .attr("name", "val_fraction")
+          .attr("type", "number")
+          .attr("min", "0")
+          .attr("max", "0.9")
+          .attr("step", "0.05")
+          .val("0.2")
+      )
+      .appendTo(p2);
+    p2.appendTo(datasetForm);
+    const status = $("<p/>").appendTo(datasetForm);
+    $("<input/>")
+      .attr("type", "submit")
+      .attr("value", "Produce")
+      .appendTo(datasetForm);
+    datasetForm.on("submit", function (event) {
+      event.preventDefault();
+      $.ajax({
+        url: "/api/datasets",
+        method: "POST",
+        contentType: "application/json",
+        data: JSON.stringify({
+          video_ids: videoIds,
+          format: datasetForm.find("[name=format]").val(),
+          val_fraction: parseFloat(
+            datasetForm.find("[name=val_fraction]").val()
+          ),
+        }),
+        dataType: "json",
+      }).done(function (result) {
+        if (result.status !== 0) {
+          status.text(result.error);
+          return;
+        }
+        status.text(
+          result.frames +
+            " frames (" +
+            result.train_frames +
+            " train, " +
+            result.val_frames +
+            " val), downloading..."
+        );
+        window.location = "/api/datasets/" + result.export_id + "/download";
+      });
+    });
+    datasetForm.appendTo("#popup");
+    $(".popups").show();
+  });
 });
@@ -0,0 +1,184 @@
+from collections import deque
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Deque, Iterable, Tuple, Union
+from uuid import uuid4
+import os
+import threading
+from common import DATA_FOLDER, RECLAIM_FILES_PER_SECOND, ensure_directory
+
+TRASH_FOLDER = Path(DATA_FOLDER, "trash")
+# the worker only sleeps once it is this far ahead of its rate, so it
+# unlinks in small bursts instead of sleeping after every file
+PACE_SLEEP_SECONDS = 0.01
+
+def tree_size(path: Path):
+  total = 0
+  folders = [str(path)]
+  while folders:
+    try:
+      with os.scandir(folders.pop()) as entries:
+        for entry in entries:
+          if entry.is_dir(follow_symlinks=False):
+            folders.append(entry.path)
+          elif entry.is_file(follow_symlinks=False):
+            total += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+      continue
+  return total
+
+def file_sizes(paths: Iterable[Path]):
+  sizes = []
+  for path in paths:
+    try:
+      sizes.append((path, path.stat().st_size))
+    except FileNotFoundError:
+      continue
+  return sizes
+
+class StorageReclaimer:
+  # a video can be a few hundred thousand frame files, unlinking them all at
+  # once keeps the disk busy long enough to stall every request reading
+  # frames, so one thread removes them at a bounded rate instead
+
+  def __init__(self, files_per_second: int):
+    self.files_per_second = files_per_second
+    # a folder already moved to the trash and the bytes in it, if known
+    self.jobs: Deque[Tuple[Path, int]] = deque()
+    self.active = 0
+    self.condition = threading.Condition()
+    self.thread: Union[threading.Thread, None] = None
+    self.stopping = False
+    self.pending_bytes = 0
+    self.reclaimed_files = 0
+    self.reclaimed_bytes = 0
+    self.paced_files = 0
+    self.paced_since = 0.0
+
+  def _submit(self, jobs):
+    with self.condition:
+      self.jobs.extend(jobs)
+      self.pending_bytes += sum(size for _, size in jobs)
+      self.stopping = False
+      if self.thread is None or not self.thread.is_alive():
+        self.thread = threading.Thread(target=self._run,
+                                       name="storage_reclaim",
+                                       daemon=True)
+        self.thread.start()
+      self.condition.notify()
+
+  def discard(self, folder: Path):
+    # the folder is gone from where it was right away, only emptying it is
+    # left to the worker
+    ensure_directory(TRASH_FOLDER)
+    trash_path = Path(TRASH_FOLDER, f"{Path(folder).name}_{uuid4().hex}")
+    try:
+      os.replace(folder, trash_path)
+    except FileNotFoundError:
+      return False
+    self._submit([(trash_path, 0)])
+    return True
+
+  def remove(self, files: Iterable[Path]):
+    # moved to the trash first like a discarded folder, a file rebuilt under
+    # the same name before the worker gets to it is left alone
+    jobs = file_sizes(files)
+    if not jobs:
+      return 0
+    trash_path = Path(TRASH_FOLDER, f"evicted_{uuid4().hex}")
+    ensure_directory(trash_path)
+    total = 0
+    for path, size in jobs:
+      try:
+        os.replace(path, Path(trash_path, path.name))
+      except FileNotFoundError:
+        continue
+      total += size
+    self._submit([(trash_path, total)])
+    return total
+
+  def resume(self):
+    # whatever the last run didn't get to before it stopped
+    if TRASH_FOLDER.exists():
+      self._submit([(path, 0) for path in TRASH_FOLDER.iterdir()])
+
+  def _pace(self, size: int):
+    with self.condition:
+      self.reclaimed_files += 1
+      self.reclaimed_bytes += size
+    if self.files_per_second <= 0:
+      return
+    self.paced_files += 1
+    ahead = self.paced_files / self.files_per_second - \
+      (monotonic() - self.paced_since)
+    if ahead > PACE_SLEEP_SECONDS:
+      sleep(ahead)
+
+  def _unlink(self, path: str):
+    try:
+      size = os.lstat(path).st_size
+      os.unlink(path)
+    except FileNotFoundError:
+      return
+    except OSError as e:
+      print(f"Failed to remove {path}: {e}")
+      return
+    self._pace(size)
+
+  def _remove_folder(self, folder: Path):
+    for root, folders, files in os.walk(folder, topdown=False):
+      if self.stopping:
+        return
+      for name in files:
+        self._unlink(os.path.join(root, name))
+      for name in folders:
+        try:
+          os.rmdir(os.path.join(root, name))
+        except OSError:
+          pass
+    try:
+      os.rmdir(folder)
+    except OSError:
+      pass
+
+  def _run(self):
+    self.paced_files = 0
+    self.paced_since = monotonic()
+    while True:
+      with self.condition:
+        while not self.jobs and not self.stopping:
+          self.condition.wait()
+          # the rate starts over after a pause, time spent idle isn't credit
+          self.paced_files = 0
+          self.paced_since = monotonic()
+        if self.stopping:
+          return
+        path, size = self.jobs.popleft()
+        self.active = 1
+      if path.is_dir() and not path.is_symlink():
+        self._remove_folder(path)
+      else:
+        self._unlink(str(path))
+      with self.condition:
+        self.pending_bytes = max(0, self.pending_bytes - size)
+        self.active = 0
+
+  def shutdown(self):
+    # a folder left half emptied stays in the trash for the next run
+    with self.condition:
+      self.stopping = True
+      self.jobs.clear()
+      self.pending_bytes = 0
+      self.condition.notify()
+
+  @property
+  def stats(self):
+    with self.condition:
+      return {
+          "pending_jobs": len(self.jobs) + self.active,
+          "pending_bytes": self.pending_bytes,
+          "reclaimed_files": self.reclaimed_files,
+          "reclaimed_bytes": self.reclaimed_bytes
+      }
+
+reclaimer = StorageReclaimer(RECLAIM_FILES_PER_SECOND)
@@ -0,0 +1,277 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from enum import IntEnum
+from typing import Dict, List, Sequence, Tuple, Union
+from time import perf_counter
+from common import TRACKER_WORKERS, TRACKING_PROCESSES
+from metrics import stage_items, stage_seconds
+import asyncio
+import heapq
+import itertools
+import multiprocessing
+import cv2
+
+ACCEPTABLE_ALGORITHMS = [
+    "KCF", "MedianFlow", "MOSSE", "CSRT", "MIL", "TLD", "Boosting"
+]
+# fills the frames between labeled keyframes instead of tracking, only as a
+# tracking job since it needs the keyframes after the start as well
+INTERPOLATE_ALGORITHM = "interpolate"
+
+class TrackingStopReason(IntEnum):
+  END_OF_VIDEO = 0
+  MAX_FRAMES = 1
+  TRACKER_LOST = 2
+  ALL_LOST = 3
+  STOPPED = 4
+
+# how often a tracking worker process hands its tracked boxes back
+TRACKING_BATCH_SECONDS = 0.25
+
+_tracker_executor: Union[ThreadPoolExecutor, None] = None
+_tracking_process_executor: Union[ProcessPoolExecutor, None] = None
+_tracking_manager = None
+
+def get_tracker_executor():
+  global _tracker_executor
+  if _tracker_executor is None:
+    # OpenCV releases the GIL inside init and update, so threads are enough
+    # to run the trackers of one frame side by side
+    _tracker_executor = ThreadPoolExecutor(TRACKER_WORKERS,
+                                           thread_name_prefix="tracker")
+  return _tracker_executor
+
+def get_tracking_process_executor():
+  global _tracking_process_executor
+  if _tracking_process_executor is None:
+    _tracking_process_executor = ProcessPoolExecutor(TRACKING_PROCESSES)
+  return _tracking_process_executor
+
+def new_tracking_channel():
+  # the results queue and cancel flag have to be reachable from the worker
+  # process, so they live in a manager
+  global _tracking_manager
+  if _tracking_manager is None:
+    _tracking_manager = multiprocessing.Manager()
+  return _tracking_manager.Queue(), _tracking_manager.Event()
+
+def shutdown_tracker_executor():
+  global _tracker_executor, _tracking_process_executor, _tracking_manager
+  if _tracker_executor is not None:
+    _tracker_executor.shutdown(wait=False, cancel_futures=True)
+    _tracker_executor = None
+  if _tracking_process_executor is not None:
+    _tracking_process_executor.shutdown(wait=False, cancel_futures=True)
+    _tracking_process_executor = None
+  if _tracking_manager is not None:
+    _tracking_manager.shutdown()
+    _tracking_manager = None
+
+def create_tracker(algorithm: str):
+  if algorithm == "KCF":
+    return cv2.TrackerKCF.create()
+  elif algorithm == "MedianFlow":
+    return cv2.legacy.TrackerMedianFlow.create()
+  elif algorithm == "MOSSE":
+    return cv2.legacy.TrackerMOSSE.create()
+  elif algorithm == "CSRT":
+    return cv2.TrackerCSRT.create()
+  elif algorithm == "MIL":
+    return cv2.TrackerMIL.create()
+  elif algorithm == "TLD":
+    return cv2.legacy.TrackerTLD.create()
+  elif algorithm == "Boosting":
+    return cv2.legacy.TrackerBoosting.create()
+  else:
+    raise ValueError(f"Unknown tracker algorithm: {algorithm}")
+
+def downscale_frame(frame: cv2.typing.MatLike, scale: float):
+  # boxes stay in full resolution coordinates, only the pixels the trackers
+  # look at shrink; init_tracker and update_tracker convert between the two
+  if scale >= 1:
+    return frame
+  return cv2.resize(frame,
+                    None,
+                    fx=scale,
+                    fy=scale,
+                    interpolation=cv2.INTER_AREA)
+
+def read_tracking_frame(frame_store, frame_index: int, scale: float):
+  frame = frame_store.read(frame_index)
+  return downscale_frame(frame, scale) if frame is not None else None
+
+def init_tracker(algorithm: str,
+                 frame: cv2.typing.MatLike,
+                 box: Sequence[float],
+                 scale: float = 1.0):
+  tracker = create_tracker(algorithm)
+  left, top, right, bottom = (int(round(value * scale)) for value in box)
+  tracker.init(frame,
+               (left, top, max(1, right - left), max(1, bottom - top)))
+  return tracker
+
+def update_tracker(tracker, frame: cv2.typing.MatLike, scale: float = 1.0):
+  started = perf_counter()
+  try:
+    success, bbox = tracker.update(frame)
+  except cv2.error:
+    success, bbox = False, None
+  if success and scale != 1:
+    bbox = tuple(value / scale for value in bbox)
+  seconds = perf_counter() - started
+  stage_seconds.observe(seconds, stage="tracker_update")
+  stage_items.inc(stage="tracker_update")
+  return bool(success), bbox, seconds
+
+def box_iou(a: Sequence[float], b: Sequence[float]):
+  # boxes are (left, top, width, height) as returned by tracker.update
+  right = min(a[0] + a[2], b[0] + b[2])
+  bottom = min(a[1] + a[3], b[1] + b[3])
+  intersection = max(0.0, right - max(a[0], b[0])) * \
+    max(0.0, bottom - max(a[1], b[1]))
+  union = a[2] * a[3] + b[2] * b[3] - intersection
+  return intersection / union if union > 0 else 0.0
+
+class TrackerStats:
+
+  def __init__(self, label: str):
+    self.label = label
+    self.updates = 0
+    self.total_seconds = 0.0
+    self.max_seconds = 0.0
+    self.failed_at: Union[int, None] = None
+
+  def record(self, frame_index: int, success: bool, seconds: float):
+    self.updates += 1
+    self.total_seconds += seconds
+    self.max_seconds = max(self.max_seconds, seconds)
+    if not success and self.failed_at is None:
+      self.failed_at = frame_index
+
+  def to_dict(self):
+    return {
+        "label": self.label,
+        "updates": self.updates,
+        "mean_ms": self.total_seconds / self.updates * 1000
+                   if self.updates else 0.0,
+        "max_ms": self.max_seconds * 1000,
+        "failed_at": self.failed_at
+    }
+
+def track_video(frame_store, starting_frame_index: int, last_frame_index: int,
+                algorithm: str, labels: List[str],
+                boxes: List[Sequence[float]], stop_on_failure: bool,
+                min_iou: Union[float, None], scale: float, results,
+                cancel_event):
+  # runs in a tracking worker process; tracked boxes go back through results
+  # as batches of (frame_index, [(label, bbox), ...]) so the server can merge
+  # them while the job is still running
+  frame = read_tracking_frame(frame_store, starting_frame_index, scale)
+  if frame is None:
+    raise LookupError(f"Frame {starting_frame_index} could not be read")
+  trackers = [init_tracker(algorithm, frame, box, scale) for box in boxes]
+  previous = [(left, top, right - left, bottom - top)
+              for left, top, right, bottom in boxes]
+  batch: List[Tuple[int, List[Tuple[str, Tuple[float, ...]]]]] = []
+  flushed = perf_counter()
+  reason = TrackingStopReason.END_OF_VIDEO
+  with ThreadPoolExecutor(1) as decoder:
+    frame_index = starting_frame_index + 1
+    next_frame = decoder.submit(read_tracking_frame, frame_store,
+                                frame_index, scale) \
+      if frame_index <= last_frame_index else None
+    try:
+      while next_frame is not None:
+        frame = next_frame.result()
+        if frame is None:
+          raise LookupError(f"Frame {frame_index} could not be read")
+        # decode the next frame while the trackers work on this one
+        next_frame = decoder.submit(read_tracking_frame, frame_store,
+                                    frame_index + 1, scale) \
+          if frame_index < last_frame_index else None
+        if cancel_event.is_set():
+          reason = TrackingStopReason.STOPPED
+          break
+        tracked = []
+        lost = False
+        for i, tracker in enumerate(trackers):
+          if tracker is None:
+            continue
+          success, bbox, _ = update_tracker(tracker, frame, scale)
+          if success and min_iou is not None \
+            and box_iou(previous[i], bbox) < min_iou:
+            success = False
+          if success:
+            previous[i] = bbox
+            tracked.append((labels[i], tuple(bbox)))
+          else:
+            trackers[i] = None
+            lost = True
+        if not tracked:
+          reason = TrackingStopReason.ALL_LOST
+          break
+        batch.append((frame_index, tracked))
+        if perf_counter() - flushed >= TRACKING_BATCH_SECONDS:
+          results.put(batch)
+          batch = []
+          flushed = perf_counter()
+        if lost and stop_on_failure:
+          reason = TrackingStopReason.TRACKER_LOST
+          break
+        frame_index += 1
+    finally:
+      if batch:
+        results.put(batch)
+  return reason
+
+class TrackingScheduler:
+
+  def __init__(self, workers: int):
+    self.workers = workers
+    self.queued: List[Tuple[int, int, object]] = []
+    self.running: Dict[str, object] = {}
+    self.order = itertools.count()
+
+  def submit(self, job):
+    # higher priorities first, first come first served within a priority
+    heapq.heappush(self.queued, (-job.priority, next(self.order), job))
+    self.dispatch()
+
+  def dispatch(self):
+    while self.queued and len(self.running) < self.workers:
+      _, _, job = heapq.heappop(self.queued)
+      self.running[job.identifier] = job
+      job.task = asyncio.ensure_future(self.run(job))
+
+  async def run(self, job):
+    try:
+      await job.run()
+    finally:
+      del self.running[job.identifier]
+      self.dispatch()
+
+  def cancel(self, job):
+    for i, (_, _, queued_job) in enumerate(self.queued):
+      if queued_job is job:
+        self.queued.pop(i)
+        heapq.heapify(self.queued)
+        job.cancel_queued()
+        return
+    if job.task is not None:
+      job.task.cancel()
+
+  def queue_position(self, job):
+    ordered = sorted(self.queued, key=lambda entry: entry[:2])
+    for position, (_, _, queued_job) in enumerate(ordered):
+      if queued_job is job:
+        return position
+    return None
+
+  @property
+  def stats(self):
+    return {
+        "workers": self.workers,
+        "running": len(self.running),
+        "queued": len(self.queued)
+    }
+
+tracking_scheduler = TrackingScheduler(TRACKING_PROCESSES)
@@ -0,0 +1,224 @@
+from pathlib import Path
+from time import time
+from typing import AsyncIterable, Dict, List, Union
+from uuid import uuid4
+import asyncio
+import hashlib
+import json
+import os
+import re
+from common import BackendError, ReturnResult, FRAME_STORE, TEMP_FOLDER, \
+  UPLOAD_CHUNK_BYTES, UPLOAD_EXPIRE_SECONDS
+from frame_store import mp4_moov_complete, read_mp4_keyframes
+from metrics import metrics
+import video_tool
+
+# body pieces are gathered up to this size before being written and hashed
+WRITE_BUFFER_BYTES = 1024 * 1024
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+class UploadSession:
+
+  def __init__(self, name: str, size: int, checksum: Union[str, None],
+               identifier: Union[str, None] = None):
+    self.identifier = identifier if identifier else uuid4().hex
+    self.name = name
+    self.size = size
+    self.checksum = checksum
+    self.received = 0
+    # chunks only ever arrive in order, so the hash can be kept running
+    # instead of reading the whole file again at the end
+    self.hasher = hashlib.sha256()
+    self.updated_at = time()
+    self.lock = asyncio.Lock()
+    # reads the keyframes as soon as the moov box is in, so the lazy frame
+    # store has its index by the time the last chunk arrives
+    self.index_task: Union[asyncio.Future, None] = None
+
+  @property
+  def part_path(self):
+    return Path(TEMP_FOLDER, f"upload_{self.identifier}.part")
+
+  @property
+  def meta_path(self):
+    return Path(TEMP_FOLDER, f"upload_{self.identifier}.json")
+
+  def write_meta(self):
+    with open(self.meta_path, "w") as f:
+      json.dump({
+          "name": self.name,
+          "size": self.size,
+          "sha256": self.checksum
+      }, f)
+    self.part_path.touch()
+
+  def append(self, data: bytes):
+    with open(self.part_path, "ab") as f:
+      f.write(data)
+    self.hasher.update(data)
+    self.received += len(data)
+
+  def restore(self):
+    # picks up an upload that outlived the server process it started in
+    with open(self.part_path, "rb") as f:
+      while data := f.read(WRITE_BUFFER_BYTES):
+        self.hasher.update(data)
+        self.received += len(data)
+
+  async def start_indexing(self):
+    if FRAME_STORE != "lazy" or self.index_task is not None:
+      return
+    received = self.received
+    if await asyncio.to_thread(mp4_moov_complete, self.part_path, received):
+      print(f"Indexing keyframes of upload {self.identifier} after " +
+            f"{received} of {self.size} bytes")
+      self.index_task = asyncio.ensure_future(
+          asyncio.to_thread(read_mp4_keyframes, self.part_path, received))
+
+  async def keyframes(self) -> Union[List[int], None]:
+    if self.index_task is None:
+      return None
+    try:
+      return await self.index_task
+    except Exception:
+      return None
+
+  def remove_files(self):
+    self.part_path.unlink(missing_ok=True)
+    self.meta_path.unlink(missing_ok=True)
+
+  def to_dict(self):
+    return {
+        "upload_id": self.identifier,
+        "name": self.name,
+        "size": self.size,
+        "received": self.received,
+        "chunk_size": UPLOAD_CHUNK_BYTES
+    }
+
+upload_sessions: Dict[str, UploadSession] = {}
+metrics.gauge("ftcml_upload_sessions", "Chunked uploads in progress",
+              lambda: {(): len(upload_sessions)})
+
+def expire_uploads():
+  now = time()
+  for identifier, session in list(upload_sessions.items()):
+    if now - session.updated_at > UPLOAD_EXPIRE_SECONDS \
+      and not session.lock.locked():
+      del upload_sessions[identifier]
+      session.remove_files()
+  for meta_path in TEMP_FOLDER.glob("upload_*.json"):
+    identifier = meta_path.stem[len("upload_"):]
+    part_path = Path(TEMP_FOLDER, f"upload_{identifier}.part")
+    touched = part_path.stat().st_mtime if part_path.exists() \
+      else meta_path.stat().st_mtime
+    if identifier not in upload_sessions \
+      and now - touched > UPLOAD_EXPIRE_SECONDS:
+      part_path.unlink(missing_ok=True)
+      meta_path.unlink(missing_ok=True)
+
+async def get_session(upload_identifier: str):
+  if upload_identifier in upload_sessions:
+    return upload_sessions[upload_identifier]
+  if not re.fullmatch(r"[0-9a-f]{32}", upload_identifier):
+    return None
+  meta_path = Path(TEMP_FOLDER, f"upload_{upload_identifier}.json")
+  if not meta_path.exists():
+    return None
+  with open(meta_path, "r") as f:
+    meta = json.load(f)
+  session = UploadSession(meta["name"], meta["size"], meta["sha256"],
+                          upload_identifier)
+  if session.part_path.exists():
+    await asyncio.to_thread(session.restore)
+  # another request may have restored it while this one was hashing
+  return upload_sessions.setdefault(upload_identifier, session)
+
+async def create_upload(name: str, size: int, checksum: Union[str, None]):
+  if not isinstance(name, str) or not name or not isinstance(size, int) \
+    or size <= 0:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  if checksum is not None:
+    checksum = str(checksum).lower()
+    if not SHA256_PATTERN.fullmatch(checksum):
+      return ReturnResult(BackendError.INVALID_ARGUMENT)
+  await asyncio.to_thread(expire_uploads)
+  session = UploadSession(name, size, checksum)
+  await asyncio.to_thread(session.write_meta)
+  upload_sessions[session.identifier] = session
+  return ReturnResult.success(session.to_dict())
+
+async def get_upload(upload_identifier: str):
+  session = await get_session(upload_identifier)
+  if session is None:
+    return ReturnResult(BackendError.UPLOAD_NOT_FOUND)
+  return ReturnResult.success(session.to_dict())
+
+async def write_chunk(upload_identifier: str, offset: int,
+                      length: Union[int, None], body: AsyncIterable[bytes]):
+  session = await get_session(upload_identifier)
+  if session is None:
+    return ReturnResult(BackendError.UPLOAD_NOT_FOUND)
+  limit = min(UPLOAD_CHUNK_BYTES, session.size - offset)
+  if length is not None and not 0 < length <= limit:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  async with session.lock:
+    if offset != session.received:
+      # tells the client where to resume
+      return ReturnResult(BackendError.UPLOAD_OFFSET_MISMATCH,
+                          session.to_dict())
+    buffer = bytearray()
+    written = 0
+    async for data in body:
+      # without a content length the limit is only known while streaming,
+      # whatever was written before it's hit stays and can be resumed from
+      if written + len(buffer) + len(data) > limit:
+        if buffer:
+          await asyncio.to_thread(session.append, bytes(buffer))
+        session.updated_at = time()
+        return ReturnResult(BackendError.INVALID_ARGUMENT, session.to_dict())
+      buffer += data
+      if len(buffer) >= WRITE_BUFFER_BYTES:
+        await asyncio.to_thread(session.append, bytes(buffer))
+        written += len(buffer)
+        buffer.clear()
+    if buffer:
+      await asyncio.to_thread(session.append, bytes(buffer))
+    session.updated_at = time()
+    await session.start_indexing()
+  return ReturnResult.success(session.to_dict())
+
+async def finish_upload(upload_identifier: str):
+  session = await get_session(upload_identifier)
+  if session is None:
+    return ReturnResult(BackendError.UPLOAD_NOT_FOUND)
+  async with session.lock:
+    if session.received != session.size:
+      return ReturnResult(BackendError.UPLOAD_INCOMPLETE, session.to_dict())
+    upload_sessions.pop(session.identifier, None)
+    content_hash = session.hasher.hexdigest()
+    if session.checksum is not None and content_hash != session.checksum:
+      await asyncio.to_thread(session.remove_files)
+      return ReturnResult(BackendError.CHECKSUM_MISMATCH)
+    duplicate = video_tool.find_video_by_content_hash(content_hash)
+    if duplicate is not None:
+      await asyncio.to_thread(session.remove_files)
+      return ReturnResult.success(duplicate.name, duplicate.identifier, True)
+    keyframes = await session.keyframes()
+    video_path = Path(TEMP_FOLDER, f"upload_{session.identifier}.mp4")
+    os.replace(session.part_path, video_path)
+    session.meta_path.unlink(missing_ok=True)
+    # the data is complete and already hashed, so extraction starts right
+    # away; the lazy frame store is indexed already unless moov came last
+    name, video_identifier = (await video_tool.upload_video(
+        session.name, str(video_path), content_hash, keyframes)).data
+    return ReturnResult.success(name, video_identifier, False)
+
+async def cancel_upload(upload_identifier: str):
+  session = await get_session(upload_identifier)
+  if session is None:
+    return ReturnResult(BackendError.UPLOAD_NOT_FOUND)
+  async with session.lock:
+    upload_sessions.pop(session.identifier, None)
+    await asyncio.to_thread(session.remove_files)
+  return ReturnResult.success()
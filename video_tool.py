@@ -1,18 +1,95 @@
 from enum import IntEnum
 
 import aiofiles.os
-import aioshutil
 from quart import Quart
-from common import BackendError, DictProxy, ReturnResult, DATA_FOLDER, ensure_directory
+from common import BackendError, Registry, ReturnResult, DATA_FOLDER, \
+  ANALYZE_SIMILARITY, BUILD_PYRAMID, DISK_QUOTA_BYTES, EVICT_IDLE_SECONDS, \
+  QUOTA_CHECK_SECONDS, EXTRACT_POOL, EXTRACT_WORKERS, MAX_CONCURRENT_EXTRACTS, FRAME_STORE, \
+  FRAME_STORE_QUALITY, LABEL_FLUSH_SECONDS, LABEL_LOAD_WORKERS, \
+  PRELOAD_LABELS, TRACKING_WINDOW, ensure_directory
+from frame_cache import BGR, ENCODED, frame_cache
+from frame_pyramid import MAX_SPRITE_FRAMES, PREVIEW_QUALITY, \
+  PREVIEW_WIDTH, PYRAMID_FILES, THUMBNAIL_WIDTH, FramePyramid, level_size
+from frame_similarity import SIMILARITY_NAME, FrameSimilarity
+from label_journal import LabelJournal
+from label_store import COLUMNS, LabelStore
+from metrics import gauge_values, metrics, stage_items, time_stage
+from prefetch import prefetcher
+from storage import reclaimer, tree_size
+from interpolation import DEFAULT_MIN_SIMILARITY, INTERPOLATION_METHODS, \
+  interpolate, match_keyframes, refine
+from tracking import ACCEPTABLE_ALGORITHMS, INTERPOLATE_ALGORITHM, \
+  TRACKING_BATCH_SECONDS, \
+  TrackerStats, TrackingStopReason, box_iou, downscale_frame, \
+  get_tracker_executor, get_tracking_process_executor, init_tracker, \
+  new_tracking_channel, shutdown_tracker_executor, track_video, \
+  tracking_scheduler, update_tracker
+from frame_store import MIME_TYPES, LazyFrameStore, create_frame_store, \
+  extract_frames, frame_store_from_dict, measure_random_read, probe_video
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from uuid import uuid4
 from pathlib import Path
-from typing import Tuple, List, Union
+from typing import Awaitable, Callable, Dict, Set, Tuple, List, Union
+from time import perf_counter, time
 import json
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import numpy as np
 import pandas as pd
 import asyncio
 import aiofiles
 import cv2
 
+EXTRACT_PROGRESS_INTERVAL = 0.25
+
+_extract_executor: Union[Executor, None] = None
+_extract_manager = None
+_extract_semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTS)
+
+class _ExtractProgress:
+
+  def __init__(self):
+    self.value = 0
+
+def _get_extract_executor():
+  global _extract_executor
+  if _extract_executor is None:
+    if EXTRACT_POOL == "process":
+      _extract_executor = ProcessPoolExecutor(EXTRACT_WORKERS)
+    else:
+      _extract_executor = ThreadPoolExecutor(
+          EXTRACT_WORKERS, thread_name_prefix="frame_extract")
+  return _extract_executor
+
+def _new_extract_progress():
+  # process workers can't see plain objects from the server process, so the
+  # progress counter and cancel flag go through a manager there
+  global _extract_manager
+  if EXTRACT_POOL == "process":
+    if _extract_manager is None:
+      _extract_manager = multiprocessing.Manager()
+    return _extract_manager.Value("i", 0), _extract_manager.Event()
+  return _ExtractProgress(), threading.Event()
+
+def shutdown_workers():
+  global _extract_executor, _extract_manager
+  # analysis passes save where they got to and pick up from there next time
+  for video in videos.values():
+    video.similarity_cancel.set()
+    video.pyramid_cancel.set()
+  prefetcher.shutdown()
+  reclaimer.shutdown()
+  shutdown_tracker_executor()
+  if _extract_executor is not None:
+    _extract_executor.shutdown(wait=False, cancel_futures=True)
+    _extract_executor = None
+  if _extract_manager is not None:
+    _extract_manager.shutdown()
+    _extract_manager = None
+
 class Video:
 
   class ProcessStatus(IntEnum):
@@ -24,214 +101,821 @@ class Video:
   def __init__(self, name: str, identifier: Union[str, None] = None):
     self.name = name
     self.identifier = identifier if identifier else uuid4().hex
+    self.process_status = Video.ProcessStatus.PREPARING
+    self._labels: Union[LabelStore, None] = None
+    self._excluded_frames: List[int] = []
+    self._labels_lock = threading.Lock()
+    # labels are only ever changed from the event loop, without awaiting in
+    # between, so mutations need no lock of their own; what does need one is
+    # persisting them, where a snapshot written from an older journal offset
+    # after a newer one would drop whatever was journaled in between
+    self.persist_lock = asyncio.Lock()
+    self.labeled_frame_count_hint = 0
+    self.content_hash: Union[str, None] = None
+    self.journal: Union[LabelJournal, None] = None
+    self.tracker_stats: List[TrackerStats] = []
+    self.frame_extract_task = None
+    self.track_task = None
+    self.similarity: Union[FrameSimilarity, None] = None
+    self.similarity_task = None
+    self.similarity_cancel = threading.Event()
+    self.pyramid: Union[FramePyramid, None] = None
+    self.pyramid_task = None
+    self.pyramid_cancel = threading.Event()
+    self.pyramid_lock = asyncio.Lock()
+    # what the disk quota evicts by, least recently used first
+    self.last_accessed = time()
 
-  async def frame_extract(self, tmp_file_path: str):
+  async def frame_extract(self,
+                          tmp_file_path: str,
+                          keyframes: Union[List[int], None] = None):
+    frame_folder = Path(DATA_FOLDER, "videos", self.identifier).absolute()
+    progress, cancel_event = _new_extract_progress()
+    future = None
     try:
       self.process_status = Video.ProcessStatus.PREPARING
-      video = cv2.VideoCapture(tmp_file_path)
-      frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-      self.total_frame_count = frame_count
+      self.total_frame_count = 0
       self.extracted_frame_count = 0
-      self.process_status = Video.ProcessStatus.PROCESSING
-      ensure_directory(Path(DATA_FOLDER, "videos", self.identifier))
-      for i in range(frame_count):
-        ret, frame = video.read()
-        if not ret:
-          break
-        cv2.imwrite(
-            str(
-                Path(DATA_FOLDER, "videos", self.identifier,
-                     f"frame_{i+1}.png").absolute()), frame)
-        self.extracted_frame_count += 1
-      self.resolution = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)),
-                         int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-      self.labels = pd.DataFrame(columns=[
-          "frame_index", "label", "left", "top", "right", "bottom",
-          "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"
-      ])
+      self.frame_store = create_frame_store(FRAME_STORE, frame_folder,
+                                            FRAME_STORE_QUALITY)
+      self.total_frame_count, self.resolution = await asyncio.to_thread(
+          probe_video, tmp_file_path)
+      async with _extract_semaphore:
+        self.process_status = Video.ProcessStatus.PROCESSING
+        ensure_directory(frame_folder)
+        started = perf_counter()
+        if self.frame_store.extracts_frames:
+          future = asyncio.get_running_loop().run_in_executor(
+              _get_extract_executor(), extract_frames, tmp_file_path,
+              self.frame_store, self.total_frame_count, progress,
+              cancel_event)
+          while not future.done():
+            await asyncio.wait([future], timeout=EXTRACT_PROGRESS_INTERVAL)
+            self.extracted_frame_count = progress.value
+          self.extracted_frame_count, stored_bytes = future.result()
+        else:
+          stored_bytes = (await aiofiles.os.stat(tmp_file_path)).st_size
+          await asyncio.to_thread(self.frame_store.import_source,
+                                  tmp_file_path, keyframes)
+          self.extracted_frame_count = self.total_frame_count
+        elapsed = perf_counter() - started
+      random_read = await asyncio.to_thread(measure_random_read,
+                                            self.frame_store,
+                                            self.extracted_frame_count)
+      self.extract_stats = {
+          "frame_store": self.frame_store.kind,
+          "frames_per_second": self.extracted_frame_count / elapsed
+                               if elapsed > 0 else 0.0,
+          "bytes_per_frame": stored_bytes / self.extracted_frame_count
+                             if self.extracted_frame_count else 0.0,
+          "random_read_seconds": random_read,
+          "prepare_seconds": elapsed
+      }
+      print(f"Video frame store {self.frame_store.kind}: " +
+            f"labelable after {elapsed:.2f} s, " +
+            f"{self.extract_stats['frames_per_second']:.1f} frames/s, " +
+            f"{self.extract_stats['bytes_per_frame'] / 1024:.1f} KiB/frame, " +
+            f"random read {random_read * 1000:.1f} ms")
+      if self.frame_store.extracts_frames and DISK_QUOTA_BYTES:
+        # kept so the frames can be evicted and decoded from it later on
+        await asyncio.to_thread(
+            shutil.move, tmp_file_path,
+            Path(frame_folder, LazyFrameStore.source_name))
+      self.labels = LabelStore()
+      self.journal = LabelJournal(frame_folder)
       self.excluded_frames = []
       self.process_status = Video.ProcessStatus.COMPLETED
-    except asyncio.CancelledError:
-      self.process_status = Video.ProcessStatus.CANCELLED
-      await aioshutil.rmtree(Path(DATA_FOLDER, "videos", self.identifier))
-    except Exception as e:
+      mark_video_index_dirty()
+      if BUILD_PYRAMID:
+        self.start_pyramid_build()
+      if ANALYZE_SIMILARITY:
+        self.start_similarity_analysis()
+    except (asyncio.CancelledError, Exception):
       self.process_status = Video.ProcessStatus.CANCELLED
-      await aioshutil.rmtree(Path(DATA_FOLDER, "videos", self.identifier))
+      cancel_event.set()
+      if future is not None:
+        # the worker notices the flag between two frames, wait for it to stop
+        # writing before removing the folder
+        await asyncio.wait([future])
+      frame_cache.invalidate(self.identifier)
+      prefetcher.forget(self.identifier)
+      await asyncio.to_thread(reclaimer.discard, frame_folder)
     finally:
       print("Video frame extract finished: " + self.identifier)
-      video.release()
-      await aiofiles.os.remove(tmp_file_path)
+      if await aiofiles.os.path.exists(tmp_file_path):
+        await aiofiles.os.remove(tmp_file_path)
 
-  def start_frame_extract(self, tmp_file_path: str):
-    coro = self.frame_extract(tmp_file_path)
-    self.frame_extract_task = asyncio.ensure_future(coro)
-    asyncio.run_coroutine_threadsafe(coro=coro, loop=asyncio.get_event_loop())
+  def start_frame_extract(self,
+                          tmp_file_path: str,
+                          keyframes: Union[List[int], None] = None):
+    self.frame_extract_task = asyncio.ensure_future(
+        self.frame_extract(tmp_file_path, keyframes))
+
+  def load_frame(self, frame_index: int):
+    frame = frame_cache.get(self.identifier, frame_index, BGR)
+    if frame is None:
+      frame = self.frame_store.read(frame_index)
+      if frame is not None:
+        frame_cache.put(self.identifier, frame_index, BGR, frame)
+    return frame
+
+  def load_frame_encoded(self, frame_index: int):
+    encoded = frame_cache.get(self.identifier, frame_index, ENCODED)
+    if encoded is None:
+      if self.frame_store.extracts_frames:
+        encoded = self.frame_store.read_encoded(frame_index)
+      else:
+        # nothing is encoded on disk, so encode from the decoded frame cache
+        frame = self.load_frame(frame_index)
+        encoded = self.frame_store.encode(frame) if frame is not None else None
+      if encoded is not None:
+        frame_cache.put(self.identifier, frame_index, ENCODED, encoded)
+    return encoded
+
+  def load_tracking_frame(self, frame_index: int, scale: float):
+    frame = self.load_frame(frame_index)
+    return downscale_frame(frame, scale) if frame is not None else None
+
+  def prefetch_after(self, frame_index: int, decoded: bool = False):
+    # an image store serves the encoded bytes from disk as they are, so
+    # those are what a client paging through frames gets ahead of time;
+    # only the lazy store and trackers need the decoded frames
+    if decoded or not self.frame_store.extracts_frames:
+      prefetcher.access(self.identifier, frame_index, self.load_frame,
+                        self.total_frame_count)
+    else:
+      prefetcher.access(self.identifier, frame_index, self.load_frame_encoded,
+                        self.total_frame_count, "encoded")
+
+  @property
+  def labels_loaded(self):
+    return self._labels is not None
+
+  @property
+  def labels(self) -> LabelStore:
+    if self._labels is None:
+      self.load_labels()
+    return self._labels  # type: ignore
+
+  @labels.setter
+  def labels(self, labels: LabelStore):
+    self._labels = labels
+
+  @property
+  def excluded_frames(self) -> List[int]:
+    # exclusions can also be replayed from the label journal
+    if self._labels is None:
+      self.load_labels()
+    return self._excluded_frames
+
+  @excluded_frames.setter
+  def excluded_frames(self, excluded_frames: List[int]):
+    self._excluded_frames = excluded_frames
 
   def exclude_frame(self, frame_index: int):
-    self.excluded_frames.append(frame_index)
+    # the frame count isn't known before extraction has started
+    if not self.frame_extract_finished():
+      return ReturnResult(BackendError.VIDEO_PROCESSING)
+    if frame_index < 1 or self.total_frame_count < frame_index:
+      return ReturnResult(BackendError.FRAME_NOT_FOUND)
+    self.exclude_frames([frame_index])
+    return ReturnResult.success()
+
+  def exclude_frames(self, frame_indices: List[int]):
+    # journaled before extraction is done, an exclusion would be lost when
+    # extraction starts the journal over
+    if not self.frame_extract_finished():
+      return []
+    excluded = set(self.excluded_frames)
+    added = [
+        frame_index for frame_index in dict.fromkeys(frame_indices)
+        if 1 <= frame_index <= self.total_frame_count
+        and frame_index not in excluded
+    ]
+    if added:
+      self.excluded_frames.extend(added)
+      self.journal.record_exclude(added)
+    return added
+
+  def insert_labels(self, records: Union[List[dict], pd.DataFrame]):
+    with time_stage("label_append"):
+      if isinstance(records, list) and len(records) == 1:
+        self.labels.append(records[0])
+      else:
+        self.labels.extend(records)
+      self.journal.record_insert(records)
+    stage_items.inc(len(records), stage="label_append")
+
+  def delete_labels(self, label_ids: List[str]):
+    deleted = [
+        label_id for label_id in label_ids if self.labels.delete(label_id)
+    ]
+    if deleted:
+      self.journal.record_delete(deleted)
+    return deleted
+
+  async def analyze_similarity(self):
+    try:
+      if self.similarity is None:
+        similarity = FrameSimilarity(
+            Path(DATA_FOLDER, "videos", self.identifier).absolute(),
+            self.total_frame_count)
+        # picks up whatever an earlier, interrupted pass got through
+        await asyncio.to_thread(similarity.load)
+        self.similarity = similarity
+      if not self.similarity.complete:
+        started = perf_counter()
+        first = self.similarity.analyzed
+        await asyncio.to_thread(self.similarity.analyze, self.frame_store,
+                                self.similarity_cancel)
+        elapsed = perf_counter() - started
+        print(f"Analyzed frames {first + 1} to {self.similarity.analyzed} " +
+              f"of video {self.identifier} for near-duplicates in " +
+              f"{elapsed:.2f} s")
+    except Exception as e:
+      print(f"Failed to analyze video {self.identifier} " +
+            f"for near-duplicates: {e}")
+
+  def start_similarity_analysis(self):
+    if self.similarity_task is None or self.similarity_task.done():
+      self.similarity_cancel.clear()
+      self.similarity_task = asyncio.ensure_future(self.analyze_similarity())
+    return self.similarity_task
+
+  @property
+  def similarity_running(self):
+    return self.similarity_task is not None and not self.similarity_task.done()
+
+  async def open_pyramid(self):
+    async with self.pyramid_lock:
+      if self.pyramid is None:
+        pyramid = FramePyramid(
+            Path(DATA_FOLDER, "videos", self.identifier).absolute(),
+            self.total_frame_count, tuple(self.resolution))
+        # picks up whatever an earlier, interrupted build got through
+        await asyncio.to_thread(pyramid.open)
+        self.pyramid = pyramid
+      return self.pyramid
+
+  async def build_pyramid(self):
+    try:
+      pyramid = await self.open_pyramid()
+      if not pyramid.complete:
+        started = perf_counter()
+        first = pyramid.built
+        await asyncio.to_thread(pyramid.build, self.frame_store,
+                                self.pyramid_cancel)
+        elapsed = perf_counter() - started
+        print(f"Built thumbnails and previews for frames {first + 1} to " +
+              f"{pyramid.built} of video {self.identifier} in " +
+              f"{elapsed:.2f} s")
+    except Exception as e:
+      print(f"Failed to build thumbnails for video {self.identifier}: {e}")
+
+  def start_pyramid_build(self):
+    if self.pyramid is not None and self.pyramid.complete:
+      return None
+    if self.pyramid_task is None or self.pyramid_task.done():
+      self.pyramid_cancel.clear()
+      self.pyramid_task = asyncio.ensure_future(self.build_pyramid())
+    return self.pyramid_task
+
+  @property
+  def pyramid_running(self):
+    return self.pyramid_task is not None and not self.pyramid_task.done()
+
+  def load_preview(self, frame_index: int):
+    preview = self.pyramid.preview(frame_index) \
+      if self.pyramid is not None else None
+    if preview is None:
+      # not built yet, scaled down from the full frame instead
+      frame = self.load_frame(frame_index)
+      if frame is None:
+        return None
+      success, buffer = cv2.imencode(
+          ".jpg",
+          cv2.resize(frame,
+                     level_size(tuple(self.resolution), PREVIEW_WIDTH),
+                     interpolation=cv2.INTER_AREA),
+          [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+      preview = buffer.tobytes() if success else None
+    return preview
+
+  async def near_duplicates(self, threshold: float):
+    # labeled frames are never thinned out, and frames already excluded
+    # aren't suggested again
+    labeled = list(self.labels.rows_by_frame)
+    candidates = await asyncio.to_thread(self.similarity.near_duplicates,
+                                         threshold, labeled)
+    excluded = set(self.excluded_frames)
+    return [
+        frame_index for frame_index in candidates
+        if frame_index not in excluded
+    ]
 
   def frame_extract_finished(self):
-    if not hasattr(self, "process_status"):
-      return False
-    return self.process_status == Video.ProcessStatus.COMPLETED \
-      or self.process_status == Video.ProcessStatus.CANCELLED
+    # a cancelled video never got its resolution or labels
+    return self.process_status == Video.ProcessStatus.COMPLETED
+
+  def touch(self):
+    self.last_accessed = time()
+
+  @property
+  def busy(self):
+    # anything that may be reading or writing the video folder right now
+    return self.process_status != Video.ProcessStatus.COMPLETED \
+      or self.similarity_running or self.pyramid_running \
+      or self.track_task is not None and not self.track_task.done() \
+      or any(job.video is self
+             for job in list(tracking_scheduler.running.values()))
+
+  def derived_files(self):
+    folder = Path(DATA_FOLDER, "videos", self.identifier).absolute()
+    files = [Path(folder, name) for name in PYRAMID_FILES + (SIMILARITY_NAME,)]
+    # only with the original next to them can the frames be decoded again,
+    # legacy videos and those extracted before the quota keep theirs
+    decodable = Path(folder, LazyFrameStore.source_name).exists()
+    if self.frame_store.extracts_frames:
+      if decodable:
+        files += folder.glob(f"frame_*{self.frame_store.extension}")
+    else:
+      # left over from an eviction that was cut short
+      files += folder.glob("frame_*.*")
+    return files, decodable
+
+  async def evict_derived_data(self):
+    # thumbnails, previews and near-duplicate scores are rebuilt on request,
+    # evicted frames are decoded from the original from then on
+    async with self.pyramid_lock:
+      if self.busy:
+        return 0
+      files, decodable = await asyncio.to_thread(self.derived_files)
+      if self.busy:
+        return 0
+      if self.pyramid is not None:
+        self.pyramid.close()
+        self.pyramid = None
+      self.similarity = None
+      if self.frame_store.extracts_frames and decodable:
+        self.frame_store = LazyFrameStore(
+            Path(DATA_FOLDER, "videos", self.identifier).absolute())
+        frame_cache.invalidate(self.identifier)
+        prefetcher.forget(self.identifier)
+        mark_video_index_dirty()
+      return await asyncio.to_thread(reclaimer.remove, files)
+
+  async def discard(self):
+    # the video is out of the registry already; everything still working on
+    # it is stopped before its folder goes
+    self.similarity_cancel.set()
+    self.pyramid_cancel.set()
+    tasks = [
+        task for task in (self.frame_extract_task, self.track_task,
+                          self.similarity_task, self.pyramid_task)
+        if task is not None and not task.done()
+    ]
+    for task in (self.frame_extract_task, self.track_task):
+      if task is not None:
+        task.cancel()
+    for job in list(tracking_jobs.values()):
+      if job.video is self:
+        tracking_scheduler.cancel(job)
+        if job.task is not None and not job.task.done():
+          tasks.append(job.task)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    async with self.persist_lock:
+      if self.pyramid is not None:
+        self.pyramid.close()
+      if getattr(self, "frame_store", None) is not None:
+        self.frame_store.close()
+      frame_cache.invalidate(self.identifier)
+      prefetcher.forget(self.identifier)
+      await asyncio.to_thread(
+          reclaimer.discard,
+          Path(DATA_FOLDER, "videos", self.identifier).absolute())
+
+  def frame_error(self, frame_index):
+    if not is_integer(frame_index):
+      return BackendError.INVALID_ARGUMENT
+    if not 1 <= frame_index <= self.total_frame_count:
+      return BackendError.FRAME_NOT_FOUND
+    return None
+
+  def label_error(self, frame_index, label, box):
+    # what a label is checked for, on its own or in a batch, before its box
+    # coordinates are, see absolute_boxes
+    error = self.frame_error(frame_index)
+    if error is not None:
+      return error
+    if not isinstance(label, str) or not label \
+      or not isinstance(box, (list, tuple)) or len(box) != 4:
+      return BackendError.INVALID_ARGUMENT
+    return None
+
+  def absolute_boxes(self, boxes: list, normalized: list):
+    # every box at once, in pixels, and whether it is four finite numbers
+    # with right past left and bottom past top
+    try:
+      array = np.array(boxes)
+    except ValueError:
+      array = np.array(boxes, dtype=object)
+    # numpy takes true and false for 1 and 0 next to other numbers
+    if array.ndim != 2 or array.dtype.kind not in "iuf" \
+      or any(isinstance(value, bool) for box in boxes for value in box):
+      # something in there isn't a number, sort it out box by box
+      array = np.array([
+          box if all(is_number(value) for value in box) else [np.nan] * 4
+          for box in boxes
+      ])
+    boxes = array.astype(np.float64)
+    size = np.asarray(self.resolution * 2, dtype=np.float64)
+    absolute = np.where(np.asarray(normalized)[:, None], boxes * size, boxes)
+    valid = np.isfinite(absolute).all(axis=1) \
+      & (absolute[:, 2] > absolute[:, 0]) & (absolute[:, 3] > absolute[:, 1])
+    return absolute, valid
 
   def label_frame(self, frame_index: int, label: str, box: Tuple[int, int, int,
                                                                  int]):
-    if self.total_frame_count < frame_index:
-      return ReturnResult(BackendError.FRAME_NOT_FOUND)
+    # the frame count isn't known before extraction has started
     if not self.frame_extract_finished():
       return ReturnResult(BackendError.VIDEO_PROCESSING)
+    error = self.label_error(frame_index, label, box)
+    if error is not None:
+      return ReturnResult(error)
+    absolute, valid = self.absolute_boxes([box], [False])
+    if not valid[0]:
+      return ReturnResult(BackendError.INVALID_ARGUMENT)
+    left, top, right, bottom = absolute[0].tolist()
     label_id = uuid4().hex
     record = {
         "label_id": label_id,
         "frame_index": frame_index,
         "label": label,
-        "left": box[0] / self.resolution[0],
-        "top": box[1] / self.resolution[1],
-        "right": box[2] / self.resolution[0],
-        "bottom": box[3] / self.resolution[1],
-        "absolute_left": box[0],
-        "absolute_top": box[1],
-        "absolute_right": box[2],
-        "absolute_bottom": box[3]
+        "left": left / self.resolution[0],
+        "top": top / self.resolution[1],
+        "right": right / self.resolution[0],
+        "bottom": bottom / self.resolution[1],
+        "absolute_left": left,
+        "absolute_top": top,
+        "absolute_right": right,
+        "absolute_bottom": bottom
     }
-    new_df = pd.DataFrame([record])
-    self.labels = pd.concat([self.labels, new_df], ignore_index=True)
+    self.insert_labels([record])
     return ReturnResult.success(label_id)
 
-  def unlabel_frame(self, label_id: str):
-    self.labels = self.labels.loc[self.labels["label_id"] != label_id]
+  def unlabel_frame(self, frame_index: int, label_id: str):
+    if label_id not in self.labels \
+      or frame_index not in self.labels.rows_by_frame \
+      or self.labels.rows_by_label_id[label_id] \
+        not in self.labels.rows_by_frame[frame_index]:
+      return ReturnResult(BackendError.LABEL_NOT_FOUND)
+    self.delete_labels([label_id])
     return ReturnResult.success()
 
+  def apply_label_operations(self, operations: list):
+    # every operation is checked on its own, then all labels go in as one
+    # column-wise insert, all deletes and all exclusions as one journal
+    # record each; the three kinds never depend on each other, so grouping
+    # them gives the same result as applying them in order
+    results: List[dict] = [{"status": BackendError.SUCCESS}] * len(operations)
+    inserts = []
+    deletes = []
+    excludes = []
+    for i, operation in enumerate(operations):
+      kind = operation.get("op") if isinstance(operation, dict) else None
+      if kind not in LABEL_OPERATIONS:
+        results[i] = operation_error(BackendError.INVALID_REQUEST)
+      elif kind == "unlabel":
+        label_id = operation.get("label_id")
+        if isinstance(label_id, str):
+          deletes.append((i, label_id))
+        else:
+          results[i] = operation_error(BackendError.INVALID_ARGUMENT)
+      elif kind == "exclude":
+        frame_index = operation.get("frame")
+        if (error := self.frame_error(frame_index)) is None:
+          excludes.append((i, frame_index))
+        else:
+          results[i] = operation_error(error)
+      elif (error := self.label_error(
+          frame_index := operation.get("frame"),
+          label := operation.get("label"),
+          box := operation.get("box"))) is None:
+        inserts.append((i, frame_index, label, box,
+                        bool(operation.get("normalized", False))))
+      else:
+        results[i] = operation_error(error)
+    if inserts:
+      positions, frame_indices, names, boxes, normalized = zip(*inserts)
+      absolute, valid = self.absolute_boxes(boxes, normalized)
+      records = self.label_records(
+          np.asarray(frame_indices, dtype=np.int64)[valid],
+          np.asarray(names, dtype=object)[valid], absolute[valid])
+      self.insert_labels(records)
+      inserted = iter(records["label_id"])
+      for position, is_valid in zip(positions, valid.tolist()):
+        results[position] = {
+            "status": BackendError.SUCCESS,
+            "label_id": next(inserted)
+        } if is_valid else operation_error(BackendError.INVALID_ARGUMENT)
+    if deletes:
+      deleted = set(self.delete_labels([label_id for _, label_id in deletes]))
+      for position, label_id in deletes:
+        if label_id not in deleted:
+          results[position] = operation_error(BackendError.LABEL_NOT_FOUND)
+    if excludes:
+      self.exclude_frames([frame_index for _, frame_index in excludes])
+    return results
+
+  def label_records(self, frame_indices: np.ndarray, names: np.ndarray,
+                    absolute: np.ndarray):
+    # many labels as one frame, column by column, for insert_labels
+    relative = absolute / np.asarray(self.resolution * 2, dtype=np.float64)
+    # the same 32 random hex digits uuid4().hex gives, in one call
+    random_hex = os.urandom(16 * len(absolute)).hex()
+    return pd.DataFrame(
+        {
+            "label_id": [
+                random_hex[i:i + 32] for i in range(0, len(random_hex), 32)
+            ],
+            "frame_index": frame_indices,
+            "label": names,
+            "left": relative[:, 0],
+            "top": relative[:, 1],
+            "right": relative[:, 2],
+            "bottom": relative[:, 3],
+            "absolute_left": absolute[:, 0],
+            "absolute_top": absolute[:, 1],
+            "absolute_right": absolute[:, 2],
+            "absolute_bottom": absolute[:, 3]
+        },
+        columns=COLUMNS)
+
+  def tracked_record(self, frame_index: int, label: str, bbox):
+    al, at, w, h = bbox
+    ar = al + w
+    ab = at + h
+    return {
+        "label_id": uuid4().hex,
+        "frame_index": frame_index,
+        "label": label,
+        "left": al / self.resolution[0],
+        "top": at / self.resolution[1],
+        "right": ar / self.resolution[0],
+        "bottom": ab / self.resolution[1],
+        "absolute_left": al,
+        "absolute_top": at,
+        "absolute_right": ar,
+        "absolute_bottom": ab
+    }
+
   async def track_one_frame(self, new_frame_index: int,
                             new_frame: cv2.typing.MatLike,
-                            trackers: List[cv2.Tracker], labels: List[str]):
+                            trackers: List[Union[cv2.Tracker, None]],
+                            labels: List[str],
+                            stats: Union[List[TrackerStats], None] = None,
+                            boxes: Union[List[Tuple[float, float, float,
+                                                    float]], None] = None,
+                            min_iou: Union[float, None] = None,
+                            scale: float = 1.0):
+    loop = asyncio.get_running_loop()
+    executor = get_tracker_executor()
+    active = [i for i, tracker in enumerate(trackers) if tracker is not None]
+    outcomes = await asyncio.gather(*[
+        loop.run_in_executor(executor, update_tracker, trackers[i],
+                             new_frame, scale) for i in active
+    ])
     result = []
-    for i, tracker in enumerate(trackers):
-      success, bbox = tracker.update(new_frame)
+    for i, (success, bbox, seconds) in zip(active, outcomes):
+      if success and boxes is not None:
+        # a box that jumps away from where it just was has usually latched
+        # onto something else
+        if min_iou is not None and box_iou(boxes[i], bbox) < min_iou:
+          success = False
+        else:
+          boxes[i] = bbox
+      if stats is not None:
+        stats[i].record(new_frame_index, success, seconds)
       if success:
-        al, at, w, h = bbox
-        ar = al + w
-        ab = at + h
-        label_id = uuid4().hex
-        result.append({
-            "label_id": label_id,
-            "frame_index": new_frame_index,
-            "label": labels[i],
-            "left": al / self.resolution[0],
-            "top": at / self.resolution[1],
-            "right": ar / self.resolution[0],
-            "bottom": ab / self.resolution[1],
-            "absolute_left": al,
-            "absolute_top": at,
-            "absolute_right": ar,
-            "absolute_bottom": ab
-        })
+        result.append(self.tracked_record(new_frame_index, labels[i], bbox))
       else:
-        return ReturnResult(BackendError.TRACKING_FAILED)
+        # a lost object stops being tracked, the others carry on
+        trackers[i] = None
+    if not result:
+      return ReturnResult(BackendError.TRACKING_FAILED)
     return ReturnResult.success(result)
 
-  async def track_from_frame(self, starting_frame_index: int, algorithm: str,
-                             continue_event: asyncio.Event):
+  async def track_frames(self,
+                         starting_frame_index: int,
+                         algorithm: str,
+                         on_frame: Callable[[int, List[dict]],
+                                            Awaitable[bool]],
+                         max_frames: Union[int, None] = None,
+                         stop_on_failure: bool = False,
+                         min_iou: Union[float, None] = None,
+                         scale: float = 1.0):
+    self.tracker_stats = []
+    next_frame = None
     try:
-      frame_index = starting_frame_index
-      frame_path = Path(DATA_FOLDER, "videos", self.identifier,
-                        f"frame_{frame_index}.png")
-      frame = cv2.imread(str(frame_path.absolute()))
-      raw_bboxes = self.labels["frame_index", "label",
-                            "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"] \
-        .loc[self.labels["frame_index"] == frame_index]
-      bboxes = raw_bboxes["absolute_left", "absolute_top",
-                          "absolute_right", "absolute_bottom"].to_dict(
-                              orient="records")  # type: ignore
-      labels = raw_bboxes["label"].tolist()
-      trackers = []
-      for bbox in bboxes:
-        if algorithm == "KCF":
-          tracker = cv2.TrackerKCF()
-        elif algorithm == "MedianFlow":
-          tracker = cv2.legacy.TrackerMedianFlow()
-        elif algorithm == "MOSSE":
-          tracker = cv2.legacy.TrackerMOSSE()
-        elif algorithm == "CSRT":
-          tracker = cv2.TrackerCSRT()
-        elif algorithm == "MIL":
-          tracker = cv2.TrackerMIL()
-        elif algorithm == "TLD":
-          tracker = cv2.legacy.TrackerTLD()
-        elif algorithm == "Boosting":
-          tracker = cv2.legacy.TrackerBoosting()
-        else:
-          raise ValueError(f"Unknown tracker algorithm: {algorithm}")
-
-        trackers.append(tracker)
-        tracker.init(frame, (bbox["absolute_left"], bbox["absolute_top"],
-                             bbox["absolute_right"] - bbox["absolute_left"],
-                             bbox["absolute_bottom"] - bbox["absolute_top"]))
-      frame_index += 1
-      while frame_index <= self.total_frame_count:
-        frame_path = Path(DATA_FOLDER, "videos", self.identifier,
-                          f"frame_{frame_index}.png")
-        frame = cv2.imread(str(frame_path.absolute()))
+      loop = asyncio.get_running_loop()
+      executor = get_tracker_executor()
+      frame = await asyncio.to_thread(self.load_tracking_frame,
+                                      starting_frame_index, scale)
+      bboxes = self.labels.frame_records(starting_frame_index, [
+          "label", "absolute_left", "absolute_top", "absolute_right",
+          "absolute_bottom"
+      ])
+      labels = [bbox["label"] for bbox in bboxes]
+      trackers = list(await asyncio.gather(*[
+          loop.run_in_executor(
+              executor, init_tracker, algorithm, frame,
+              (bbox["absolute_left"], bbox["absolute_top"],
+               bbox["absolute_right"], bbox["absolute_bottom"]), scale)
+          for bbox in bboxes
+      ]))
+      boxes = [(bbox["absolute_left"], bbox["absolute_top"],
+                bbox["absolute_right"] - bbox["absolute_left"],
+                bbox["absolute_bottom"] - bbox["absolute_top"])
+               for bbox in bboxes]
+      self.tracker_stats = [TrackerStats(label) for label in labels]
+      last_frame_index = self.total_frame_count
+      if max_frames is not None:
+        last_frame_index = min(last_frame_index,
+                               starting_frame_index + max_frames)
+      frame_index = starting_frame_index + 1
+      if frame_index <= last_frame_index:
+        next_frame = asyncio.ensure_future(
+            asyncio.to_thread(self.load_tracking_frame, frame_index, scale))
+      while next_frame is not None:
+        self.prefetch_after(frame_index, decoded=True)
+        frame = await next_frame
+        next_frame = None
+        if frame is None:
+          return ReturnResult(BackendError.FRAME_NOT_FOUND)
+        # decode the next frame while the trackers work on this one
+        if frame_index < last_frame_index:
+          next_frame = asyncio.ensure_future(
+              asyncio.to_thread(self.load_tracking_frame, frame_index + 1,
+                                scale))
+        tracking_before = sum(1 for tracker in trackers if tracker)
         result = await self.track_one_frame(frame_index, frame, trackers,
-                                            labels)
+                                            labels, self.tracker_stats, boxes,
+                                            min_iou, scale)
+        if result.status == BackendError.TRACKING_FAILED:
+          return ReturnResult.success(TrackingStopReason.ALL_LOST)
         if not result.is_success:
           return result
-        self.labels = pd.concat(
-            [self.labels, pd.DataFrame(result.data)], ignore_index=True)
-        continue_event.clear()
-        await continue_event.wait()
+        if not await on_frame(frame_index, result.data):
+          return ReturnResult.success(TrackingStopReason.STOPPED)
+        if stop_on_failure and \
+          sum(1 for tracker in trackers if tracker) < tracking_before:
+          return ReturnResult.success(TrackingStopReason.TRACKER_LOST)
         frame_index += 1
-      return ReturnResult.success()
+      if last_frame_index < self.total_frame_count:
+        return ReturnResult.success(TrackingStopReason.MAX_FRAMES)
+      return ReturnResult.success(TrackingStopReason.END_OF_VIDEO)
+    finally:
+      if next_frame is not None:
+        next_frame.cancel()
+      for stats in self.tracker_stats:
+        print(f"Tracker {stats.label} on video {self.identifier}: " +
+              f"{stats.updates} updates, " +
+              f"{stats.to_dict()['mean_ms']:.1f} ms mean, " +
+              f"{stats.max_seconds * 1000:.1f} ms max")
+
+  async def track_from_frame(self,
+                             starting_frame_index: int,
+                             algorithm: str,
+                             stream: "TrackingStream",
+                             scale: float = 1.0):
+
+    async def on_frame(frame_index: int, records: List[dict]):
+      self.insert_labels(records)
+      await stream.running.wait()
+      # blocks once the client is a whole window behind
+      await stream.frames.put(frame_index)
+      return True
+
+    try:
+      result = await self.track_frames(starting_frame_index,
+                                       algorithm,
+                                       on_frame,
+                                       scale=scale)
+      if result.is_success and result.data == TrackingStopReason.ALL_LOST:
+        result = ReturnResult(BackendError.TRACKING_FAILED)
+      elif result.is_success:
+        result = ReturnResult.success()
     except asyncio.CancelledError:
       return ReturnResult(BackendError.TASK_WAS_CANCELLED)
+    except Exception as e:
+      print(f"Tracking on video {self.identifier} failed: {e!r}")
+      result = ReturnResult(BackendError.TRACKING_FAILED)
+    await stream.frames.put(result)
+    return result
 
-  def start_object_tracking(self, starting_frame_index: int, algorithm: str,
-                            continue_event: asyncio.Event):
-    coro = self.track_from_frame(starting_frame_index, algorithm,
-                                 continue_event)
-    self.track_task = asyncio.ensure_future(coro)
-    asyncio.run_coroutine_threadsafe(coro=coro, loop=asyncio.get_event_loop())
+  def start_object_tracking(self,
+                            starting_frame_index: int,
+                            algorithm: str,
+                            stream: "TrackingStream",
+                            scale: float = 1.0):
+    self.track_task = asyncio.ensure_future(
+        self.track_from_frame(starting_frame_index, algorithm, stream, scale))
+    stream.task = self.track_task
     return self.track_task
 
   @property
   def info(self):
     if self.frame_extract_finished():
-      labeled_frame_count = len(
-          self.labels.drop_duplicates(subset=["frame_index"]))
-      excluded_frame_count = len(self.excluded_frames)
+      if self.labels_loaded:
+        labeled_frame_count = self.labels.labeled_frame_count
+        excluded_frame_count = len(self.excluded_frames)
+      else:
+        # counts saved in videos.json, good enough until the labels are in
+        labeled_frame_count = self.labeled_frame_count_hint
+        excluded_frame_count = len(self._excluded_frames)
       return self.name, self.resolution, self.total_frame_count, labeled_frame_count, excluded_frame_count
     else:
       return self.name, self.process_status, self.total_frame_count, self.extracted_frame_count
 
   def to_dict(self):
     if self.frame_extract_finished():
-      self.save_labels()
       return ReturnResult.success({
           "name": self.name,
           "identifier": self.identifier,
           "resolution": self.resolution,
           "total_frame_count": self.total_frame_count,
           "excluded_frames": self.excluded_frames
+                             if self.labels_loaded else self._excluded_frames,
+          "labeled_frame_count": self.labels.labeled_frame_count
+                                 if self.labels_loaded else
+                                 self.labeled_frame_count_hint,
+          "frame_store": self.frame_store.to_dict(),
+          "extract_stats": self.extract_stats,
+          "content_hash": self.content_hash,
+          "last_accessed": self.last_accessed
       })
     else:
       return ReturnResult(BackendError.VIDEO_PROCESSING)
 
-  def save_labels(self):
-    self.labels.to_csv(Path(DATA_FOLDER, "videos", self.identifier,
-                            "labels.csv"),
-                       index=False)
+  async def _save_labels(self):
+    with time_stage("label_snapshot"):
+      columns, offset = self.journal.prepare_snapshot(self.labels,
+                                                      self.excluded_frames)
+      await asyncio.to_thread(self.journal.write_snapshot, columns, offset)
+    stage_items.inc(len(columns["label_id"]), stage="label_snapshot")
+
+  async def save_labels(self):
+    if not self.labels_loaded:
+      return
+    async with self.persist_lock:
+      await self._save_labels()
+
+  async def flush_labels(self):
+    if not self.labels_loaded:
+      return
+    async with self.persist_lock:
+      if self.journal.needs_compaction:
+        await self._save_labels()
+      elif self.journal.has_pending:
+        with time_stage("journal_flush"):
+          flushed = await asyncio.to_thread(self.journal.flush)
+        stage_items.inc(flushed, stage="journal_flush")
 
   def load_labels(self):
-    if Path(DATA_FOLDER, "videos", self.identifier, "labels.csv").exists():
-      self.labels = pd.read_csv(
-          Path(DATA_FOLDER, "videos", self.identifier, "labels.csv"))
-    else:
-      self.labels = pd.DataFrame(columns=[
-          "frame_index", "label", "left", "top", "right", "bottom",
-          "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"
-      ])
+    # called from the preload pool and, for videos it hasn't reached yet,
+    # from whoever touches the labels first
+    with self._labels_lock:
+      if self._labels is not None:
+        return 0.0
+      started = perf_counter()
+      journal = LabelJournal(
+          Path(DATA_FOLDER, "videos", self.identifier).absolute())
+      excluded_frames = list(self._excluded_frames)
+      if journal.snapshot_path.exists():
+        labels, snapshot_excluded_frames = journal.load_snapshot()
+        excluded_frames += [
+            frame_index for frame_index in snapshot_excluded_frames
+            if frame_index not in excluded_frames
+        ]
+      elif Path(DATA_FOLDER, "videos", self.identifier,
+                "labels.csv").exists():
+        label_frame = pd.read_csv(
+            Path(DATA_FOLDER, "videos", self.identifier, "labels.csv"))
+        if "label_id" not in label_frame:
+          label_frame["label_id"] = [
+              uuid4().hex for _ in range(len(label_frame))
+          ]
+        labels = LabelStore.from_dataframe(label_frame)
+      else:
+        labels = LabelStore()
+      journal.replay(labels, excluded_frames)
+      self.journal = journal
+      self._excluded_frames = excluded_frames
+      self._labels = labels
+      elapsed = perf_counter() - started
+      print(f"Loaded {len(labels)} labels for video {self.identifier} " +
+            f"in {elapsed * 1000:.1f} ms")
+      return elapsed
 
   @classmethod
   def from_dict(cls, d: dict):
@@ -241,136 +925,817 @@ class Video:
     video.resolution = d["resolution"]
     video.total_frame_count = d["total_frame_count"]
     video.excluded_frames = d["excluded_frames"]
+    video.frame_store = frame_store_from_dict(
+        d.get("frame_store"),
+        Path(DATA_FOLDER, "videos", video.identifier).absolute())
+    video.extract_stats = d.get("extract_stats")
+    video.labeled_frame_count_hint = d.get("labeled_frame_count", 0)
+    video.content_hash = d.get("content_hash")
+    video.last_accessed = d.get("last_accessed", 0.0)
     video.process_status = Video.ProcessStatus.COMPLETED
-    video.frame_extract_task = None
-    video.track_task = None
-    video.load_labels()
     return ReturnResult.success(video)
 
-videos: DictProxy[str, Video] = DictProxy()
-frame_ids: DictProxy[str, str] = DictProxy()
+videos: Registry[str, Video] = Registry()
+_video_index_dirty = False
+_preload_task: Union[asyncio.Task, None] = None
+# deleted videos whose folders are still being let go of
+_discard_tasks: Set[asyncio.Task] = set()
+_quota_lock = asyncio.Lock()
+_storage_stats = {
+    "used_bytes": 0,
+    "evicted_videos": 0,
+    "evicted_bytes": 0,
+    "last_check": None
+}
+
+def mark_video_index_dirty():
+  global _video_index_dirty
+  _video_index_dirty = True
 
-async def upload_video(name: str, tmp_file_path: str):
+async def upload_video(name: str,
+                       tmp_file_path: str,
+                       content_hash: Union[str, None] = None,
+                       keyframes: Union[List[int], None] = None):
   video = Video(name)
-  await videos.put(video.identifier, video)
-  video.start_frame_extract(tmp_file_path)
+  video.content_hash = content_hash
+  videos.put(video.identifier, video)
+  video.start_frame_extract(tmp_file_path, keyframes)
   return ReturnResult.success(name, video.identifier)
 
+def find_video_by_content_hash(content_hash: str):
+  for video in videos.values():
+    if video.content_hash == content_hash \
+      and video.process_status != Video.ProcessStatus.CANCELLED:
+      return video
+  return None
+
 async def get_video_info(video_identifier: str):
-  if video_identifier not in videos:
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
   return ReturnResult.success(video.frame_extract_finished(), *video.info)
 
 async def get_all_videos():
   video_infos = {}
-  for video in await videos.values():
+  for video in videos.values():
     video_infos[video.identifier] = (video.frame_extract_finished(),
                                      *video.info)
   return ReturnResult.success(video_infos)
 
 async def cancel_process(video_identifier: str):
-  if video_identifier not in videos:
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
-  video.frame_extract_task.cancel()
+  if video.frame_extract_task is not None:
+    video.frame_extract_task.cancel()
   return ReturnResult.success()
 
-async def cleanup_frame_cache(frame_id):
-  await asyncio.sleep(10)
-  await aiofiles.os.remove(Path("static", "img", "tmp", f"{frame_id}.png"))
+async def delete_video(video_identifier: str):
+  video = videos.remove(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  # gone for every request from here on, the folder follows in the background
+  frame_cache.invalidate(video_identifier)
+  prefetcher.forget(video_identifier)
+  mark_video_index_dirty()
+  task = asyncio.ensure_future(video.discard())
+  _discard_tasks.add(task)
+  task.add_done_callback(_discard_tasks.discard)
+  return ReturnResult.success()
+
+async def wait_for_deletions():
+  if _discard_tasks:
+    await asyncio.gather(*list(_discard_tasks), return_exceptions=True)
+
+async def enforce_disk_quota():
+  async with _quota_lock:
+    # files queued for removal are in the trash already, outside of it
+    used = await asyncio.to_thread(tree_size, Path(DATA_FOLDER, "videos"))
+    _storage_stats["used_bytes"] = used
+    _storage_stats["last_check"] = time()
+    if used <= DISK_QUOTA_BYTES:
+      return 0
+    now = time()
+    candidates = sorted(
+        (video for video in videos.values()
+         if not video.busy and now - video.last_accessed >= EVICT_IDLE_SECONDS),
+        key=lambda video: video.last_accessed)
+    freed = 0
+    for video in candidates:
+      if used - freed <= DISK_QUOTA_BYTES:
+        break
+      evicted = await video.evict_derived_data()
+      if evicted:
+        freed += evicted
+        _storage_stats["evicted_videos"] += 1
+        _storage_stats["evicted_bytes"] += evicted
+        print(f"Evicted {evicted / 1024 / 1024:.1f} MiB of thumbnails and " +
+              f"frames from video {video.identifier}")
+    if used - freed > DISK_QUOTA_BYTES:
+      print(f"Disk use of {(used - freed) / 1024 / 1024:.1f} MiB stays " +
+            f"over the quota, nothing else is idle and evictable")
+    return freed
+
+async def disk_quota_loop():
+  while True:
+    try:
+      await enforce_disk_quota()
+    except Exception as e:
+      print(f"Failed to enforce the disk quota: {e}")
+    await asyncio.sleep(QUOTA_CHECK_SECONDS)
+
+def get_storage_stats():
+  return ReturnResult.success({
+      "quota_bytes": DISK_QUOTA_BYTES,
+      **_storage_stats,
+      **reclaimer.stats
+  })
+
+def frame_id_of(video_identifier: str, frame_index: int):
+  return f"{video_identifier}_{frame_index}"
 
 async def read_frame(video_identifier: str, frame_index: int):
-  if video_identifier not in videos:
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
+  video.touch()
   if video.total_frame_count < frame_index:
     return ReturnResult(BackendError.FRAME_NOT_FOUND)
   if not video.frame_extract_finished():
     return ReturnResult(BackendError.VIDEO_PROCESSING)
-  frame_path = Path(DATA_FOLDER, "videos", video_identifier,
-                    f"frame_{frame_index}.png")
-  frame_id = uuid4().hex
-  await aioshutil.copyfile(frame_path,
-                           Path("static", "img", "tmp", f"{frame_id}.png"))
-  frame_ids[frame_id] = f"img/tmp/{frame_id}.png"
-  asyncio.create_task(cleanup_frame_cache(frame_id))
-  frame_labels = video.labels \
-    ["label_id", "frame_index", "label", \
-    "absolute_left", "absolute_top", "absolute_right", "absolute_bottom"] \
-    .loc[video.labels["frame_index"] == frame_index].to_dict(orient="records") # type: ignore
-  return ReturnResult.success(frame_id, frame_labels)
-
-def get_frame_png(frame_id: str):
-  if frame_id not in frame_ids:
+  frame_labels = video.labels.frame_records(frame_index, [
+      "label_id", "frame_index", "label", "absolute_left", "absolute_top",
+      "absolute_right", "absolute_bottom"
+  ])
+  video.prefetch_after(frame_index)
+  return ReturnResult.success(frame_id_of(video_identifier, frame_index),
+                              frame_labels)
+
+async def get_frame_image(video_identifier: str, frame_index: int):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  video.touch()
+  if not video.frame_extract_finished():
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  if frame_index < 1 or video.total_frame_count < frame_index:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  video.prefetch_after(frame_index)
+  encoded = await asyncio.to_thread(video.load_frame_encoded, frame_index)
+  if encoded is None:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  frame_bytes, extension = encoded
+  return ReturnResult.success(frame_bytes, MIME_TYPES[extension])
+
+async def get_frame_png(frame_id: str):
+  video_identifier, _, frame_index = frame_id.rpartition("_")
+  if not video_identifier or not frame_index.isdigit():
     return ReturnResult(BackendError.FRAME_NOT_FOUND)
-  frame_path = frame_ids[frame_id]
-  del frame_ids[frame_id]
-  return ReturnResult.success(frame_path)
+  return await get_frame_image(video_identifier, int(frame_index))
+
+def get_frame_cache_stats():
+  return ReturnResult.success({
+      **frame_cache.stats, "prefetch": prefetcher.stats
+  })
 
 async def label_frame(video_identifier: str, frame_index: int, label: str,
                       box: Tuple[int, int, int, int]):
-  if video_identifier not in videos:
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
   return video.label_frame(frame_index, label, box)
 
-async def unlabel_frame(video_identifier: str, label_id: str):
-  if video_identifier not in videos:
+async def unlabel_frame(video_identifier: str, frame_index: int,
+                        label_id: str):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  return video.unlabel_frame(frame_index, label_id)
+
+LABEL_OPERATIONS = ("label", "unlabel", "exclude")
+
+def is_integer(value):
+  return isinstance(value, int) and not isinstance(value, bool)
+
+def is_number(value):
+  return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def operation_error(error: BackendError):
+  return {"status": error, "error": error.error_message}
+
+async def apply_label_operations(video_identifier: str, operations: list):
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
-  return video.unlabel_frame(label_id)
+  if video.process_status != Video.ProcessStatus.COMPLETED:
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  return ReturnResult.success(video.apply_label_operations(operations))
 
 async def exclude_frame(video_identifier: str, frame_index: int):
-  if video_identifier not in videos:
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
-  video.exclude_frame(frame_index)
-  return ReturnResult.success()
+  return video.exclude_frame(frame_index)
+
+def check_thumbnail_range(video: Video, start: int, count: int):
+  if video.process_status != Video.ProcessStatus.COMPLETED:
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  if start < 1 or start > video.total_frame_count:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  if not 1 <= count <= MAX_SPRITE_FRAMES:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  return ReturnResult.success(min(count, video.total_frame_count - start + 1))
+
+async def get_thumbnails(video_identifier: str, start: int, count: int):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  video.touch()
+  result = check_thumbnail_range(video, start, count)
+  if not result.is_success:
+    return result
+  count = result.data
+  video.start_pyramid_build()
+  width, height = level_size(tuple(video.resolution), THUMBNAIL_WIDTH)
+  # normalized, so the client can draw them over a thumbnail, a preview or
+  # the full frame alike
+  labels = {}
+  for frame_index in range(start, start + count):
+    records = video.labels.frame_records(
+        frame_index, ["label_id", "label", "left", "top", "right", "bottom"])
+    if records:
+      labels[frame_index] = records
+  excluded = set(video.excluded_frames)
+  return ReturnResult.success({
+      "start": start,
+      "count": count,
+      "thumbnail_width": width,
+      "thumbnail_height": height,
+      "built_frame_count": video.pyramid.built if video.pyramid else 0,
+      "total_frame_count": video.total_frame_count,
+      "labels": labels,
+      "excluded_frames": [
+          frame_index for frame_index in range(start, start + count)
+          if frame_index in excluded
+      ]
+  })
 
-async def start_object_tracking(video_identifier: str, start_frame_index: int,
-                                algorithm: str):
-  if video_identifier not in videos:
+async def get_thumbnail_sprite(video_identifier: str, start: int, count: int,
+                               columns: int):
+  video = videos.get(video_identifier)
+  if video is None:
     return ReturnResult(BackendError.VIDEO_NOT_FOUND)
-  video = await videos[video_identifier]
+  video.touch()
+  result = check_thumbnail_range(video, start, count)
+  if not result.is_success:
+    return result
+  count = result.data
+  if not 1 <= columns <= MAX_SPRITE_FRAMES:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  pyramid = await video.open_pyramid()
+  video.start_pyramid_build()
+  complete = pyramid.built >= start + count - 1
+  sprite = await asyncio.to_thread(pyramid.sprite, start, count,
+                                   min(columns, count))
+  if sprite is None:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  return ReturnResult.success(sprite, complete)
+
+async def get_frame_preview(video_identifier: str, frame_index: int):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  video.touch()
+  if video.process_status != Video.ProcessStatus.COMPLETED:
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  if frame_index < 1 or video.total_frame_count < frame_index:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  preview = await asyncio.to_thread(video.load_preview, frame_index)
+  if preview is None:
+    return ReturnResult(BackendError.FRAME_NOT_FOUND)
+  return ReturnResult.success(preview)
+
+def check_similarity_threshold(threshold):
+  return isinstance(threshold, (int, float)) \
+    and not isinstance(threshold, bool) and 0 <= threshold <= 1
+
+async def get_near_duplicates(video_identifier: str,
+                              threshold: float,
+                              with_changes: bool = False):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  if video.process_status != Video.ProcessStatus.COMPLETED:
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  if not check_similarity_threshold(threshold):
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  # asking is what starts the analysis, a finished one is only read back
+  if video.similarity is None or not video.similarity.complete:
+    video.start_similarity_analysis()
+  similarity = video.similarity
+  result = {
+      "running": video.similarity_running,
+      "analyzed_frame_count": similarity.analyzed if similarity else 0,
+      "total_frame_count": video.total_frame_count,
+      "threshold": threshold,
+      "near_duplicates": []
+  }
+  if similarity is not None:
+    result["near_duplicates"] = await video.near_duplicates(threshold)
+    if with_changes:
+      result["changes"] = [
+          round(change, 4) for change in similarity.changes().tolist()
+      ]
+  return ReturnResult.success(result)
+
+async def exclude_near_duplicates(video_identifier: str, threshold: float):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  if video.process_status != Video.ProcessStatus.COMPLETED:
+    return ReturnResult(BackendError.VIDEO_PROCESSING)
+  if not check_similarity_threshold(threshold):
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  if video.similarity is None or not video.similarity.complete:
+    video.start_similarity_analysis()
+    return ReturnResult(BackendError.ANALYSIS_RUNNING)
+  candidates = await video.near_duplicates(threshold)
+  return ReturnResult.success(video.exclude_frames(candidates))
+
+async def check_object_tracking(video_identifier: str,
+                                start_frame_index: int,
+                                algorithm: str,
+                                scale: float = 1.0,
+                                allow_interpolation: bool = False):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  video.touch()
+  if not is_integer(start_frame_index) or not is_number(scale):
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
   if video.total_frame_count < start_frame_index:
     return ReturnResult(BackendError.FRAME_NOT_FOUND)
   if video.total_frame_count == start_frame_index:
     return ReturnResult(BackendError.NO_MORE_FRAMES)
   if not video.frame_extract_finished():
     return ReturnResult(BackendError.VIDEO_PROCESSING)
-  acceptable_algorithms = [
-      "KCF", "MedianFlow", "MOSSE", "CSRT", "MIL", "TLD", "Boosting"
-  ]
-  if algorithm not in acceptable_algorithms:
+  if algorithm not in ACCEPTABLE_ALGORITHMS and not (
+      allow_interpolation and algorithm == INTERPOLATE_ALGORITHM):
     return ReturnResult(BackendError.UNACCEPTABLE_ALGORITHM)
-  if start_frame_index not in video.labels["frame_index"].array:
+  if not 0 < scale <= 1:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  if not video.labels.has_frame(start_frame_index):
     return ReturnResult(BackendError.FRAME_NOT_LABELED)
-  continue_event = asyncio.Event()
-  task = video.start_object_tracking(start_frame_index, algorithm,
-                                     continue_event)
-  return ReturnResult.success(task, continue_event)
+  return ReturnResult.success(video)
 
-async def save_videos():
+class TrackingStream:
+
+  def __init__(self, window: int):
+    self.window = window
+    # frame indices as they are tracked, then the final ReturnResult
+    self.frames: asyncio.Queue = asyncio.Queue(window)
+    self.running = asyncio.Event()
+    self.running.set()
+    self.task: Union[asyncio.Task, None] = None
+
+  def pause(self):
+    self.running.clear()
+
+  def resume(self):
+    self.running.set()
+
+  def cancel(self):
+    if self.task is not None:
+      self.task.cancel()
+
+async def start_object_tracking(video_identifier: str,
+                                start_frame_index: int,
+                                algorithm: str,
+                                window: int = TRACKING_WINDOW,
+                                scale: float = 1.0):
+  if not is_integer(window) or window < 1:
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  result = await check_object_tracking(video_identifier, start_frame_index,
+                                       algorithm, scale)
+  if not result.is_success:
+    return result
+  video: Video = result.data
+  stream = TrackingStream(window)
+  video.start_object_tracking(start_frame_index, algorithm, stream, scale)
+  return ReturnResult.success(stream)
+
+class TrackingJob:
+
+  class Status(IntEnum):
+    QUEUED = 3
+    RUNNING = 0
+    COMPLETED = 1
+    FAILED = 2
+    CANCELLED = -1
+
+  def __init__(self, video: Video, starting_frame_index: int,
+               algorithm: str, max_frames: Union[int, None],
+               stop_on_failure: bool, min_iou: Union[float, None],
+               scale: float, priority: int):
+    self.identifier = uuid4().hex
+    self.video = video
+    self.starting_frame_index = starting_frame_index
+    self.algorithm = algorithm
+    self.max_frames = max_frames
+    self.stop_on_failure = stop_on_failure
+    self.min_iou = min_iou
+    self.scale = scale
+    self.priority = priority
+    self.status = TrackingJob.Status.QUEUED
+    self.stop_reason: Union[TrackingStopReason, None] = None
+    self.error: Union[BackendError, None] = None
+    self.last_frame_index = starting_frame_index
+    self.frames_tracked = 0
+    self.labels_added = 0
+    self.started_at: Union[float, None] = None
+    self.finished_at: Union[float, None] = None
+    self.task: Union[asyncio.Task, None] = None
+
+  def merge(self, batches):
+    records = [
+        self.video.tracked_record(frame_index, label, bbox)
+        for batch in batches for frame_index, tracked in batch
+        for label, bbox in tracked
+    ]
+    if not records:
+      return
+    self.video.insert_labels(records)
+    self.last_frame_index = batches[-1][-1][0]
+    self.frames_tracked = self.last_frame_index - self.starting_frame_index
+    self.labels_added += len(records)
+
+  async def run(self):
+    self.status = TrackingJob.Status.RUNNING
+    self.started_at = perf_counter()
+    cancel_event = None
+    future = None
+    try:
+      # the first channel starts the manager process, a cancel can come in
+      # while that is still going
+      results, cancel_event = await asyncio.to_thread(new_tracking_channel)
+      video = self.video
+      bboxes = video.labels.frame_records(self.starting_frame_index, [
+          "label", "absolute_left", "absolute_top", "absolute_right",
+          "absolute_bottom"
+      ])
+      last_frame_index = video.total_frame_count
+      if self.max_frames is not None:
+        last_frame_index = min(last_frame_index,
+                               self.starting_frame_index + self.max_frames)
+      future = asyncio.get_running_loop().run_in_executor(
+          get_tracking_process_executor(), track_video, video.frame_store,
+          self.starting_frame_index, last_frame_index, self.algorithm,
+          [bbox["label"] for bbox in bboxes],
+          [(bbox["absolute_left"], bbox["absolute_top"],
+            bbox["absolute_right"], bbox["absolute_bottom"])
+           for bbox in bboxes], self.stop_on_failure, self.min_iou,
+          self.scale, results, cancel_event)
+      while not future.done():
+        await asyncio.wait([future], timeout=TRACKING_BATCH_SECONDS)
+        self.merge(await asyncio.to_thread(drain_queue, results))
+      reason = future.result()
+      self.merge(await asyncio.to_thread(drain_queue, results))
+      if reason == TrackingStopReason.END_OF_VIDEO \
+        and last_frame_index < video.total_frame_count:
+        reason = TrackingStopReason.MAX_FRAMES
+      self.status = TrackingJob.Status.COMPLETED
+      self.stop_reason = reason
+    except asyncio.CancelledError:
+      self.status = TrackingJob.Status.CANCELLED
+      if cancel_event is not None:
+        cancel_event.set()
+      if future is not None:
+        # keep what the worker tracked before it noticed the flag
+        await asyncio.wait([future])
+        self.merge(await asyncio.to_thread(drain_queue, results))
+    except Exception as e:
+      # nobody awaits the job, so an error has to end up in its status
+      print(f"Tracking job {self.identifier} failed: {e!r}")
+      self.status = TrackingJob.Status.FAILED
+      self.error = BackendError.TRACKING_FAILED
+    finally:
+      self.finished_at = perf_counter()
+      print(f"Tracking job {self.identifier} finished: " +
+            f"{self.frames_tracked} frames at " +
+            f"{self.frames_per_second:.1f} frames/s")
+
+  def cancel_queued(self):
+    self.status = TrackingJob.Status.CANCELLED
+
+  @property
+  def frames_per_second(self):
+    if self.started_at is None:
+      return 0.0
+    elapsed = (self.finished_at or perf_counter()) - self.started_at
+    return self.frames_tracked / elapsed if elapsed > 0 else 0.0
+
+  def to_dict(self):
+    return {
+        "job_id": self.identifier,
+        "video_id": self.video.identifier,
+        "algorithm": self.algorithm,
+        "scale": self.scale,
+        "priority": self.priority,
+        "job_status": self.status.name.lower(),
+        "queue_position": tracking_scheduler.queue_position(self),
+        "stop_reason": self.stop_reason.name.lower()
+                       if self.stop_reason is not None else None,
+        "error": self.error.error_message if self.error is not None else None,
+        "start_frame": self.starting_frame_index,
+        "last_frame": self.last_frame_index,
+        "frames_tracked": self.frames_tracked,
+        "labels_added": self.labels_added,
+        "frames_per_second": self.frames_per_second
+    }
+
+class InterpolationJob(TrackingJob):
+  # boxes between keyframes come from the keyframes themselves; the frames
+  # are only decoded when refining
+
+  def __init__(self, video: Video, starting_frame_index: int,
+               max_frames: Union[int, None], method: str,
+               max_gap: Union[int, None], refine_algorithm: Union[str, None],
+               min_similarity: float, priority: int):
+    super().__init__(video, starting_frame_index, INTERPOLATE_ALGORITHM,
+                     max_frames, False, None, 1.0, priority)
+    self.method = method
+    self.max_gap = max_gap
+    self.refine_algorithm = refine_algorithm
+    self.min_similarity = min_similarity
+    self.labels_refined = 0
+
+  def interpolate(self, labels: pd.DataFrame, last_frame_index: int,
+                  excluded_frames: List[int], cancel_event: threading.Event):
+    video = self.video
+    segments = match_keyframes(labels, self.starting_frame_index,
+                               last_frame_index, self.max_gap)
+    frames, segment_of, boxes = interpolate(segments, self.method,
+                                            tuple(video.resolution))
+    kept = ~np.isin(frames, excluded_frames)
+    frames, segment_of, boxes = frames[kept], segment_of[kept], boxes[kept]
+    if self.refine_algorithm is not None and len(frames):
+      self.labels_refined = refine(video.frame_store, segments, frames,
+                                   segment_of, boxes, self.refine_algorithm,
+                                   self.min_similarity, cancel_event)
+      width, height = video.resolution
+      boxes = np.clip(boxes, 0, [width, height, width, height])
+    return frames, segments.labels[segments.start][segment_of], boxes
+
+  async def run(self):
+    self.status = TrackingJob.Status.RUNNING
+    self.started_at = perf_counter()
+    cancel_event = threading.Event()
+    future = None
+    try:
+      video = self.video
+      last_frame_index = video.total_frame_count
+      if self.max_frames is not None:
+        last_frame_index = min(last_frame_index,
+                               self.starting_frame_index + self.max_frames)
+      future = asyncio.ensure_future(
+          asyncio.to_thread(self.interpolate, video.labels.to_dataframe(),
+                            last_frame_index, list(video.excluded_frames),
+                            cancel_event))
+      await asyncio.wait([future])
+      frames, names, boxes = future.result()
+      # frames labeled while this ran keep what the annotator gave them
+      kept = ~np.isin(frames, list(video.labels.rows_by_frame)) \
+        & (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+      if kept.any():
+        video.insert_labels(
+            video.label_records(frames[kept], names[kept], boxes[kept]))
+        self.last_frame_index = int(frames[kept].max())
+      self.frames_tracked = len(np.unique(frames[kept]))
+      self.labels_added = int(kept.sum())
+      self.status = TrackingJob.Status.COMPLETED
+      self.stop_reason = TrackingStopReason.MAX_FRAMES \
+        if last_frame_index < video.total_frame_count \
+        else TrackingStopReason.END_OF_VIDEO
+    except asyncio.CancelledError:
+      # nothing is inserted, a half refined pass isn't worth keeping
+      self.status = TrackingJob.Status.CANCELLED
+      if cancel_event is not None:
+        cancel_event.set()
+      if future is not None:
+        await asyncio.wait([future])
+    except Exception as e:
+      print(f"Interpolation job {self.identifier} failed: {e!r}")
+      self.status = TrackingJob.Status.FAILED
+      self.error = BackendError.TRACKING_FAILED
+    finally:
+      self.finished_at = perf_counter()
+      print(f"Interpolation job {self.identifier} finished: " +
+            f"{self.labels_added} labels on {self.frames_tracked} frames, " +
+            f"{self.labels_refined} refined, in " +
+            f"{(self.finished_at - self.started_at) * 1000:.1f} ms")
+
+  def to_dict(self):
+    return {
+        **super().to_dict(), "method": self.method,
+        "max_gap": self.max_gap,
+        "refine_algorithm": self.refine_algorithm,
+        "labels_refined": self.labels_refined
+    }
+
+def drain_queue(results):
+  batches = []
+  while True:
+    try:
+      batches.append(results.get_nowait())
+    except queue.Empty:
+      return batches
+
+tracking_jobs: Dict[str, TrackingJob] = {}
+
+def queue_depths():
+  all_videos = videos.values()
+  scheduler_stats = tracking_scheduler.stats
+  return gauge_values({
+      "frame_extracts": sum(
+          1 for video in all_videos
+          if video.process_status in (Video.ProcessStatus.PREPARING,
+                                      Video.ProcessStatus.PROCESSING)),
+      "similarity_analyses": sum(
+          1 for video in all_videos if video.similarity_running),
+      "pyramid_builds": sum(
+          1 for video in all_videos if video.pyramid_running),
+      "video_deletions": len(_discard_tasks),
+      "tracking_jobs_queued": scheduler_stats["queued"],
+      "tracking_jobs_running": scheduler_stats["running"],
+      "prefetch_streams": prefetcher.stats["sequential_streams"]
+  }, "queue")
+
+def frame_cache_state():
+  return gauge_values({
+      name: value for name, value in frame_cache.stats.items()
+      if name != "hit_rate"
+  }, "stat")
+
+metrics.gauge("ftcml_queue_depth", "Jobs waiting or running per queue",
+              queue_depths)
+metrics.gauge("ftcml_frame_cache", "Frame cache counters and size",
+              frame_cache_state)
+metrics.gauge("ftcml_videos", "Videos in the registry",
+              lambda: {(): len(videos)})
+metrics.gauge(
+    "ftcml_storage", "Disk use against the quota and background removal",
+    lambda: gauge_values({
+        name: value for name, value in get_storage_stats().data.items()
+        if name != "last_check"
+    }, "stat"))
+
+async def start_tracking_job(video_identifier: str,
+                             start_frame_index: int,
+                             algorithm: str,
+                             max_frames: Union[int, None] = None,
+                             stop_on_failure: bool = False,
+                             min_iou: Union[float, None] = None,
+                             scale: float = 1.0,
+                             priority: int = 0,
+                             method: str = "linear",
+                             max_gap: Union[int, None] = None,
+                             refine_algorithm: Union[str, None] = None,
+                             min_similarity: float = DEFAULT_MIN_SIMILARITY):
+  result = await check_object_tracking(video_identifier,
+                                       start_frame_index,
+                                       algorithm,
+                                       scale,
+                                       allow_interpolation=True)
+  if not result.is_success:
+    return result
+  if max_frames is not None and not (is_integer(max_frames)
+                                     and max_frames >= 1) \
+    or min_iou is not None and not (is_number(min_iou) and 0 <= min_iou <= 1) \
+    or not is_integer(priority):
+    return ReturnResult(BackendError.INVALID_ARGUMENT)
+  if algorithm == INTERPOLATE_ALGORITHM:
+    if method not in INTERPOLATION_METHODS \
+      or max_gap is not None and not (is_integer(max_gap) and max_gap >= 2) \
+      or not (is_number(min_similarity) and -1 <= min_similarity <= 1):
+      return ReturnResult(BackendError.INVALID_ARGUMENT)
+    if refine_algorithm is not None \
+      and refine_algorithm not in ACCEPTABLE_ALGORITHMS:
+      return ReturnResult(BackendError.UNACCEPTABLE_ALGORITHM)
+    job = InterpolationJob(result.data, start_frame_index, max_frames, method,
+                           max_gap, refine_algorithm, min_similarity,
+                           priority)
+    tracking_jobs[job.identifier] = job
+    if refine_algorithm is None:
+      # takes milliseconds, done before the response goes out
+      await job.run()
+    else:
+      tracking_scheduler.submit(job)
+    return ReturnResult.success(job.identifier)
+  job = TrackingJob(result.data, start_frame_index, algorithm, max_frames,
+                    stop_on_failure, min_iou, scale, priority)
+  tracking_jobs[job.identifier] = job
+  tracking_scheduler.submit(job)
+  return ReturnResult.success(job.identifier)
+
+def get_tracking_job(job_identifier: str):
+  if job_identifier not in tracking_jobs:
+    return ReturnResult(BackendError.JOB_NOT_FOUND)
+  return ReturnResult.success(tracking_jobs[job_identifier].to_dict())
+
+def get_all_tracking_jobs():
+  return ReturnResult.success(
+      [job.to_dict() for job in tracking_jobs.values()],
+      tracking_scheduler.stats)
+
+def cancel_tracking_job(job_identifier: str):
+  if job_identifier not in tracking_jobs:
+    return ReturnResult(BackendError.JOB_NOT_FOUND)
+  tracking_scheduler.cancel(tracking_jobs[job_identifier])
+  return ReturnResult.success()
+
+async def get_tracking_stats(video_identifier: str):
+  video = videos.get(video_identifier)
+  if video is None:
+    return ReturnResult(BackendError.VIDEO_NOT_FOUND)
+  return ReturnResult.success(
+      [stats.to_dict() for stats in video.tracker_stats])
+
+def write_video_index():
+  global _video_index_dirty
+  _video_index_dirty = False
   json_dict = []
-  for video in await videos.values():
+  for video in videos.values():
+    if video.process_status == Video.ProcessStatus.CANCELLED:
+      continue
     if (vresult := video.to_dict()).is_success:
       json_dict.append(vresult.data)
     else:
       print(f"Failed to save video {video.identifier}")
-  with open(Path(DATA_FOLDER, "videos.json"), "w") as f:
+  tmp_path = Path(DATA_FOLDER, "videos.json.tmp")
+  with open(tmp_path, "w") as f:
     json.dump(json_dict, f)
-  print(f"Saved {len(json_dict)} videos")
+  os.replace(tmp_path, Path(DATA_FOLDER, "videos.json"))
+  return len(json_dict)
+
+async def flush_labels():
+  for video in videos.values():
+    if video.process_status == Video.ProcessStatus.COMPLETED:
+      await video.flush_labels()
+  if _video_index_dirty:
+    write_video_index()
+
+async def label_flush_loop():
+  while True:
+    await asyncio.sleep(LABEL_FLUSH_SECONDS)
+    try:
+      await flush_labels()
+    except Exception as e:
+      print(f"Failed to flush labels: {e}")
+
+async def save_videos():
+  await wait_for_deletions()
+  for video in videos.values():
+    if video.process_status == Video.ProcessStatus.COMPLETED:
+      await video.save_labels()
+  print(f"Saved {write_video_index()} videos")
+
+async def preload_labels(pending: List[Video]):
+  started = perf_counter()
+  loop = asyncio.get_running_loop()
+  with ThreadPoolExecutor(LABEL_LOAD_WORKERS,
+                          thread_name_prefix="label_load") as executor:
+    results = await asyncio.gather(
+        *[loop.run_in_executor(executor, video.load_labels)
+          for video in pending],
+        return_exceptions=True)
+  for video, result in zip(pending, results):
+    if isinstance(result, BaseException):
+      print(f"Failed to load labels for video {video.identifier}: {result}")
+  print(f"Preloaded labels for {len(pending)} videos in " +
+        f"{perf_counter() - started:.2f} s")
 
 async def load_videos():
+  # deletions the last run didn't finish
+  reclaimer.resume()
   if not Path(DATA_FOLDER, "videos.json").exists():
     return
+  started = perf_counter()
   with open(Path(DATA_FOLDER, "videos.json"), "r") as f:
     videos_json = json.load(f)
+  loaded: Dict[str, Video] = {}
   for video_json in videos_json:
     vresult = Video.from_dict(video_json)
     if vresult.is_success:
-      await videos.put(vresult.data.identifier, vresult.data)
+      loaded[vresult.data.identifier] = vresult.data
     else:
       print(f"Failed to load video {video_json['identifier']}")
-  print(f"Loaded {len(videos)} videos")
+  # published in one go rather than copying the registry once per video
+  videos.update(loaded)
+  print(f"Loaded {len(videos)} videos in " +
+        f"{(perf_counter() - started) * 1000:.1f} ms")
+  if PRELOAD_LABELS:
+    # labels come in behind the scenes, a request that needs a video's labels
+    # before then loads them itself
+    global _preload_task
+    _preload_task = asyncio.ensure_future(
+        preload_labels(videos.values()))